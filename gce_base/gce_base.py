@@ -4,6 +4,7 @@ from typing import Dict, Any
 import proto
 
 from plugin import Plugin
+from util.label_specs import field
 from util.gcp_utils import (
     cloudclient_pb_obj_to_dict,
     cloudclient_pb_objects_to_list_of_dicts,
@@ -11,14 +12,12 @@ from util.gcp_utils import (
 
 
 class GceBase(Plugin, metaclass=ABCMeta):
+    _label_specs = {"name": field("name")}
+
     @staticmethod
     def _discovery_api():
         return "compute", "v1"
 
-    def _gcp_name(self, gcp_object):
-        """Method dynamically called in generating labels, so don't change name"""
-        return self._name_no_separator(gcp_object)
-
     def _get_resource_as_dict(self, request: proto.Message) -> Dict[str, Any]:
         inst = self._cloudclient().get(request)
         return cloudclient_pb_obj_to_dict(inst)
@@ -26,3 +25,10 @@ class GceBase(Plugin, metaclass=ABCMeta):
     def _list_resources_as_dicts(self, request: proto.Message):
         objects = self._cloudclient().list(request)  # Disk class
         return cloudclient_pb_objects_to_list_of_dicts(objects)
+
+    def _list_pages_as_dicts(self, request: proto.Message):
+        """:return for each page, the objects and the next page token, as for Plugin._list_pages"""
+        for page in self._cloudclient().list(request).pages:
+            yield list(cloudclient_pb_objects_to_list_of_dicts(page.items)), (
+                page.next_page_token or None
+            )
@@ -5,17 +5,25 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import lru_cache
 from typing import Dict, Optional
 
+from gce_base import zone_occupancy
 from gce_base.gce_base import GceBase
-from util import gcp_utils
+from plugin import Sweep
+from util import api_limiter, config_utils, gcp_utils, skip_cache
 from util.gcp_utils import add_loaded_lib
+from util.label_specs import MISSING, after_last, chain, field
 from util.utils import timing
 
 
 class GceZonalBase(GceBase, metaclass=ABCMeta):
-    def __init__(self):
+    _label_specs = {
+        "zone": field("zone", transform=after_last("/")),
+        "region": field(
+            "zone", transform=chain(after_last("/"), gcp_utils.region_from_zone)
+        ),
+    }
 
-        super().__init__()
-        self._write_lock = threading.Lock()
+    # The zone threads label at once
+    _PER_THREAD_BATCHES = True
 
     @staticmethod
     @abstractmethod
@@ -25,22 +33,14 @@ class GceZonalBase(GceBase, metaclass=ABCMeta):
         should cache the result."""
         pass
 
-    def _gcp_zone(self, gcp_object):
-        """Method dynamically called in generating labels, so don't change name"""
-        try:
-            return gcp_object["zone"].split("/")[-1]
-        except KeyError:
-            logging.exception("")
-            return None
+    def _zone(self, gcp_object) -> Optional[str]:
+        zone = GceZonalBase._label_specs["zone"](gcp_object)
+        return None if zone is MISSING else zone
 
-    def _gcp_region(self, gcp_object):
-        """Method dynamically called in generating labels, so don't change name"""
-        try:
-            zone = self._gcp_zone(gcp_object)
-            return gcp_utils.region_from_zone(zone)
-        except KeyError:
-            logging.exception("")
-            return None
+    def _object_from_asset(self, asset):
+        gcp_object = super()._object_from_asset(asset)
+        gcp_object.setdefault("zone", asset.get("location"))
+        return gcp_object
 
     @lru_cache(maxsize=1)
     def _all_zones(self):
@@ -57,32 +57,94 @@ class GceZonalBase(GceBase, metaclass=ABCMeta):
             request = compute_v1.ListZonesRequest(project=project_id)
             zones_client = compute_v1.ZonesClient()
             zones = zones_client.list(request)
-            return [z.name for z in zones]
-
-    def label_all(self, project_id):
+            regions = config_utils.zone_regions()
+            return [
+                z.name
+                for z in zones
+                if not regions or gcp_utils.region_from_zone(z.name) in regions
+            ]
+
+    def _label_all(self, project_id, sweep: Sweep):
         with timing(f"label_all {type(self).__name__} in {project_id}"):
-            self.__label_by_zones(project_id, self._all_zones())
+            all_zones = self._all_zones()
+            plugin_name = type(self).__name__
+            zones = zone_occupancy.zones_to_sweep(project_id, plugin_name, all_zones)
+            is_full_sweep = len(zones) == len(all_zones) and sweep.partition is None
+            if sweep.partition is not None:
+                # Partition by zone rather than by resource, since listing a zone is the main cost
+                zones = [
+                    z for z in zones if sweep.partition.contains(f"{project_id}/{z}")
+                ]
+            # The checkpoint is the zones already done
+            zones_done = sweep.checkpoint.setdefault("zones_done", [])
+            zones = [z for z in zones if z not in zones_done]
+            count = self.__label_by_zones(project_id, zones, sweep)
             if self.counter > 0:
                 self.do_batch()
+            # With zones that failed to list, their occupancy is unknown, so they are listed again next time
+            if is_full_sweep and not sweep.listing_errors:
+                zone_occupancy.record_full_sweep(project_id, plugin_name)
+            return count
+
+    def __label_by_zones(self, project_id, zones, sweep: Sweep) -> int:
+        checkpoint_lock = threading.Lock()
+        suspended = False
 
-    def __label_by_zones(self, project_id, zones):
         def label_one_zone(zone):
+            nonlocal suspended
+            if sweep.stop.is_set():
+                return 0
+            if sweep.out_of_time():
+                suspended = True
+                return 0
             # with timing(
             #     f"zone {zone}, label_all {type(self).__name__} in {project_id}"
             # ):
-            for resource in self._list_all(project_id, zone):
-                try:
-                    self.label_resource(resource, project_id)
-                except Exception:
-                    logging.exception("in label_one_zone")
-
-        with ThreadPoolExecutor(max_workers=8) as executor:
-            futs = [executor.submit(label_one_zone, zone) for zone in zones]
+            try:
+                with self._pipeline.owned_by(sweep):
+                    count_in_zone = self._label_resources(
+                        self._list_all(project_id, zone), project_id, stop=sweep.stop
+                    )
+            except Exception as e:
+                if skip_cache.skip_reason(e):
+                    sweep.stop.set()  # Without waiting for the result to be seen
+                raise
+            finally:
+                self._pipeline.flush_thread()
+            if sweep.stop.is_set():
+                return count_in_zone  # Maybe not all of the zone, so not done
+            if count_in_zone > 0:
+                zone_occupancy.record_occupied(project_id, zone)
+            with checkpoint_lock:
+                sweep.checkpoint["zones_done"].append(zone)
+            return count_in_zone
+
+        count = 0
+        # Either way, leaving the with block waits for the zones in progress, which check sweep.stop
+        if api_limiter.is_enabled():
+            executor = api_limiter.LimitedExecutor("compute")
+        else:
+            executor = ThreadPoolExecutor(max_workers=8)
+        with executor:
+            futs = []
+            for zone in zones:
+                if sweep.stop.is_set():
+                    break
+                futs.append(executor.submit(label_one_zone, zone))
             for future in as_completed(futs):
                 try:
-                    _ = future.result()  # We Do not use ret; just a way of waiting
-                except Exception:
+                    count += future.result()
+                except Exception as e:
+                    if skip_cache.skip_reason(e):
+                        # API disabled or no permission: Same for all zones, so stop here
+                        for f in futs:
+                            f.cancel()
+                        raise
+                    sweep.listing_errors += 1
                     logging.exception("Error getting result for future")
+        if suspended:
+            self._suspend()
+        return count
 
     def get_gcp_object(self, log_data: Dict) -> Optional[Dict]:
         try:
@@ -91,6 +153,7 @@ class GceZonalBase(GceBase, metaclass=ABCMeta):
             name = name[idx + 1 :]
             project_id = log_data["resource"]["labels"]["project_id"]
             zone = log_data["resource"]["labels"]["zone"]
+            zone_occupancy.record_occupied(project_id, zone)
             resource = self._get_resource(project_id, zone, name)
             return resource
         except Exception:
@@ -101,6 +164,11 @@ class GceZonalBase(GceBase, metaclass=ABCMeta):
     def _get_resource(self, project_id, zone, name):
         pass
 
+    def _refresh_resource(self, gcp_object, project_id):
+        return self._get_resource(
+            project_id, self._zone(gcp_object), gcp_object["name"]
+        )
+
     @abstractmethod
     def _list_all(self, project_id, zone):
         pass
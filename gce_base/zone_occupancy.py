@@ -0,0 +1,134 @@
+"""
+Index of which zones of each project have GCE resources, so that GceZonalBase need not list
+all ~100 zones for every project on every cron run, when most projects use two or three.
+
+A zone is occupied if a sweep found resources of any zonal plugin there, or a creation event
+was there, within the last 2 * empty_zone_sweep_days. Occupied zones are swept on every run;
+all zones are swept once every empty_zone_sweep_days per project and plugin, to discover
+resources created while Iris was not listening.
+
+Occupancy is recorded by the do_label requests, which App Engine routes to various instances;
+so with zone_occupancy_backend "memcache" (the default), the index is shared by all instances.
+With "local", it is in-process, and optionally persisted to the local file zone_occupancy_path,
+which is useful only where one instance serves all requests, as in local development.
+With no entry for a project, as after a restart or an eviction from Memcache, all zones are swept.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from util import config_utils, memcache_utils
+
+_SECONDS_PER_DAY = 24 * 60 * 60
+# The cron runs about once a day, but not at exactly the same second
+_CRON_JITTER_SECONDS = 60 * 60
+_MEMCACHE_KEY_PREFIX = "iris_zone_occupancy/"
+
+__lock = threading.Lock()
+# project_id to {"zones": {zone: time last seen occupied}, "full_sweeps": {plugin: time of last full sweep}}
+__entries: Optional[Dict[str, Dict]] = None
+
+
+def is_enabled() -> bool:
+    return config_utils.empty_zone_sweep_days() > 0
+
+
+def zones_to_sweep(
+    project_id: str, plugin_name: str, all_zones: List[str]
+) -> List[str]:
+    """:return all_zones if a full sweep is due, else only the occupied ones"""
+    if not is_enabled():
+        return all_zones
+    now = time.time()
+    interval = config_utils.empty_zone_sweep_days() * _SECONDS_PER_DAY
+    entry = __read(project_id)
+    if entry is None:
+        return all_zones
+    last_full_sweep = entry["full_sweeps"].get(plugin_name, 0)
+    if now >= last_full_sweep + interval - _CRON_JITTER_SECONDS:
+        return all_zones
+    occupied = {z for z, seen in entry["zones"].items() if now < seen + 2 * interval}
+    return [z for z in all_zones if z in occupied]
+
+
+def record_occupied(project_id: str, zone: str):
+    """For a zone where a sweep found resources, or where there was a resource-creation event"""
+    if not is_enabled() or not zone:
+        return
+    now = time.time()
+    __update(
+        project_id, lambda entry: {**entry, "zones": {**entry["zones"], zone: now}}
+    )
+
+
+def record_full_sweep(project_id: str, plugin_name: str):
+    """For when a sweep of all zones has completed"""
+    if not is_enabled():
+        return
+    now = time.time()
+    __update(
+        project_id,
+        lambda entry: {
+            **entry,
+            "full_sweeps": {**entry["full_sweeps"], plugin_name: now},
+        },
+    )
+
+
+def __read(project_id: str) -> Optional[Dict]:
+    if config_utils.zone_occupancy_backend() == "memcache":
+        return memcache_utils.client().get(_MEMCACHE_KEY_PREFIX + project_id)
+    with __lock:
+        return __get_entries().get(project_id)
+
+
+def __update(project_id: str, func: Callable[[Dict], Dict]):
+    """Replace the project's entry with func(entry)"""
+    if config_utils.zone_occupancy_backend() == "memcache":
+        # Zones are occupied for 2 * empty_zone_sweep_days, so the entry is not needed after that
+        ttl = 2 * config_utils.empty_zone_sweep_days() * _SECONDS_PER_DAY
+        memcache_utils.update(
+            _MEMCACHE_KEY_PREFIX + project_id,
+            lambda entry: func(entry or {"zones": {}, "full_sweeps": {}}),
+            time=ttl,
+        )
+        return
+    with __lock:
+        entries = __get_entries()
+        entries[project_id] = func(
+            entries.get(project_id) or {"zones": {}, "full_sweeps": {}}
+        )
+        __save()
+
+
+def __get_entries() -> Dict[str, Dict]:
+    """Call only under the lock"""
+    global __entries
+    if __entries is None:
+        __entries = {}
+        path = config_utils.zone_occupancy_path()
+        if path and os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    __entries = json.load(f)
+            except (OSError, ValueError):
+                logging.exception("Cannot load zone occupancy from %s", path)
+    return __entries
+
+
+def __save():
+    """Call only under the lock"""
+    path = config_utils.zone_occupancy_path()
+    if not path:
+        return
+    try:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(__entries, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        logging.exception("Cannot save zone occupancy to %s", path)
@@ -26,7 +26,7 @@ init_logging()
 
 from functools import lru_cache
 
-from typing import Dict, Type
+from typing import Dict, List, Optional, Type
 
 import time
 
@@ -36,8 +36,19 @@ import json
 import logging
 import os
 
-from plugin import Plugin, PluginHolder
-from util import pubsub_utils, gcp_utils, utils, config_utils
+from plugin import Plugin, PluginHolder, Sweep, SweepSuspended
+from util import (
+    pubsub_utils,
+    gcp_utils,
+    utils,
+    config_utils,
+    partition_utils,
+    skip_cache,
+    export_utils,
+    work_journal,
+    lease_utils,
+    project_labels,
+)
 from util.gcp_utils import (
     detect_gae,
     is_appscript_project,
@@ -112,8 +123,20 @@ def schedule():
             if not is_cron:
                 return "Access Denied: No Cron header found", 403
 
-            enabled_projects = __get_enabled_projects()
-            __send_pubsub_per_projectplugin(enabled_projects)
+            if config_utils.is_copying_labels_from_project():
+                try:
+                    project_labels.refresh()
+                except Exception:
+                    # The labeling falls back to reading each project
+                    logging.exception("Cannot load project labels")
+
+            if config_utils.resource_search():
+                searched_plugins = __send_pubsub_per_scopeplugin()
+            else:
+                searched_plugins = []
+            if len(searched_plugins) < len(PluginHolder.plugins):
+                enabled_projects = __get_enabled_projects()
+                __send_pubsub_per_projectplugin(enabled_projects, searched_plugins)
             # All errors are actually caught before this point,
             # since most errors are unrecoverable.
             return "OK", 200
@@ -122,8 +145,13 @@ def schedule():
             return "Error", 500
 
 
-@lru_cache(maxsize=1)
 def __get_enabled_projects():
+    return __get_enabled_projects_for_config(config_utils.config_version())
+
+
+# The argument is the config version, so that a reloaded config is reflected
+@lru_cache(maxsize=1)
+def __get_enabled_projects_for_config(_config_version):
     configured_as_enabled = config_utils.enabled_projects()
     if configured_as_enabled:
         enabled_projs = configured_as_enabled
@@ -161,32 +189,83 @@ def __get_enabled_projects():
     return enabled_projs
 
 
-def __send_pubsub_per_projectplugin(configured_projects):
-    msg_count = 0
-    for project_id in configured_projects:
-        for plugin_cls in PluginHolder.plugins:
-            if (
-                not plugin_cls.is_labeled_on_creation()
-                or plugin_cls.relabel_on_cron()
-                or config_utils.label_all_on_cron()
-            ):
+def __send_pubsub_per_scopeplugin() -> List[Type[Plugin]]:
+    """
+    With resource_search, send one message per plugin per organization or folder
+    in project_roots, rather than per project.
+    :return the plugins that are handled this way
+    """
+    scopes = gcp_utils.project_roots()
+    searched_plugins = []
+    for plugin_cls in PluginHolder.plugins:
+        if plugin_cls.asset_types() and (
+            __needs_cron(plugin_cls) or config_utils.label_all_on_cron()
+        ):
+            for scope in scopes:
                 pubsub_utils.publish(
-                    msg=json.dumps(
-                        {"project_id": project_id, "plugin": plugin_cls.__name__}
-                    ),
+                    msg=json.dumps({"scope": scope, "plugin": plugin_cls.__name__}),
                     topic_id=pubsub_utils.schedulelabeling_topic(),
                 )
+            searched_plugins.append(plugin_cls)
+    logging.info(
+        "schedule() sent messages to label by search in %s for %s",
+        scopes,
+        [p.__name__ for p in searched_plugins],
+    )
+    return searched_plugins
 
-                logging.info(
-                    "Sent do_label message for %s , %s",
-                    project_id,
-                    plugin_cls.__name__,
-                )
+
+def __needs_cron(plugin_cls: Type[Plugin]) -> bool:
+    return not plugin_cls.is_labeled_on_creation() or plugin_cls.relabel_on_cron()
+
+
+def __send_pubsub_per_projectplugin(configured_projects, excluded_plugins=()):
+    msg_count = 0
+    skipped_count = 0
+    # Used only where the cron labeling is due just to label_all_on_cron
+    partition = partition_utils.todays_partition(config_utils.rolling_partitions())
+    if partition is not None:
+        logging.info(
+            "Rolling relabel by %s: partition %s of %s",
+            config_utils.rolling_partition_by(),
+            partition.index,
+            partition.count,
+        )
+    for project_id in configured_projects:
+        skipped_plugins = skip_cache.skipped_plugins(project_id)
+        for plugin_cls in PluginHolder.plugins:
+            if plugin_cls in excluded_plugins:
+                continue
+            msg = {"project_id": project_id, "plugin": plugin_cls.__name__}
+            if not __needs_cron(plugin_cls):
+                if not config_utils.label_all_on_cron():
+                    continue
+                if partition is not None:
+                    if config_utils.rolling_partition_by() == "project":
+                        if not partition.contains(project_id):
+                            continue
+                    else:
+                        msg["partition"] = list(partition)
+            if plugin_cls.__name__ in skipped_plugins:
+                skipped_count += 1
+                continue
+
+            pubsub_utils.publish(
+                msg=json.dumps(msg),
+                topic_id=pubsub_utils.schedulelabeling_topic(),
+            )
+
+            logging.info(
+                "Sent do_label message for %s , %s",
+                project_id,
+                plugin_cls.__name__,
+            )
             msg_count += 1
     logging.info(
-        "schedule() sent %d messages to label %d projects",
+        "schedule() sent %d messages to label %d projects; skipped %d per skip cache",
         msg_count,
         len(configured_projects),
+        skipped_count,
     )
 
 
@@ -213,11 +292,19 @@ def label_one():
 
             method_from_log = data["protoPayload"]["methodName"]
 
+            if method_from_log.endswith("UpdateProject"):
+                __on_project_updated(data)
+                return "OK", 200
+
             for plugin_cls in PluginHolder.plugins.keys():
                 method_names = plugin_cls.method_names()
 
                 for supported_method in method_names:
                     if supported_method.lower() in method_from_log.lower():
+                        # A resource was created, so the project should not be skipped on cron
+                        skip_cache.clear_project(
+                            data.get("resource", {}).get("labels", {}).get("project_id")
+                        )
                         if plugin_cls.is_labeled_on_creation():
                             __label_one_0(data, plugin_cls)
 
@@ -247,6 +334,30 @@ def label_one():
             return "Error", 500
 
 
+def __on_project_updated(data):
+    """The project's labels may have changed, so drop the cached labels,
+    and optionally relabel the project's resources with the new ones."""
+    project_id = data.get("resource", {}).get("labels", {}).get("project_id")
+    if not project_id:
+        logging.info("No project_id in UpdateProject event")
+        return
+    project_labels.invalidate(project_id)
+    logging.info("Project %s updated; invalidated its cached labels", project_id)
+    if (
+        config_utils.is_copying_labels_from_project()
+        and config_utils.repropagate_project_labels()
+        and is_project_enabled(project_id)
+    ):
+        for plugin_cls in PluginHolder.plugins:
+            pubsub_utils.publish(
+                msg=json.dumps(
+                    {"project_id": project_id, "plugin": plugin_cls.__name__}
+                ),
+                topic_id=pubsub_utils.schedulelabeling_topic(),
+            )
+        logging.info("Sent do_label messages to copy new labels of %s", project_id)
+
+
 def __label_one_0(data, plugin_cls: Type[Plugin]):
     plugin = PluginHolder.get_plugin_instance(plugin_cls)
     gcp_object = plugin.get_gcp_object(data)
@@ -306,40 +417,175 @@ def do_label():
 
         """Receive a push message from PubSub, sent from schedule() above,
         with instructions to label all objects of a given plugin and project_id.
+        Alternatively, the message may give the export_uri of a Cloud Asset Inventory export
+        (gs://bucket/object) from which to label, as sent by test_label_from_export.py.
+
+        With work_journal_path in the config, the job is journaled, and the message acked at once;
+        background workers do the labeling.
         """
-        project_id = ""  # set up variables to allow logging in Exception block at end
-        plugin_class_name = ""
+        data = {}
         try:
             data = __extract_pubsub_content()
-            plugin_class_name = data["plugin"]
+            if work_journal.is_enabled():
+                if work_journal.enqueue(data):
+                    logging.info("Journaled do_label %s", utils.shorten(data, 200))
+                return "OK", 200
 
-            plugin = PluginHolder.get_plugin_instance_by_name(plugin_class_name)
-            if not plugin:
-                logging.info(
-                    "(OK if plugin is disabled.) No plugins found for %s. Enabled plugins are %s",
-                    plugin_class_name,
-                    config_utils.enabled_plugins(),
-                )
-            else:
-                project_id = data["project_id"]
-                with timing(f"do_label {plugin_class_name} {project_id}"):
-                    logging.info(
-                        "do_label() for %s in %s",
-                        plugin.__class__.__name__,
-                        project_id,
-                    )
-                    plugin.label_all(project_id)
-                logging.info("OK on do_label %s %s", plugin_class_name, project_id)
+            __do_label_job(data)
             # All errors are actually caught before this point, since most errors are unrecoverable.
             # However, Subscription gets "InternalServerError"" "InactiveRpcError" on occasion
             #  so retry could be relevant. B
 
             return "OK", 200
         except Exception:
-            logging.exception("Error on do_label %s %s", plugin_class_name, project_id)
+            logging.exception(
+                "Error on do_label %s %s", data.get("plugin"), data.get("project_id")
+            )
             return "Error", 500
 
 
+def __do_label_job(data: Dict):
+    """Label according to the data of a do_label message. Raises on failure."""
+    if "export_uri" in data:
+        # Label from a Cloud Asset Inventory export, for all plugins at once
+        export_uri = data["export_uri"]
+        # Local paths only on a local development server, for test_label_from_export.py
+        allow_local = not detect_gae()
+        if not allow_local and not export_uri.startswith("gs://"):
+            # Not retried, since it would fail again
+            logging.error(
+                "Ignoring export_uri %s: Should be gs://bucket/object", export_uri
+            )
+            return
+        with timing(f"do_label from export {export_uri}"):
+            export_utils.label_from_export(
+                export_uri, PluginHolder.plugins_by_asset_type(), allow_local
+            )
+        return
+
+    plugin_class_name = data["plugin"]
+
+    plugin = PluginHolder.get_plugin_instance_by_name(plugin_class_name)
+    if not plugin:
+        logging.info(
+            "(OK if plugin is disabled.) No plugins found for %s. Enabled plugins are %s",
+            plugin_class_name,
+            config_utils.enabled_plugins(),
+        )
+    elif "scope" in data:
+        scope = data["scope"]
+        with lease_utils.lease(f"{plugin_class_name}/{scope}/search") as acquired:
+            if not acquired:
+                logging.info(
+                    "Skipping do_label %s %s, already running", plugin_class_name, scope
+                )
+                return
+            checkpoint = __label_scope(plugin, scope, data.get("checkpoint"))
+        if checkpoint is not None:
+            __send_continuation(data, checkpoint, scope)
+        else:
+            logging.info("OK on do_label %s %s", plugin_class_name, scope)
+    else:
+        project_id = data["project_id"]
+        partition = (
+            partition_utils.Partition(*data["partition"])
+            if "partition" in data
+            else None
+        )
+        shard = f"{partition.index}-of-{partition.count}" if partition else "all"
+        with lease_utils.lease(f"{plugin_class_name}/{project_id}/{shard}") as acquired:
+            if not acquired:
+                logging.info(
+                    "Skipping do_label %s %s, already running",
+                    plugin_class_name,
+                    project_id,
+                )
+                return
+            checkpoint = __label_project(
+                plugin, project_id, partition, data.get("checkpoint")
+            )
+        if checkpoint is not None:
+            __send_continuation(data, checkpoint, project_id)
+
+
+def __send_continuation(data: Dict, checkpoint: Dict, target: str):
+    """Call only after releasing the lease, which the continuation needs"""
+    pubsub_utils.publish(
+        msg=json.dumps({**data, "checkpoint": checkpoint}),
+        topic_id=pubsub_utils.schedulelabeling_topic(),
+    )
+    logging.info(
+        "Time budget spent on do_label %s %s; sent continuation message",
+        data["plugin"],
+        target,
+    )
+
+
+def __label_scope(
+    plugin: Plugin, scope: str, checkpoint: Optional[Dict]
+) -> Optional[Dict]:
+    """:return the checkpoint from which to continue, if the time budget was spent; else None"""
+    sweep = Sweep(
+        checkpoint=checkpoint,
+        time_budget_seconds=config_utils.do_label_time_budget_seconds(),
+    )
+    with timing(f"do_label {plugin.__class__.__name__} {scope}"):
+        try:
+            plugin.label_by_search(scope, sweep)
+        except SweepSuspended:
+            # Continue in another request, rather than exceed the deadline and be redelivered
+            return sweep.checkpoint
+    return None
+
+
+def __label_project(
+    plugin: Plugin,
+    project_id: str,
+    partition: Optional[partition_utils.Partition],
+    checkpoint: Optional[Dict],
+) -> Optional[Dict]:
+    """:return the checkpoint from which to continue, if the time budget was spent; else None"""
+    plugin_class_name = plugin.__class__.__name__
+    sweep = Sweep(
+        partition,
+        checkpoint,
+        config_utils.do_label_time_budget_seconds(),
+    )
+    with timing(f"do_label {plugin_class_name} {project_id}"):
+        logging.info(
+            "do_label() for %s in %s; partition %s; checkpoint %s",
+            plugin_class_name,
+            project_id,
+            partition,
+            utils.shorten(sweep.checkpoint, 200),
+        )
+        try:
+            count = plugin.label_all(project_id, sweep)
+        except SweepSuspended:
+            # Continue in another request, rather than exceed the deadline and be redelivered
+            return sweep.checkpoint
+        except Exception as e:
+            reason = skip_cache.skip_reason(e)
+            if reason is None:
+                raise
+            # Expected for some projects, so no stack trace, and no retry
+            skip_cache.record(project_id, plugin_class_name, reason)
+            logging.info(
+                "Cannot do_label %s %s: %s",
+                plugin_class_name,
+                project_id,
+                utils.shorten(str(e), 300),
+            )
+            return None
+    if partition is None and not sweep.resumed and not sweep.listing_errors:
+        if count == 0:
+            skip_cache.record(project_id, plugin_class_name, skip_cache.NO_RESOURCES)
+        else:
+            skip_cache.clear(project_id, plugin_class_name)
+    logging.info("OK on do_label %s %s", plugin_class_name, project_id)
+    return None
+
+
 def __check_pubsub_verification_token():
     """Token verifying that only PubSub accesses PubSub push endpoints"""
     expected_token = pubsub_token()
@@ -379,6 +625,10 @@ def handle_invalid_usage(error):
     return response
 
 
+if work_journal.is_enabled():
+    # Replays jobs left unfinished by a crash
+    work_journal.start(__do_label_job)
+
 logging.info(f"Coldstart took {int((time.time() - cold_start_begin) * 1000)} ms")
 
 if __name__ in ["__main__"]:
@@ -1,38 +1,93 @@
 import logging
 import pkgutil
-import re
 import threading
+import time
 from abc import ABCMeta, abstractmethod
 from functools import lru_cache
-from typing import Dict, Tuple, Type, Optional
+from itertools import islice
+from typing import Callable, Dict, Iterator, List, Tuple, Type, Optional
 
 from googleapiclient import discovery
-from googleapiclient import errors
 
-from util import gcp_utils, config_utils
-from util.config_utils import (
-    is_copying_labels_from_project,
-    iris_prefix,
-    specific_prefix,
-)
+from util import gcp_utils, config_utils, asset_search, project_labels, rate_limiter
+from util.config_utils import is_copying_labels_from_project
+from util.batch_pipeline import BatchPipeline
+from util.label_specs import MISSING, Extractor
+from util.rate_limiter import AimdRateLimiter
+from util.partition_utils import Partition
 from util.utils import (
-    methods,
     cls_by_name,
+    legalize_value,
     log_time,
-    timed_lru_cache,
 )
 
 PLUGINS_MODULE = "plugins"
 
+# Methods named with this prefix are dynamically called in generating labels, as an alternative to _label_specs
+_LABEL_METHOD_PREFIX = "_gcp_"
+# Resources are labeled this many at a time, as they are listed; the usual page size of the list APIs
+_LABEL_PAGE_SIZE = 500
+
+
+class Sweep:
+    """
+    The state of one label_all run in a project: Optionally, the partition to label (see rolling_partitions
+    in the config), a time budget, and a checkpoint of the progress so far.
+    When the time budget is spent, the plugin records its progress in the checkpoint
+    (a JSON-serializable dict, whose keys are up to the plugin) and raises SweepSuspended,
+    so that the run can be continued from the checkpoint in another request.
+    stop is set to end the run early, as on an error that holds for all of it; work on other threads
+    checks it between units of work, like zones and pages, so that none goes on after label_all returns.
+    """
+
+    def __init__(
+        self,
+        partition: Optional[Partition] = None,
+        checkpoint: Optional[Dict] = None,
+        time_budget_seconds: int = 0,
+    ):
+        self.partition = partition
+        self.resumed = bool(checkpoint)
+        self.checkpoint = checkpoint or {}
+        # Parts of the listing that failed but were skipped over, like some zones; the count is then partial
+        self.listing_errors = 0
+        self.stop = threading.Event()
+        self.__deadline = (
+            time.time() + time_budget_seconds if time_budget_seconds else None
+        )
+
+    @property
+    def deadline(self) -> Optional[float]:
+        """The end of the time budget, or None"""
+        return self.__deadline
+
+    def out_of_time(self) -> bool:
+        return self.__deadline is not None and time.time() >= self.__deadline
+
+
+class SweepSuspended(Exception):
+    pass
+
 
 # TODO Since subclasses are already singletons, and we are already using
 # a lot of classmethods and staticmethods, , could convert this to
 # never use instance methods
 class Plugin(metaclass=ABCMeta):
     # Underlying API  max is 1000; avoid off-by-one errors
-    # We send a batch when _BATCH_SIZE or more tasks are in it, or at the end of a label_all
+    # We send a batch when it is full, or at the end of a label_all. This is the maximum size;
+    # the BatchPipeline adapts the size downwards to latency and errors
     _BATCH_SIZE = 990
 
+    # Whether each thread fills its own batch; see BatchPipeline
+    _PER_THREAD_BATCHES = False
+
+    # Label name to extractor (see util.label_specs); extended and overridden in subclasses
+    _label_specs: Dict[str, Extractor] = {}
+
+    # Per class, the config version and, for that version, the label key and extractor for each label;
+    # see init_label_table
+    __label_tables: Dict[type, Tuple[int, Tuple[Tuple[str, Callable], ...]]] = {}
+
     @staticmethod
     @abstractmethod
     def _discovery_api() -> Optional[Tuple[str, str]]:
@@ -44,6 +99,12 @@ class Plugin(metaclass=ABCMeta):
         """The name of the methods inside the Google REST API that indicate the creation of such resources."""
         pass
 
+    @staticmethod
+    def asset_types() -> List[str]:
+        """The Cloud Asset Inventory types of the resources labeled by this plugin,
+        used for enumerating them with resource_search. Empty if not supported."""
+        return []
+
     @staticmethod
     def relabel_on_cron() -> bool:
         """
@@ -60,6 +121,8 @@ class Plugin(metaclass=ABCMeta):
         """
         return True
 
+    # The client is shared by all threads, so requests built from it are executed on transports from util.http_pool,
+    # rather than on the client's own, which is not thread-safe
     @classmethod
     @lru_cache(maxsize=1)
     def _google_api_client(cls):
@@ -83,41 +146,50 @@ class Plugin(metaclass=ABCMeta):
         )
 
     def __init__(self):
-        self.__init_batch_req()
+        self._pipeline = BatchPipeline(
+            type(self).__name__,
+            self.__new_batch,
+            self.__batch_callback,
+            self._BATCH_SIZE,
+            on_stale=self.__rebuild_stale_request,
+            per_thread=self._PER_THREAD_BATCHES,
+            rate_limiter=self.__rate_limiter_for,
+        )
 
-    @timed_lru_cache(seconds=600, maxsize=512)
     def _project_labels(self, project_id) -> Dict:
-        try:
-            proj = gcp_utils.get_project(project_id)
-            return proj.get("labels", {})
-        except errors.HttpError:
-            logging.exception("Failing to get labels for project {project_id}")
-            return {}
-
-    def __iris_labels(self, gcp_object) -> Dict[str, str]:
-        func_name_pfx = "_gcp_"
-
-        def legalize_value(s):
-            """
-            Only hyphens (-), underscores (_=None), lowercase characters,
-            and numbers are allowed in label values. International characters are allowed.
-            """
-            label_chars = re.compile(r"[\w\d_-]")  # cached
-            return "".join(c if label_chars.match(c) else "_" for c in s).lower()[:62]
-
-        def value(func, gcp_obj):
-            return legalize_value(func(gcp_obj))
-
-        def key(func) -> str:
-            general_pfx = iris_prefix()
-            assert general_pfx is not None
-            specific_pfx = specific_prefix(type(self).__name__)
-            pfx = specific_pfx if specific_pfx is not None else general_pfx
-            pfx_full = pfx + "_" if pfx else ""
-            return pfx_full + func.__name__[len(func_name_pfx) :]
-
-        # noinspection PyTypeChecker
-        return {key(f): value(f, gcp_object) for f in methods(self, func_name_pfx)}
+        return project_labels.get(project_id)
+
+    @classmethod
+    def init_label_table(cls) -> Tuple[Tuple[str, Callable], ...]:
+        """
+        Compute, once per class, the label key and the extractor for each label that Iris adds:
+        From the _label_specs of the class and its bases, and from any methods named _gcp_<label_name>.
+        Extractors here take the plugin and the resource.
+        Called from PluginHolder.init; else on first use, and after the config is reloaded.
+        """
+        version = config_utils.config_version()
+        pfx_full = config_utils.label_prefix(cls.__name__)
+
+        extractors = {}
+        for klass in reversed(cls.__mro__):  # Subclasses override their bases
+            for label_name, extract in vars(klass).get("_label_specs", {}).items():
+                extractors[label_name] = lambda _, o, e=extract: e(o)
+        for name in dir(cls):
+            if name.startswith(_LABEL_METHOD_PREFIX) and callable(getattr(cls, name)):
+                extractors[name[len(_LABEL_METHOD_PREFIX) :]] = getattr(cls, name)
+        table = tuple(
+            (pfx_full + label_name, extract)
+            for label_name, extract in sorted(extractors.items())
+        )
+        Plugin.__label_tables[cls] = (version, table)
+        return table
+
+    @classmethod
+    def _label_table(cls) -> Tuple[Tuple[str, Callable], ...]:
+        entry = Plugin.__label_tables.get(cls)
+        if entry is None or entry[0] != config_utils.config_version():
+            return cls.init_label_table()
+        return entry[1]
 
     # noinspection PyUnusedLocal
     def __batch_callback(self, request, response, exception):
@@ -127,33 +199,271 @@ class Plugin(metaclass=ABCMeta):
                 exc_info=exception,
             )
 
+    @property
+    def counter(self) -> int:
+        """The number of requests in the batch now filling"""
+        return self._pipeline.pending
+
+    def _add_to_batch(self, request, gcp_object=None, project_id=None):
+        """Add a request to the batch; a full batch is sent in the background while the next one fills.
+        With gcp_object and project_id, the request is rate-limited, if the plugin implements _label_operation;
+        and a request that fails on a stale labelFingerprint is retried,
+        if the plugin implements _refresh_resource and _label_request."""
+        context = (gcp_object, project_id) if gcp_object is not None else None
+        self._pipeline.add(request, context)
+
+    def _refresh_resource(self, gcp_object, project_id) -> Optional[Dict]:
+        """Re-read the resource, with its current labels and labelFingerprint, for a retry.
+        :return None if not supported"""
+        return None
+
+    def _label_request(self, gcp_object, project_id, labels):
+        """:return the (batchable) request that writes the labels to the resource"""
+        raise NotImplementedError()
+
+    def _label_operation(self, gcp_object) -> Optional[str]:
+        """The API method that writes the labels, like instances.setLabels, for rate limiting. None for no limit"""
+        return None
+
+    def __rate_limiter_for(self, context) -> Optional[AimdRateLimiter]:
+        gcp_object, project_id = context
+        operation = self._label_operation(gcp_object)
+        if operation is None:
+            return None
+        return rate_limiter.get_limiter(self._discovery_api()[0], operation, project_id)
+
+    def __rebuild_stale_request(self, context):
+        gcp_object, project_id = context
+        fresh = self._refresh_resource(gcp_object, project_id)
+        if fresh is None:
+            return None
+        labels = self._build_labels(fresh, project_id)
+        if labels is None:
+            return None  # Meanwhile, the labels were set
+        return self._label_request(fresh, project_id, labels)
+
     def do_batch(self):
         """In main#do_label, we loop over all objects. But for efficienccy, we do not process
-        then all at once, but rather gather objects and process them in batches of
-        self._BATCH_SIZE as we loop; then parse the remaining at the end of the loop"""
+        then all at once, but rather gather objects and process them in batches as we loop,
+        sending each full batch in the background; then send the remaining at the end of the loop,
+        and wait for all batches in flight.
+        In a sweep, the wait ends at its deadline: The requests not sent by then, as they wait for
+        a rate-limit slot, go to the sweep's checkpoint for the continuation; then SweepSuspended is raised.
+        """
+        sweep = self._pipeline.owner
+        unsent = self._pipeline.flush(
+            sweep.deadline if sweep is not None else None, sweep
+        )
+        if unsent:
+            sweep.checkpoint.setdefault("unsent", []).extend(
+                [project_id, gcp_object] for gcp_object, project_id in unsent
+            )
+            raise SweepSuspended()
+
+    def __label_unsent(self, sweep: Sweep):
+        """Label the resources whose requests a previous part of the sweep did not send in time"""
+        for project_id, gcp_object in sweep.checkpoint.pop("unsent", []):
+            labels = self._build_labels(gcp_object, project_id)
+            if labels is not None:
+                self._label_listed(gcp_object, project_id, labels)
+
+    def label_all(self, project_id, sweep: Optional[Sweep] = None) -> int:
+        """Label all objects of a type in a given project.
+        :return the number of objects found
+        :raise SweepSuspended if the sweep's time budget was spent; the sweep's checkpoint then tells where to continue
+        """
+        if sweep is None:
+            sweep = Sweep()
         try:
-            if self._batch is not None:
-                self._batch.execute()
-        except Exception:
-            logging.exception("Exception executing _batch()")
-
-        self.__init_batch_req()
+            with self._pipeline.owned_by(sweep):
+                self.__label_unsent(sweep)
+                count = self._label_all(project_id, sweep)
+                self.do_batch()
+            return count
+        finally:
+            # Also on errors, do not leave batches in flight beyond this label_all
+            self._pipeline.wait()
 
     @abstractmethod
-    def label_all(self, project_id):
-        """Label all objects of a type in a given project"""
+    def _label_all(self, project_id, sweep: Sweep) -> int:
+        """Implement label_all. Label only those objects in sweep.partition, if any.
+        Where sweep.out_of_time(), record the progress in sweep.checkpoint and call _suspend().
+        """
         pass
 
+    def _suspend(self):
+        """Write what was batched so far, and stop this label_all, to be continued from the sweep's checkpoint"""
+        self.do_batch()  # Also for requests that wait for a rate-limit slot, which counter does not include
+        raise SweepSuspended()
+
+    def _label_pages(self, project_id, sweep: Sweep) -> int:
+        """For plugins that implement _list_pages: Label page by page, with the page token as checkpoint.
+        :return the number of objects found"""
+        count = 0
+        page_token = sweep.checkpoint.get("page_token")
+        for resources, next_page_token in self._list_pages(project_id, page_token):
+            if sweep.out_of_time():
+                sweep.checkpoint["page_token"] = page_token
+                self._suspend()
+            count += self._label_resources(
+                resources, project_id, sweep.partition, sweep.stop
+            )
+            page_token = next_page_token
+        return count
+
+    def _list_pages(
+        self, project_id, page_token: Optional[str]
+    ) -> Iterator[Tuple[List[Dict], Optional[str]]]:
+        """Implement this to use _label_pages.
+        :return for each page, starting from page_token, the objects and the next page token
+        """
+        raise NotImplementedError()
+
+    def _label_resources(
+        self,
+        resources,
+        project_id,
+        partition: Optional[Partition] = None,
+        stop: Optional[threading.Event] = None,
+    ) -> int:
+        """Label the resources a page at a time, as they are listed (resources may be a lazy iterator).
+        :param stop: When set, stop before the next page
+        :return the number of resources, including those not in the partition"""
+        count = 0
+        resources = iter(resources)
+        while True:
+            if stop is not None and stop.is_set():
+                return count
+            page = list(islice(resources, _LABEL_PAGE_SIZE))
+            if not page:
+                return count
+            count += len(page)
+            if partition is not None:
+                page = [r for r in page if partition.contains(self._partition_key(r))]
+            for resource, labels in zip(
+                page, self._build_labels_for_page(page, project_id)
+            ):
+                if labels is not None:
+                    self._label_listed(resource, project_id, labels)
+
+    def _label_listed(self, gcp_object: Dict, project_id: str, labels: Dict):
+        """Label a resource found in listing. Override, e.g., to send the update in the background"""
+        try:
+            self._apply_labels(gcp_object, project_id, labels)
+        except Exception:
+            logging.exception("")
+
+    def label_by_search(self, scope: str, sweep: Optional[Sweep] = None) -> int:
+        """Label the resources in the organization or folder that need it, as found by
+        one Cloud Asset Inventory search, rather than listing each project.
+        Where sweep.out_of_time(), record the page token in sweep.checkpoint and raise SweepSuspended,
+        as in label_all.
+        :return the number of resources found"""
+        if sweep is None:
+            sweep = Sweep()
+        count = 0
+        labeled = 0
+        page_token = sweep.checkpoint.get("page_token")
+        try:
+            with self._pipeline.owned_by(sweep):
+                self.__label_unsent(sweep)
+                search = asset_search.get_asset_search()
+                for assets, next_page_token in search.search_pages(
+                    scope, self.asset_types(), page_token
+                ):
+                    if sweep.out_of_time():
+                        sweep.checkpoint["page_token"] = page_token
+                        self._suspend()
+                    for asset in assets:
+                        count += 1
+                        if self.label_asset(asset):
+                            labeled += 1
+                    page_token = next_page_token
+                self.do_batch()
+        finally:
+            # Also on errors and suspension, do not leave batches in flight beyond this request
+            self._pipeline.wait()
+        logging.info(
+            "label_by_search %s in %s: %d found, %d needed labeling",
+            type(self).__name__,
+            scope,
+            count,
+            labeled,
+        )
+        return count
+
+    def label_asset(self, asset: Dict) -> bool:
+        """
+        Label a resource described by a Cloud Asset search result or export record (in search-result form),
+        if it is in an enabled project and its labels need to change.
+        :return True if labels were applied
+        """
+        project_id = asset_search.project_id_of(asset)
+        if (
+            not project_id
+            or gcp_utils.is_appscript_project(project_id)
+            or not config_utils.is_project_enabled(project_id)
+        ):
+            return False
+        try:
+            gcp_object = self.__object_for_asset(asset, project_id)
+            labels = self._build_labels(gcp_object, project_id)
+        except Exception:
+            logging.exception("Cannot build labels for %s", asset.get("name"))
+            return False
+        if labels is None:
+            return False
+        try:
+            self._apply_labels(gcp_object, project_id, labels)
+        except Exception:
+            logging.exception("")
+        return True
+
+    def __object_for_asset(self, asset: Dict, project_id: str) -> Dict:
+        gcp_object = self._object_from_asset(asset)
+        if not any("resource" in v for v in asset.get("versionedResources", [])):
+            # Not the full resource, e.g., without the labelFingerprint that setLabels needs,
+            # so read it, where the plugin supports that
+            fresh = self._refresh_resource(gcp_object, project_id)
+            if fresh is not None:
+                return fresh
+        return gcp_object
+
+    def _object_from_asset(self, asset: Dict) -> Dict:
+        """Shape a Cloud Asset search result like the objects that label_resource takes.
+        Where supported, versionedResources holds the full resource, as returned by its own API.
+        Otherwise, only the name, location and labels are known; label_asset then reads the resource
+        with _refresh_resource, if the plugin implements it."""
+        for versioned in asset.get("versionedResources", []):
+            if "resource" in versioned:
+                return versioned["resource"]
+        return {
+            "name": asset["name"].split("/")[-1],
+            "location": asset.get("location"),
+            "labels": asset.get("labels", {}),
+        }
+
+    @staticmethod
+    def _partition_key(gcp_object) -> str:
+        """A stable identifier of the resource, used for choosing its partition in rolling sweeps"""
+        return str(gcp_object.get("id") or gcp_object.get("name"))
+
     @abstractmethod
     def get_gcp_object(self, log_data: Dict) -> Optional[Dict]:
         """Parse logging data to get a GCP object"""
         pass
 
-    @abstractmethod
     def label_resource(self, gcp_object: Dict, project_id: str):
         """Label a single new object based on its description that comes from alog-line.
         Not clear why we cannot get the project_id out of the gcp_object since the PubSub/Logging
         messages seem to have this. Maybe one type of resource does not include project_id"""
+        labels = self._build_labels(gcp_object, project_id)
+        if labels is not None:
+            self._apply_labels(gcp_object, project_id, labels)
+
+    @abstractmethod
+    def _apply_labels(self, gcp_object: Dict, project_id: str, labels: Dict):
+        """Write the labels, as returned by _build_labels, to the resource (or add that to the batch)"""
         pass
 
     def _build_labels(self, gcp_object, project_id):
@@ -161,29 +471,60 @@ class Plugin(metaclass=ABCMeta):
         :return dict including original labels, project labels (if the system is configured to add those)
         and new labels. But if that would result in no change, return None
         """
-        original_labels = gcp_object.get("labels", {})
+        return self._build_labels_for_page([gcp_object], project_id)[0]
+
+    def _build_labels_for_page(
+        self, gcp_objects: List[Dict], project_id
+    ) -> List[Optional[Dict]]:
+        """
+        As _build_labels, for a page of objects in one project, computed column by column:
+        Each extractor runs over the whole page, and each distinct value is legalized once.
+        :return for each object, in order, the labels, or None if there is no change
+        """
         project_labels = (
             self._project_labels(project_id) if is_copying_labels_from_project() else {}
         )
-        iris_labels = self.__iris_labels(gcp_object)
-        all_labels = {**original_labels, **project_labels, **iris_labels}
-        if all_labels == original_labels:
-            # Skip labeling  because no change
-            return None
-        else:
-            labels = {"labels": all_labels}
-            fingerprint = gcp_object.get("labelFingerprint", "")
-            if fingerprint:
-                labels["labelFingerprint"] = fingerprint
-
-            return labels
+        columns = []
+        for key, extract in self._label_table():
+            legalized = {}
+            column = []
+            for o in gcp_objects:
+                try:
+                    value = extract(self, o)
+                except Exception:
+                    # A malformed resource should not stop the labeling of the rest of the page
+                    logging.exception("Cannot extract %s from %s", key, o.get("name"))
+                    value = None
+                if value is MISSING or value is None:
+                    column.append(None)
+                    continue
+                legal = legalized.get(value)
+                if legal is None:
+                    legal = legalized[value] = legalize_value(value)
+                column.append(legal)
+            columns.append((key, column))
+
+        ret = []
+        for i, gcp_object in enumerate(gcp_objects):
+            original_labels = gcp_object.get("labels") or {}
+            all_labels = {**original_labels, **project_labels}
+            for key, column in columns:
+                if column[i] is not None:
+                    all_labels[key] = column[i]
+            if all_labels == original_labels:
+                # Skip labeling  because no change
+                ret.append(None)
+            else:
+                labels = {"labels": all_labels}
+                fingerprint = gcp_object.get("labelFingerprint", "")
+                if fingerprint:
+                    labels["labelFingerprint"] = fingerprint
+                ret.append(labels)
+        return ret
 
     def _name_after_slash(self, gcp_object):
         return self.__name(gcp_object, separator="/")
 
-    def _name_no_separator(self, gcp_object):
-        return self.__name(gcp_object, separator=None)
-
     def __name(self, gcp_object, separator: Optional[str] = None):
         try:
             name = gcp_object["name"]
@@ -195,15 +536,8 @@ class Plugin(metaclass=ABCMeta):
             logging.exception("")
             return None
 
-    def __init_batch_req(self):
-        self.counter = 0
-        google_api_client = self._google_api_client()
-        if google_api_client is None:
-            self._batch = None
-        else:
-            self._batch = google_api_client.new_batch_http_request(
-                callback=self.__batch_callback
-            )
+    def __new_batch(self, callback):
+        return self._google_api_client().new_batch_http_request(callback=callback)
 
 
 class PluginHolder:
@@ -235,6 +569,7 @@ class PluginHolder:
                 cls.plugins[
                     plugin_class
                 ] = None  # Initialize with NO instance to avoid importing
+                plugin_class.init_label_table()
                 loaded.append(plugin_class.__name__)
 
 
@@ -260,3 +595,12 @@ class PluginHolder:
     def get_plugin_instance_by_name(cls, plugin_class_name: str):
         plugin_cls = cls.plugin_cls_by_name(plugin_class_name)
         return cls.get_plugin_instance(plugin_cls)
+
+    @classmethod
+    def plugins_by_asset_type(cls) -> Dict[str, Plugin]:
+        """Map from Cloud Asset type to the instance of the enabled plugin that labels it"""
+        return {
+            asset_type: cls.get_plugin_instance(plugin_cls)
+            for plugin_cls in cls.plugins
+            for asset_type in plugin_cls.asset_types()
+        }
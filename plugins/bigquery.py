@@ -6,15 +6,22 @@ import logging
 from functools import lru_cache
 
 from googleapiclient import errors
-from ratelimit import limits, sleep_and_retry
 
-from plugin import Plugin
-from util import gcp_utils
+from plugin import Plugin, Sweep
 from util.gcp_utils import add_loaded_lib
+from util.label_specs import after_last, field, first_of, lower
 from util.utils import log_time, timing, dict_to_camelcase
 
 
 class Bigquery(Plugin):
+    _label_specs = {
+        "name": first_of(
+            field("tableReference", "tableId", transform=after_last(":")),
+            field("datasetReference", "datasetId", transform=after_last(":")),
+        ),
+        "location": field("location", transform=lower),
+    }
+
     @staticmethod
     def _discovery_api():
         return "bigquery", "v2"
@@ -37,27 +44,26 @@ class Bigquery(Plugin):
     def method_names():
         return ["datasetservice.insert", "tableservice.insert"]
 
-    def _gcp_name(self, gcp_object):
-        """Method dynamically called in generating labels, so don't change name"""
-        try:
-            if gcp_object["kind"] == "bigquery#dataset":
-                name = gcp_object["datasetReference"]["datasetId"]
+    @staticmethod
+    def asset_types():
+        return ["bigquery.googleapis.com/Dataset", "bigquery.googleapis.com/Table"]
+
+    def _object_from_asset(self, asset):
+        gcp_object = super()._object_from_asset(asset)
+        if "kind" not in gcp_object:
+            # //bigquery.googleapis.com/projects/p/datasets/d or .../datasets/d/tables/t
+            parts = asset["name"].split("/")
+            is_table = asset["assetType"] == "bigquery.googleapis.com/Table"
+            if len(parts) < (9 if is_table else 7):
+                raise ValueError(f"Unexpected BigQuery asset name {asset['name']}")
+            reference = {"projectId": parts[4], "datasetId": parts[6]}
+            if is_table:
+                gcp_object["kind"] = "bigquery#table"
+                gcp_object["tableReference"] = {**reference, "tableId": parts[8]}
             else:
-                name = gcp_object["tableReference"]["tableId"]
-            index = name.rfind(":")
-            name = name[index + 1 :]
-            return name
-        except KeyError:
-            logging.exception("")
-            return None
-
-    def _gcp_location(self, gcp_object):
-        """Method dynamically called in generating labels, so don't change name"""
-        try:
-            return gcp_object["location"].lower()
-        except KeyError:
-            logging.exception("")
-            return None
+                gcp_object["kind"] = "bigquery#dataset"
+                gcp_object["datasetReference"] = reference
+        return gcp_object
 
     def __get_dataset(self, project_id, dataset_name):
         try:
@@ -119,56 +125,86 @@ class Bigquery(Plugin):
             logging.exception("")
             return None
 
-    def label_all(self, project_id):
+    def _label_all(self, project_id, sweep: Sweep):
         """
-        Label both tables and data sets
+        Label both tables and data sets.
+        With a partition, whole datasets (including their tables) are in or out of it,
+        so that listing tables is skipped for datasets outside the partition.
+        The checkpoint is the token of the current page of datasets, and the datasets done in that page.
         """
         with timing(f"label_all for BigQuery in {project_id}"):
-            datasets = self._cloudclient(project_id).list_datasets()
-            for dataset in datasets:
-                self.__label_dataset_and_tables(project_id, dataset._properties)
+            count = 0
+            checkpoint = sweep.checkpoint
+            datasets = self._cloudclient(project_id).list_datasets(
+                page_token=checkpoint.get("page_token")
+            )
+            for page in datasets.pages:
+                done_in_page = checkpoint.setdefault("datasets_done", [])
+                for dataset in page:
+                    ds_props = dataset._properties
+                    if ds_props["id"] in done_in_page:
+                        continue
+                    if sweep.out_of_time():
+                        self._suspend()
+                    count += 1
+                    if sweep.partition is None or sweep.partition.contains(
+                        self._partition_key(ds_props)
+                    ):
+                        count += self.__label_dataset_and_tables(project_id, ds_props)
+                    done_in_page.append(ds_props["id"])
+                checkpoint["page_token"] = datasets.next_page_token
+                checkpoint["datasets_done"] = []
 
             if self.counter > 0:
-                self.do_batch()  # Used for Tables, not Datasets
+                self.do_batch()
+            return count
 
-    def __label_dataset_and_tables(self, project_id, dataset):
-        self.__label_one_dataset(dataset, project_id)
-        self.__label_tables_for_dataset(dataset, project_id)
+    def __label_dataset_and_tables(self, project_id, dataset) -> int:
+        """:return the number of tables"""
+        self.label_resource(dataset, project_id)
+        return self.__label_tables_for_dataset(dataset, project_id)
 
-    def __label_tables_for_dataset(self, dataset, project_id):
+    def __label_tables_for_dataset(self, dataset, project_id) -> int:
         ds_id = dataset["id"].replace(":", ".")
-        for table in self._cloudclient(project_id).list_tables(dataset=ds_id):
-            table_dict = table._properties
-            table_dict["location"] = dataset["location"]
-            self.__label_one_table(table_dict, project_id)
-
-    @sleep_and_retry
-    @limits(calls=35, period=60)
-    def __label_one_dataset(self, gcp_object, project_id):
-        labels = self._build_labels(gcp_object, project_id)
-        if labels is None:
-            return
+        count = 0
+        for page in self._cloudclient(project_id).list_tables(dataset=ds_id).pages:
+            tables = [table._properties for table in page]
+            for table_dict in tables:
+                table_dict["location"] = dataset["location"]
+            count += self._label_resources(tables, project_id)
+        return count
+
+    def _label_operation(self, gcp_object):
+        if gcp_object["kind"] == "bigquery#dataset":
+            return "datasets.patch"
+        return "tables.patch"
+
+    def __label_one_dataset(self, gcp_object, project_id, labels):
         try:
             dataset_reference = gcp_object["datasetReference"]
-            dataset_id = dataset_reference["datasetId"]
 
             assert (
                 project_id == dataset_reference["projectId"]
             ), f"{project_id}!={dataset_reference['projectId']}"
 
-            client = self._cloudclient(project_id)
-            ds = client.get_dataset(f"{project_id}.{dataset_id}")
-            ds.labels = labels["labels"]
-            client.update_dataset(ds, ["labels"])
+            self._add_to_batch(
+                self._google_api_client()
+                .datasets()
+                .patch(
+                    projectId=project_id,
+                    datasetId=dataset_reference["datasetId"],
+                    body=labels,
+                ),
+                gcp_object,
+                project_id,
+            )
         except Exception:
             logging.exception("")
 
-    @sleep_and_retry
-    @limits(calls=35, period=60)
-    def __label_one_table(self, gcp_object, project_id):
+    def __label_one_table(self, gcp_object, project_id, labels):
         """
-        This often produces the following error. Hard to avoid, given that we are using batch operations. But
-        that is why we sleep_and_retry, above.
+        This often produced the following error, when the rate was fixed. Now, the rate adapts
+        (see util.rate_limiter) and rate-limited requests are retried (see util.batch_pipeline).
 
         Error in Request Id: None Response: 72edf87e-d6fe-46b5-831a-e7b7bcd51cb0
         Exception: <HttpError 403 when requesting
@@ -176,12 +212,9 @@ class Bigquery(Plugin):
         returned "Exceeded rate limits: too many table update operations for this table.
         For more information, see https://cloud.google.com/bigquery/troubleshooting-errors".
         """
-        labels = self._build_labels(gcp_object, project_id)
-        if labels is None:
-            return
         try:
             table_reference = gcp_object["tableReference"]
-            self._batch.add(
+            self._add_to_batch(
                 self._google_api_client()
                 .tables()
                 .patch(
@@ -190,20 +223,18 @@ class Bigquery(Plugin):
                     datasetId=table_reference["datasetId"],
                     tableId=table_reference["tableId"],
                 ),
-                request_id=gcp_utils.generate_uuid(),
+                gcp_object,
+                project_id,
             )
-            self.counter += 1
-            if self.counter >= self._BATCH_SIZE:
-                self.do_batch()
         except Exception:
             logging.exception("")
 
     @log_time
-    def label_resource(self, gcp_object, project_id):
+    def _apply_labels(self, gcp_object, project_id, labels):
         try:
             if gcp_object["kind"] == "bigquery#dataset":
-                self.__label_one_dataset(gcp_object, project_id)
+                self.__label_one_dataset(gcp_object, project_id, labels)
             else:
-                self.__label_one_table(gcp_object, project_id)
+                self.__label_one_table(gcp_object, project_id, labels)
         except Exception:
             logging.exception("")
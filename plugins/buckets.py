@@ -1,13 +1,17 @@
 import logging
 from functools import lru_cache
-
-from plugin import Plugin
-from util import gcp_utils
+from plugin import Plugin, Sweep
 from util.gcp_utils import add_loaded_lib
+from util.label_specs import field
 from util.utils import log_time, timing, dict_to_camelcase
 
 
 class Buckets(Plugin):
+    _label_specs = {
+        "name": field("name"),
+        "location": field("location", transform=lambda s: s.replace(".", "_").lower()),
+    }
+
     @staticmethod
     def _discovery_api():
         return "storage", "v1"
@@ -16,6 +20,10 @@ class Buckets(Plugin):
     def method_names():
         return ["storage.buckets.create"]
 
+    @staticmethod
+    def asset_types():
+        return ["storage.googleapis.com/Bucket"]
+
     @classmethod
     @lru_cache(maxsize=500)  # cached per project
     def _cloudclient(cls, project_id=None):
@@ -29,20 +37,6 @@ class Buckets(Plugin):
         add_loaded_lib("storage")
         return storage.Client(project=project_id)
 
-    def _gcp_name(self, gcp_object):
-        """Method dynamically called in generating labels, so don't change name"""
-        return self._name_no_separator(gcp_object)
-
-    def _gcp_location(self, gcp_object):
-        """Method dynamically called in generating labels, so don't change name"""
-        try:
-            location = gcp_object["location"]
-            location = location.replace(".", "_").lower()
-            return location
-        except KeyError:
-            logging.exception("")
-            return None
-
     def _get_resource(self, bucket_name, project_id):
         try:
             bucket_response = self._cloudclient(project_id).get_bucket(
@@ -73,39 +67,34 @@ class Buckets(Plugin):
         d3 = dict_to_camelcase(d2)
         return d3
 
-    def _list_all(self, project_id):
-        buckets = self._cloudclient(project_id).list_buckets()
-        return (
-            self.__response_obj_to_dict(bucket_response) for bucket_response in buckets
-        )
+    def _list_pages(self, project_id, page_token):
+        buckets = self._cloudclient(project_id).list_buckets(page_token=page_token)
+        for page in buckets.pages:
+            yield [
+                self.__response_obj_to_dict(bucket_response) for bucket_response in page
+            ], buckets.next_page_token
 
-    def label_all(self, project_id):
+    def _label_all(self, project_id, sweep: Sweep):
         with timing(f"label_all(Bucket) in {project_id}"):
-            for o in self._list_all(project_id):
-                try:
-                    self.label_resource(o, project_id)
-                except Exception:
-                    logging.exception("")
+            count = self._label_pages(project_id, sweep)
             if self.counter > 0:
                 self.do_batch()
+            return count
 
-    @log_time
-    def label_resource(self, gcp_object, project_id):
-        labels = self._build_labels(gcp_object, project_id)
-        if labels is None:
-            return
+    def _label_operation(self, gcp_object):
+        return "buckets.patch"
 
+    @log_time
+    def _apply_labels(self, gcp_object, project_id, labels):
         try:
             bucket_name = gcp_object["name"]
 
-            self._batch.add(
+            self._add_to_batch(
                 self._google_api_client()
                 .buckets()
                 .patch(bucket=bucket_name, body=labels),
-                request_id=gcp_utils.generate_uuid(),
+                gcp_object,
+                project_id,
             )
-            self.counter += 1
-            if self.counter >= self._BATCH_SIZE:
-                self.do_batch()
         except Exception:
             logging.exception("")
@@ -3,11 +3,36 @@ from typing import Dict, Optional
 
 from googleapiclient import errors
 
-from plugin import Plugin
+from plugin import Plugin, Sweep
+from util import config_utils, http_pool
+from util.concurrent_updates import ConcurrentUpdates
+from util.label_specs import field, lower
+from util.operation_tracker import OperationTracker
 from util.utils import log_time, timing
 
 
 class Cloudsql(Plugin):
+    _label_specs = {
+        "name": field("name"),
+        "region": field("region", transform=lower),
+    }
+
+    # Only instances in this state accept patches; others, like PENDING_CREATE or MAINTENANCE,
+    # are left for a later label_all
+    _LABELABLE_STATE = "RUNNABLE"
+
+    def __init__(self):
+        super().__init__()
+        # In label_all, patches are sent concurrently while listing goes on, and their operations are tracked
+        # in the background, rather than waiting for each instance in turn
+        self.__patches = ConcurrentUpdates(
+            type(self).__name__,
+            self.__patch_and_track,
+            config_utils.cloudsql_patch_concurrency,
+            success="submitted",
+        )
+        self.__operations = OperationTracker(type(self).__name__, self.__get_operation)
+
     @staticmethod
     def _discovery_api():
         return "sqladmin", "v1beta4"
@@ -16,6 +41,15 @@ class Cloudsql(Plugin):
     def method_names():
         return ["cloudsql.instances.create"]
 
+    @staticmethod
+    def asset_types():
+        return ["sqladmin.googleapis.com/Instance"]
+
+    def _object_from_asset(self, asset):
+        gcp_object = super()._object_from_asset(asset)
+        gcp_object.setdefault("region", asset.get("location"))
+        return gcp_object
+
     @classmethod
     def _cloudclient(cls, _=None):
         logging.info("_cloudclient for %s", cls.__name__)
@@ -36,25 +70,12 @@ class Cloudsql(Plugin):
         """
         return False
 
-    def _gcp_name(self, gcp_object):
-        """Method dynamically called in generating labels, so don't change name"""
-        return self._name_no_separator(gcp_object)
-
-    def _gcp_region(self, gcp_object):
-        """Method dynamically called in generating labels, so don't change name"""
-        try:
-            return gcp_object["region"].lower()
-        except KeyError:
-            logging.exception("")
-            return None
-
     def _get_resource(self, project_id, name):
         try:
-            result = (
+            result = http_pool.execute(
                 self._google_api_client()
                 .instances()
                 .get(project=project_id, instance=name)
-                .execute()
             )
             return result
         except errors.HttpError:
@@ -74,48 +95,53 @@ class Cloudsql(Plugin):
             logging.exception("")
             return None
 
-    def label_all(self, project_id):
-        with timing(f"label_all({type(self).__name__}) in {project_id}"):
-            page_token = None
-            while True:
-                response = (
-                    self._google_api_client()
-                    .instances()
-                    .list(
-                        project=project_id,
-                        pageToken=page_token,
-                        # Filter supported, but syntax not OK. We get this message: "Field not found. In
-                        # expression labels.iris_name HAS *, At field labels ."
-                    )
-                    .execute()
+    def _list_pages(self, project_id, page_token):
+        while True:
+            response = http_pool.execute(
+                self._google_api_client()
+                .instances()
+                .list(
+                    project=project_id,
+                    pageToken=page_token,
+                    # A filter on labels is supported, but syntax not OK. We get this message: "Field not found.
+                    # In expression labels.iris_name HAS *, At field labels ." But the state can be filtered.
+                    filter=f"state:{self._LABELABLE_STATE}",
                 )
+            )
+            page_token = response.get("nextPageToken")
+            yield response.get("items", []), page_token
+            if not page_token:
+                return
 
-                if "items" not in response:
-                    return
-                for database_instance in response["items"]:
-                    try:
-                        self.label_resource(database_instance, project_id)
-                    except Exception:
-                        logging.exception("")
-                if "nextPageToken" in response:
-                    page_token = response["nextPageToken"]
-                else:
-                    return
-
-    @log_time
-    def label_resource(self, gcp_object, project_id):
-        labels = self._build_labels(gcp_object, project_id)
-        if labels is None:
+    def _label_all(self, project_id, sweep: Sweep):
+        with timing(f"label_all({type(self).__name__}) in {project_id}"):
+            return self._label_pages(project_id, sweep)
+
+    def _label_listed(self, gcp_object, project_id, labels):
+        state = gcp_object.get("state", self._LABELABLE_STATE)
+        if state != self._LABELABLE_STATE:
+            logging.info(
+                "Deferring labeling of CloudSQL %s, in state %s",
+                gcp_object["name"],
+                state,
+            )
             return
-        try:
-            database_instance_body = {"settings": {"userLabels": labels["labels"]}}
+        self.__patches.submit(gcp_object, project_id, labels)
 
-            self._google_api_client().instances().patch(
-                project=project_id,
-                body=database_instance_body,
-                instance=gcp_object["name"],
-            ).execute()
+    @property
+    def counter(self) -> int:
+        """Including the patches in flight, so that _suspend waits for them"""
+        return super().counter + self.__patches.pending
 
+    def do_batch(self):
+        """Wait for the patches in flight, but not for their operations"""
+        super().do_batch()
+        self.__patches.wait()
+
+    @log_time
+    def _apply_labels(self, gcp_object, project_id, labels):
+        try:
+            self.__patch_and_track(gcp_object, project_id, labels)
         except errors.HttpError as e:
             if "PENDING_CREATE" == gcp_object.get("state"):
                 logging.exception(
@@ -124,3 +150,24 @@ class Cloudsql(Plugin):
                 )
 
             raise e
+
+    def __patch_and_track(self, gcp_object, project_id, labels):
+        database_instance_body = {"settings": {"userLabels": labels["labels"]}}
+
+        operation = http_pool.execute(
+            self._google_api_client()
+            .instances()
+            .patch(
+                project=project_id,
+                body=database_instance_body,
+                instance=gcp_object["name"],
+            )
+        )
+        self.__operations.track(project_id, operation, gcp_object["name"])
+
+    def __get_operation(self, project_id, operation_name):
+        return http_pool.execute(
+            self._google_api_client()
+            .operations()
+            .get(project=project_id, operation=operation_name)
+        )
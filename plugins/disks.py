@@ -6,7 +6,6 @@ from functools import lru_cache
 from googleapiclient import errors
 
 from gce_base.gce_zonal_base import GceZonalBase
-from util import gcp_utils
 from util.gcp_utils import add_loaded_lib
 from util.utils import log_time
 
@@ -18,6 +17,7 @@ class Disks(GceZonalBase):
     """
 
     __lock = threading.Lock()
+    _label_specs = {"pd_attached": lambda o: "true" if o.get("users") else "false"}
 
     @staticmethod
     @lru_cache(maxsize=1)
@@ -41,6 +41,10 @@ class Disks(GceZonalBase):
         # As of 2021-10-12,   beta.compute.disks.insert
         return ["compute.disks.insert"]
 
+    @staticmethod
+    def asset_types():
+        return ["compute.googleapis.com/Disk"]
+
     @staticmethod
     def relabel_on_cron() -> bool:
         """
@@ -77,31 +81,23 @@ class Disks(GceZonalBase):
             logging.exception("")
             return None
 
-    @log_time
-    def label_resource(self, gcp_object, project_id):
-        with self._write_lock:
-            labels = self._build_labels(gcp_object, project_id)
-            if labels is None:
-                return
-
-            zone = self._gcp_zone(gcp_object)
-
-            self._batch.add(
-                self._google_api_client()
-                .disks()
-                .setLabels(
-                    project=project_id,
-                    zone=zone,
-                    resource=gcp_object["name"],
-                    body=labels,
-                ),
-                request_id=gcp_utils.generate_uuid(),
+    def _label_operation(self, gcp_object):
+        return "disks.setLabels"
+
+    def _label_request(self, gcp_object, project_id, labels):
+        return (
+            self._google_api_client()
+            .disks()
+            .setLabels(
+                project=project_id,
+                zone=self._zone(gcp_object),
+                resource=gcp_object["name"],
+                body=labels,
             )
-            self.counter += 1
-            if self.counter >= self._BATCH_SIZE:
-                self.do_batch()
-
-    def _gcp_pd_attached(self, gcp_object):
-        """Method dynamically called in generating labels, so don't change name"""
-        users = gcp_object.get("users")
-        return "true" if users else "false"
+        )
+
+    @log_time
+    def _apply_labels(self, gcp_object, project_id, labels):
+        self._add_to_batch(
+            self._label_request(gcp_object, project_id, labels), gcp_object, project_id
+        )
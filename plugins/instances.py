@@ -6,13 +6,14 @@ from typing import Dict, Optional, List
 from googleapiclient import errors
 
 from gce_base.gce_zonal_base import GceZonalBase
-from util import gcp_utils
 from util.gcp_utils import add_loaded_lib
+from util.label_specs import after_last, field
 from util.utils import log_time
 
 
 class Instances(GceZonalBase):
     __lock = threading.Lock()
+    _label_specs = {"instance_type": field("machineType", transform=after_last("/"))}
 
     @staticmethod
     @lru_cache(maxsize=1)
@@ -36,16 +37,9 @@ class Instances(GceZonalBase):
     def method_names():
         return ["compute.instances.insert", "compute.instances.start"]
 
-    def _gcp_instance_type(self, gcp_object: dict):
-        """Method dynamically called in generating labels, so don't change name"""
-        try:
-            machine_type = gcp_object["machineType"]
-            ind = machine_type.rfind("/")
-            machine_type = machine_type[ind + 1 :]
-            return machine_type
-        except KeyError:
-            logging.exception("")
-            return None
+    @staticmethod
+    def asset_types():
+        return ["compute.googleapis.com/Instance"]
 
     def _list_all(self, project_id, zone) -> List[Dict]:
         # Local import to avoid burdening AppEngine memory.
@@ -74,28 +68,25 @@ class Instances(GceZonalBase):
             logging.exception("")
             return None
 
-    @log_time
-    def label_resource(self, gcp_object, project_id):
-        with self._write_lock:
-            labels = self._build_labels(gcp_object, project_id)
-            if labels is None:
-                return
-
-            zone = self._gcp_zone(gcp_object)
-
-            self._batch.add(
-                self._google_api_client()
-                .instances()
-                .setLabels(
-                    project=project_id,
-                    zone=zone,
-                    instance=gcp_object["name"],
-                    body=labels,
-                ),
-                request_id=gcp_utils.generate_uuid(),
+    def _label_operation(self, gcp_object):
+        return "instances.setLabels"
+
+    def _label_request(self, gcp_object, project_id, labels):
+        # Could use the Cloud Client as follows , but that apparently that does not support batching
+        #  compute_v1.SetLabelsInstanceRequest(project=project_id, zone=zone, instance=name, labels=labels)
+        return (
+            self._google_api_client()
+            .instances()
+            .setLabels(
+                project=project_id,
+                zone=self._zone(gcp_object),
+                instance=gcp_object["name"],
+                body=labels,
             )
-            # Could use the Cloud Client as follows , but that apparently that does not support batching
-            #  compute_v1.SetLabelsInstanceRequest(project=project_id, zone=zone, instance=name, labels=labels)
-            self.counter += 1
-            if self.counter >= self._BATCH_SIZE:
-                self.do_batch()
+        )
+
+    @log_time
+    def _apply_labels(self, gcp_object, project_id, labels):
+        self._add_to_batch(
+            self._label_request(gcp_object, project_id, labels), gcp_object, project_id
+        )
@@ -4,7 +4,7 @@ from functools import lru_cache
 from googleapiclient import errors
 
 from gce_base.gce_base import GceBase
-from util import gcp_utils
+from plugin import Sweep
 from util.gcp_utils import add_loaded_lib
 from util.utils import log_time, timing
 
@@ -27,15 +27,21 @@ class Snapshots(GceBase):
     def method_names():
         return ["compute.disks.createSnapshot", "compute.snapshots.insert"]
 
-    def _list_all(self, project_id):
+    @staticmethod
+    def asset_types():
+        return ["compute.googleapis.com/Snapshot"]
+
+    def _list_pages(self, project_id, page_token):
         # Local import to avoid burdening AppEngine memory. Loading all
         # Client libraries would be 100MB  means that the default AppEngine
         # Instance crashes on out-of-memory even before actually serving a request.
         from google.cloud import compute_v1
 
         add_loaded_lib("compute_v1")
-        all_resources = compute_v1.ListSnapshotsRequest(project=project_id)
-        return self._list_resources_as_dicts(all_resources)
+        all_resources = compute_v1.ListSnapshotsRequest(
+            project=project_id, page_token=page_token
+        )
+        return self._list_pages_as_dicts(all_resources)
 
     def _get_resource(self, project_id, name):
         try:
@@ -51,15 +57,12 @@ class Snapshots(GceBase):
             logging.exception("")
             return None
 
-    def label_all(self, project_id):
+    def _label_all(self, project_id, sweep: Sweep):
         with timing(f"label_all in {project_id}"):
-            for o in self._list_all(project_id):
-                try:
-                    self.label_resource(o, project_id)
-                except Exception:
-                    logging.exception("")
+            count = self._label_pages(project_id, sweep)
             if self.counter > 0:
                 self.do_batch()
+            return count
 
     def get_gcp_object(self, log_data):
         try:
@@ -74,16 +77,22 @@ class Snapshots(GceBase):
             logging.exception("")
             return None
 
-    @log_time
-    def label_resource(self, gcp_object, project_id):
-        labels = self._build_labels(gcp_object, project_id)
+    def _refresh_resource(self, gcp_object, project_id):
+        return self._get_resource(project_id, gcp_object["name"])
 
-        self._batch.add(  # Using Google Client API because CloudClient has, I think, no batch functionality
+    def _label_operation(self, gcp_object):
+        return "snapshots.setLabels"
+
+    def _label_request(self, gcp_object, project_id, labels):
+        # Using Google Client API because CloudClient has, I think, no batch functionality
+        return (
             self._google_api_client()
             .snapshots()
-            .setLabels(project=project_id, resource=gcp_object["name"], body=labels),
-            request_id=gcp_utils.generate_uuid(),
+            .setLabels(project=project_id, resource=gcp_object["name"], body=labels)
+        )
+
+    @log_time
+    def _apply_labels(self, gcp_object, project_id, labels):
+        self._add_to_batch(
+            self._label_request(gcp_object, project_id, labels), gcp_object, project_id
         )
-        self.counter += 1
-        if self.counter >= self._BATCH_SIZE:
-            self.do_batch()
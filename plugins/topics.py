@@ -1,19 +1,21 @@
 import logging
 from functools import lru_cache
-from typing import List, Dict, Optional
+from typing import Dict, Optional
 
 from googleapiclient import errors
 
-from plugin import Plugin
+from pubsub_base.pubsub_base import PubsubBase
 from util.gcp_utils import (
     cloudclient_pb_obj_to_dict,
     cloudclient_pb_objects_to_list_of_dicts,
     add_loaded_lib,
 )
-from util.utils import log_time, timing
+from util.label_specs import after_last, field
 
 
-class Topics(Plugin):
+class Topics(PubsubBase):
+    _label_specs = {"name": field("name", transform=after_last("/"))}
+
     @classmethod
     @lru_cache(maxsize=1)
     def _cloudclient(cls, _=None):
@@ -27,23 +29,14 @@ class Topics(Plugin):
 
         return pubsub_v1.PublisherClient()
 
-    @staticmethod
-    def _discovery_api():
-        """Discovery API not actually used with Topics. Would be "pubsub", "v1"""
-        return None
-
     @staticmethod
     def method_names():
         # Actually"google.pubsub.v1.Subscriber.CreateTopic", but substring is allowed
         return ["Publisher.CreateTopic"]
 
-    def label_all(self, project_id):
-        with timing(f"label_all({type(self).__name__})  in {project_id}"):
-            for o in self._list_all(project_id):
-                try:
-                    self.label_resource(o, project_id)
-                except Exception:
-                    logging.exception("")
+    @staticmethod
+    def asset_types():
+        return ["pubsub.googleapis.com/Topic"]
 
     def __get_resource(self, path):
         try:
@@ -53,21 +46,21 @@ class Topics(Plugin):
             logging.exception("")
             return None
 
-    def _list_all(self, project_id) -> List[Dict]:
+    def _list_pages(self, project_id, page_token):
         all_resources = self._cloudclient().list_topics(
-            request={"project": f"projects/{project_id}"}
+            request={
+                "project": f"projects/{project_id}",
+                "page_token": page_token,
+                "page_size": self._PAGE_SIZE,
+            }
         )
-        return cloudclient_pb_objects_to_list_of_dicts(all_resources)
-
-    @log_time
-    def label_resource(self, gcp_object: Dict, project_id):
-        # This API does not accept label-fingerprint, so extracting just labels
-        labels_outer = self._build_labels(gcp_object, project_id)
-        if labels_outer is None:
-            return
-        labels = labels_outer["labels"]
+        for page in all_resources.pages:
+            yield list(cloudclient_pb_objects_to_list_of_dicts(page.topics)), (
+                page.next_page_token or None
+            )
 
-        name = self._gcp_name(gcp_object)
+    def _update(self, gcp_object: Dict, project_id, labels):
+        name = self._name_after_slash(gcp_object)
         path = self._cloudclient().topic_path(project_id, name)
         # Local import to avoid burdening AppEngine memory.
         # Loading all Cloud Client libraries would be 100MB  means that
@@ -79,15 +72,12 @@ class Topics(Plugin):
 
         update_mask = {"paths": {"labels"}}
 
-        with timing("update " + type(self).__name__):
-            _ = self._cloudclient().update_topic(
-                request={
-                    "topic": update_obj,
-                    "update_mask": update_mask,
-                }
-            )
-
-        logging.info(f"Updated: {path}")
+        self._cloudclient().update_topic(
+            request={
+                "topic": update_obj,
+                "update_mask": update_mask,
+            }
+        )
 
     def get_gcp_object(self, log_data: Dict) -> Optional[Dict]:
         try:
@@ -96,7 +86,3 @@ class Topics(Plugin):
         except Exception:
             logging.exception("")
             return None
-
-    def _gcp_name(self, gcp_object):
-        """Method dynamically called in generating labels, so don't change name"""
-        return self._name_after_slash(gcp_object)
@@ -0,0 +1,59 @@
+import logging
+from abc import ABCMeta, abstractmethod
+from typing import Dict
+
+from plugin import Plugin, Sweep
+from util import config_utils
+from util.concurrent_updates import ConcurrentUpdates
+from util.utils import log_time, timing
+
+
+class PubsubBase(Plugin, metaclass=ABCMeta):
+    """
+    For Topics and Subscriptions, whose labels are written with a unary RPC per resource, with no batching.
+    In label_all, the RPCs are sent concurrently while the next page is listed,
+    with at most pubsub_update_concurrency at once per project (see ConcurrentUpdates).
+    """
+
+    # The maximum for listing PubSub resources
+    _PAGE_SIZE = 1000
+
+    def __init__(self):
+        super().__init__()
+        self.__updates = ConcurrentUpdates(
+            type(self).__name__, self._update, config_utils.pubsub_update_concurrency
+        )
+
+    @staticmethod
+    def _discovery_api():
+        """Discovery API not actually used with PubSub. Would be "pubsub", "v1"""
+        return None
+
+    @abstractmethod
+    def _update(self, gcp_object: Dict, project_id: str, labels: Dict[str, str]):
+        """Write the labels (not including a label-fingerprint, which this API does not accept) with one RPC"""
+        pass
+
+    def _label_all(self, project_id, sweep: Sweep):
+        with timing(f"label_all({type(self).__name__})  in {project_id}"):
+            count = self._label_pages(project_id, sweep)
+            return count
+
+    @log_time
+    def _apply_labels(self, gcp_object: Dict, project_id, labels):
+        """For a single resource, as in label_one"""
+        self._update(gcp_object, project_id, labels["labels"])
+        logging.info("Updated: %s", gcp_object["name"])
+
+    def _label_listed(self, gcp_object: Dict, project_id, labels):
+        self.__updates.submit(gcp_object, project_id, labels["labels"])
+
+    @property
+    def counter(self) -> int:
+        """Including the updates in flight, so that _suspend waits for them"""
+        return super().counter + self.__updates.pending
+
+    def do_batch(self):
+        """Wait for the updates in flight, and log their outcomes"""
+        super().do_batch()
+        self.__updates.wait()
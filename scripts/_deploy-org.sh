@@ -71,6 +71,8 @@ else
   log_filter+=('OR "v1.compute.snapshots.insert" OR "v1.compute.disks.createSnapshot"')
   log_filter+=('OR "google.pubsub.v1.Subscriber.CreateSubscription"')
   log_filter+=('OR "google.pubsub.v1.Publisher.CreateTopic"')
+  # Project updates, so that cached project labels are refreshed
+  log_filter+=('OR "UpdateProject"')
   log_filter+=(')')
 
   # Create or update a sink at org level
@@ -47,6 +47,7 @@ done < <(gcloud services list --format="value(config.name)")
 required_svcs=(
   cloudscheduler.googleapis.com
   cloudresourcemanager.googleapis.com
+  cloudasset.googleapis.com
   pubsub.googleapis.com
   compute.googleapis.com
   storage-component.googleapis.com
@@ -145,6 +146,7 @@ if [[ "$CRON_ONLY" == "true" ]]; then
   gcloud pubsub topics delete "$LOGS_TOPIC" --project="$PROJECT_ID" 2>/dev/null || true
 else
   # Create PubSub topic for receiving logs about new GCP objects
+  # (and UpdateProject events); the log sink and its filter are created in _deploy-org.sh
   gcloud pubsub topics describe "$LOGS_TOPIC" --project="$PROJECT_ID" ||
     gcloud pubsub topics create $LOGS_TOPIC --project="$PROJECT_ID" --quiet >/dev/null
 
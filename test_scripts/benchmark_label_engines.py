@@ -0,0 +1,131 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import request
+
+from plugin import Sweep
+from plugins.instances import Instances
+from test_scripts.utils_for_tests import assert_root_path
+from util import api_limiter, config_utils
+from util.utils import init_logging
+
+init_logging()
+"""
+This is a benchmarking tool used in development.
+It times label_all of GCE Instances against a local fake Compute API that lists the instances of each zone
+with a fixed latency, with the threads label_engine (8 threads per label_all) and with the api_limited
+label_engine, first limited to 8 calls at once, for the overhead of the shared pool at the same concurrency,
+then to 64, for the effect of a higher limit. It also checks that all give the same results.
+
+Run it in the project root, with from_project: False in the config, since the fake projects have no labels.
+"""
+
+ZONES = [f"region{r}-zone{z}" for r in range(40) for z in "abc"]
+INSTANCES_PER_ZONE = 20
+LATENCY_SECONDS = 0.3
+
+
+class FakeComputeHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        zone = self.path.strip("/").split("/")[1]
+        time.sleep(LATENCY_SECONDS)
+        items = [
+            {
+                "name": f"vm-{i}",
+                "zone": f"https://compute/zones/{zone}",
+                "machineType": "https://compute/machineTypes/e2-medium",
+                "labels": {},
+            }
+            for i in range(INSTANCES_PER_ZONE)
+        ]
+        body = json.dumps(items).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+class FakeInstances(Instances):
+    """Lists from the fake API, and records labels rather than writing them"""
+
+    port = 0
+
+    def __init__(self):
+        super().__init__()
+        self.applied = []
+        self.__lock = threading.Lock()
+
+    def _all_zones(self):
+        return ZONES
+
+    def _list_all(self, project_id, zone):
+        url = f"http://127.0.0.1:{self.port}/zones/{zone}/instances"
+        with request.urlopen(url) as response:
+            return json.load(response)
+
+    def _apply_labels(self, gcp_object, project_id, labels):
+        with self.__lock:
+            self.applied.append((self._zone(gcp_object), gcp_object["name"]))
+
+
+def run(engine: str, concurrency: int):
+    api_limiter.is_enabled = lambda: engine == "api_limited"
+    # A new API name per run, since the limit is read when an API is first used
+    api = f"compute-{concurrency}"
+    config_utils.api_concurrency = lambda _: concurrency
+    limited_executor = api_limiter.LimitedExecutor
+    api_limiter.LimitedExecutor = lambda _: limited_executor(api)
+    plugin = FakeInstances()
+    sweep = Sweep()
+    start = time.time()
+    # A project per run, so that the zone occupancy recorded by one does not narrow the sweep of another
+    try:
+        count = plugin.label_all(f"bench-{engine}-{concurrency}", sweep)
+    finally:
+        api_limiter.LimitedExecutor = limited_executor
+    elapsed = time.time() - start
+    return (
+        elapsed,
+        count,
+        sorted(plugin.applied),
+        sorted(sweep.checkpoint["zones_done"]),
+    )
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeComputeHandler)
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    FakeInstances.port = server.server_address[1]
+
+    results = {}
+    for engine, concurrency in (
+        ("threads", 8),
+        ("api_limited", 8),
+        ("api_limited", 64),
+    ):
+        elapsed, *results[(engine, concurrency)] = run(engine, concurrency)
+        logging.info(
+            "%-11s at %2d calls at once: %d zones, %d instances: %.2f s",
+            engine,
+            concurrency,
+            len(ZONES),
+            results[(engine, concurrency)][0],
+            elapsed,
+        )
+    first, *others = results.values()
+    assert all(r == first for r in others), "The results differ"
+    logging.info("Same results from all runs")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    assert_root_path()
+    main()
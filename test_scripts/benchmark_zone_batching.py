@@ -0,0 +1,108 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from test_scripts.utils_for_tests import assert_root_path
+from util import http_pool
+from util.batch_pipeline import BatchPipeline
+from util.utils import init_logging
+
+init_logging()
+"""
+This is a benchmarking tool used in development.
+It measures how labeling in the GceZonalBase zone threads scales with the number of threads,
+against a fake batch API with a fixed round-trip time: As before BatchPipeline, with a lock held
+across adding to the batch and sending a full batch; and with the BatchPipeline, with a shared batch
+and with a batch per thread.
+Each zone also has a fixed listing time, as for the API call that lists its resources.
+
+Run it in the project root.
+"""
+
+ZONES = 32
+RESOURCES_PER_ZONE = 300
+LIST_SECONDS = 0.25
+BATCH_SECONDS = 0.2
+
+
+class FakeBatch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append(request_id)
+
+    def execute(self, http=None):
+        time.sleep(BATCH_SECONDS)
+        for request_id in self.requests:
+            self.callback(request_id, {}, None)
+
+
+def run_locked(threads: int) -> float:
+    """As before BatchPipeline: The lock is held while a full batch is sent"""
+    lock = threading.Lock()
+    batch = FakeBatch(lambda *_: None)
+
+    def label_one_zone(zone):
+        nonlocal batch
+        time.sleep(LIST_SECONDS)
+        for i in range(RESOURCES_PER_ZONE):
+            with lock:
+                batch.add({"zone": zone, "resource": i}, f"{zone}-{i}")
+                if len(batch.requests) >= 990:
+                    batch.execute()
+                    batch = FakeBatch(lambda *_: None)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(label_one_zone, range(ZONES)))
+    batch.execute()
+    return time.time() - start
+
+
+def run(threads: int, per_thread: bool) -> float:
+    pipeline = BatchPipeline(
+        "bench", FakeBatch, lambda *_: None, 990, per_thread=per_thread
+    )
+
+    def label_one_zone(zone):
+        time.sleep(LIST_SECONDS)
+        try:
+            for i in range(RESOURCES_PER_ZONE):
+                pipeline.add({"zone": zone, "resource": i})
+        finally:
+            pipeline.flush_thread()
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(label_one_zone, range(ZONES)))
+    pipeline.flush()
+    return time.time() - start
+
+
+def main():
+    http_pool.set_http_factory(lambda: None)  # No real API calls
+    variants = {
+        "Locked, synchronous": run_locked,
+        "Pipeline, shared batch": lambda threads: run(threads, False),
+        "Pipeline, per-thread batches": lambda threads: run(threads, True),
+    }
+    for name, variant in variants.items():
+        base = None
+        for threads in (1, 2, 4, 8):
+            elapsed = variant(threads)
+            base = base or elapsed
+            logging.info(
+                "%s, %d threads: %.2f s, speedup %.1fx",
+                name,
+                threads,
+                elapsed,
+                base / elapsed,
+            )
+
+
+if __name__ == "__main__":
+    assert_root_path()
+    main()
@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+import tempfile
+
+from plugin import Sweep, SweepSuspended
+from plugins.instances import Instances
+from test_scripts.utils_for_tests import assert_root_path
+from util import asset_search, config_utils, export_utils
+from util.asset_search import LocalAssetSearch
+from util.utils import init_logging
+
+init_logging()
+"""
+This is a check used in development, with no server or cloud resources:
+It asserts that labeling from a local Cloud Asset Inventory export, and from LocalAssetSearch,
+routes each asset to its plugin and builds the expected labels; that local paths are refused
+unless allowed, as on App Engine; and that a search out of time is continued from its page token.
+
+Run it in the project root.
+"""
+
+PROJECT = "test-proj"
+
+
+class RecordingInstances(Instances):
+    """Records labels rather than writing them"""
+
+    def __init__(self):
+        super().__init__()
+        self.applied = {}
+
+    def _project_labels(self, project_id):
+        return {}
+
+    def _apply_labels(self, gcp_object, project_id, labels):
+        self.applied[gcp_object["name"]] = labels
+
+
+def instance_record(name, labels):
+    data = {
+        "name": name,
+        "zone": f"https://www.googleapis.com/compute/v1/projects/{PROJECT}/zones/us-east1-b",
+        "machineType": "https://www.googleapis.com/compute/v1/machineTypes/e2-small",
+        "labels": labels,
+        "labelFingerprint": "fp",
+    }
+    return {
+        "name": f"//compute.googleapis.com/projects/{PROJECT}/zones/us-east1-b/instances/{name}",
+        "asset_type": "compute.googleapis.com/Instance",
+        "resource": {"version": "v1", "location": "us-east1-b", "data": data},
+    }
+
+
+def expected_labels(name):
+    return {
+        "labels": {
+            "iris_instance_type": "e2-small",
+            "iris_name": name,
+            "iris_region": "us-east1",
+            "iris_zone": "us-east1-b",
+        },
+        "labelFingerprint": "fp",
+    }
+
+
+def check_export():
+    labeled = expected_labels("vm-2")["labels"]
+    records = [
+        instance_record("vm-1", {}),
+        instance_record("vm-2", labeled),  # No change, so not labeled
+        {
+            "name": "//storage.googleapis.com/b",
+            "asset_type": "storage.googleapis.com/Bucket",
+            "resource": {"data": {}},
+        },
+    ]
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        for r in records:
+            f.write(json.dumps(r) + "\n")
+        f.write("not json\n")
+    try:
+        plugin = RecordingInstances()
+        by_type = {"compute.googleapis.com/Instance": plugin}
+        try:
+            export_utils.label_from_export(f.name, by_type)
+            assert False, "A local path should be refused"
+        except ValueError:
+            pass
+        assert not plugin.applied
+
+        counts = export_utils.label_from_export(f.name, by_type, allow_local=True)
+        assert counts == {"compute.googleapis.com/Instance": 2}, counts
+        assert plugin.applied == {"vm-1": expected_labels("vm-1")}, plugin.applied
+    finally:
+        os.remove(f.name)
+
+
+def check_search():
+    results = [
+        export_utils.asset_from_export_record(instance_record(f"vm-{i}", {}))
+        for i in range(5)
+    ]
+    search = LocalAssetSearch(results, page_size=2)
+    asset_search.set_asset_search(search)
+    plugin = RecordingInstances()
+    count = plugin.label_by_search("organizations/1")
+    assert count == 5, count
+    assert search.page_requests == 3, search.page_requests
+    assert plugin.applied == {
+        f"vm-{i}": expected_labels(f"vm-{i}") for i in range(5)
+    }, plugin.applied
+
+
+class PagesSweep(Sweep):
+    """Out of time after the given number of pages"""
+
+    def __init__(self, pages, checkpoint=None):
+        super().__init__(checkpoint=checkpoint)
+        self.__pages = pages
+
+    def out_of_time(self):
+        self.__pages -= 1
+        return self.__pages < 0
+
+
+def check_search_continuation():
+    results = [
+        export_utils.asset_from_export_record(instance_record(f"vm-{i}", {}))
+        for i in range(5)
+    ]
+    search = LocalAssetSearch(results, page_size=2)
+    asset_search.set_asset_search(search)
+    plugin = RecordingInstances()
+    sweep = PagesSweep(1)
+    try:
+        plugin.label_by_search("organizations/1", sweep)
+        assert False, "Should be out of time after a page"
+    except SweepSuspended:
+        pass
+    assert sweep.checkpoint == {"page_token": "2"}, sweep.checkpoint
+    assert set(plugin.applied) == {"vm-0", "vm-1"}, plugin.applied
+    count = plugin.label_by_search(
+        "organizations/1", PagesSweep(10, checkpoint=sweep.checkpoint)
+    )
+    assert count == 3, count
+    assert set(plugin.applied) == {f"vm-{i}" for i in range(5)}, plugin.applied
+
+
+def main():
+    # The assets are all in PROJECT, whatever projects the config enables
+    config_utils.is_project_enabled = lambda project_id: project_id == PROJECT
+    check_export()
+    logging.info("OK for labeling from a local export")
+    check_search()
+    logging.info("OK for labeling from LocalAssetSearch")
+    check_search_continuation()
+    logging.info("OK for continuing a search from its checkpoint")
+
+
+if __name__ == "__main__":
+    assert_root_path()
+    main()
@@ -0,0 +1,46 @@
+import json
+import logging
+import os
+import sys
+
+from test_scripts.utils_for_tests import do_local_http, assert_root_path
+from util.utils import init_logging
+
+init_logging()
+"""
+This is a debugging tool used in development.
+It asks the local server to label resources from a Cloud Asset Inventory export.
+
+To use it.
+1. Export resources with
+   `gcloud asset export --organization <ORG_ID> --content-type resource --output-path gs://<BUCKET>/<OBJECT>`
+   (or use a local copy of such an export)
+2. Run main.py in debug mode
+3. Then run this file (in project root), with environment key export_uri set to the gs:// URI,
+   or a local path, which only a local server accepts.
+For a check with no server or cloud resources, run test_export_offline.py.
+"""
+
+
+def test_label_from_export(export_uri):
+    contents = json.dumps({"export_uri": export_uri})
+    do_local_http("do_label", contents)
+
+
+def main():
+    export_uri = os.environ.get("export_uri")
+    if not export_uri or len(sys.argv) > 1:
+        logging.info(
+            f"""Usage: {os.path.basename(sys.argv[0])}
+             Set environment with
+             - required key export_uri with gs://bucket/object or a local path of a Cloud Asset export
+             - optional key LOCAL_PORT for the port of the local Iris server
+             """
+        )
+        exit(1)
+    test_label_from_export(export_uri)
+
+
+if __name__ == "__main__":
+    assert_root_path()
+    main()
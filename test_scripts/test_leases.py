@@ -0,0 +1,49 @@
+import logging
+
+from util.lease_utils import (
+    FileLeaseBackend,
+    InMemoryLeaseBackend,
+    KeyValueLeaseBackend,
+)
+from util.memcache_utils import LocalKeyValueStore
+from util.utils import init_logging
+
+init_logging()
+"""
+This is a check used in development, with no server or cloud resources:
+It asserts that each lease backend hands a lease to one owner at a time,
+and to another owner right after a release, as the continuation message of a checkpointed do_label needs.
+
+Run it in the project root.
+"""
+
+
+def check_backend(backend):
+    assert backend.acquire("k", "a", 60)
+    assert not backend.acquire("k", "b", 60), "Held by a"
+    assert backend.renew("k", "a", 60)
+    assert not backend.renew("k", "b", 60)
+    backend.release("k", "b")  # Not the owner: No effect
+    assert not backend.acquire("k", "b", 60), "Still held by a"
+    backend.release("k", "a")
+    assert backend.acquire("k", "b", 60), "Free right after the release"
+    assert not backend.renew("k", "a", 60)
+    backend.release("k", "b")
+    assert backend.acquire("k", "a", 60), "Free right after the second release"
+    backend.release("k", "a")
+
+
+def main():
+    store = LocalKeyValueStore()
+    backends = {
+        "memory": InMemoryLeaseBackend(),
+        "file": FileLeaseBackend("/tmp/iris_test_leases"),
+        "memcache": KeyValueLeaseBackend(lambda: store),
+    }
+    for name, backend in backends.items():
+        check_backend(backend)
+        logging.info("OK for lease backend %s", name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import logging
+import time
+
+from gce_base import zone_occupancy
+from util import config_utils, memcache_utils, skip_cache
+from util.memcache_utils import MAX_RELATIVE_EXPIRY_SECONDS, LocalKeyValueStore
+from util.utils import init_logging
+
+init_logging()
+"""
+This is a check used in development, with no server or cloud resources:
+It asserts that the skip cache and the zone occupancy, with intervals above a month, never pass Memcache
+a relative expiry above 30 days, which Memcache would read as a Unix time in 1970, expiring the entry at once;
+and that their entries are still there after being written.
+
+Run it in the project root.
+"""
+
+PROJECT = "test-proj"
+
+
+class RecordingStore(LocalKeyValueStore):
+    """Records the expiry times passed to it"""
+
+    def __init__(self):
+        super().__init__()
+        self.times = []
+
+    def add(self, key, value, time=0):
+        self.times.append(time)
+        return super().add(key, value, time=time)
+
+    def cas(self, key, value, time=0):
+        self.times.append(time)
+        return super().cas(key, value, time=time)
+
+
+def check_expiry_times(store):
+    now = time.time()
+    assert store.times
+    for t in store.times:
+        assert t <= MAX_RELATIVE_EXPIRY_SECONDS or t > now, t
+
+
+def check_skip_cache():
+    store = RecordingStore()
+    memcache_utils.client = lambda: store
+    for _ in range(6):  # Enough for the interval to reach skip_cache_max_days
+        skip_cache.record(PROJECT, "Buckets", skip_cache.NO_RESOURCES)
+    assert skip_cache.skipped_plugins(PROJECT) == {"Buckets"}
+    check_expiry_times(store)
+
+
+def check_zone_occupancy():
+    store = RecordingStore()
+    memcache_utils.client = lambda: store
+    zones = ["us-east1-b", "us-east1-c"]
+    zone_occupancy.record_occupied(PROJECT, "us-east1-b")
+    zone_occupancy.record_full_sweep(PROJECT, "Instances")
+    swept = zone_occupancy.zones_to_sweep(PROJECT, "Instances", zones)
+    assert swept == ["us-east1-b"], swept
+    check_expiry_times(store)
+
+
+def main():
+    config_utils.skip_cache_backend = lambda: "memcache"
+    config_utils.skip_cache_max_days = lambda: 32
+    config_utils.zone_occupancy_backend = lambda: "memcache"
+    config_utils.empty_zone_sweep_days = lambda: 20
+    config_utils.zone_regions = lambda: []
+    check_skip_cache()
+    logging.info("OK for the skip cache")
+    check_zone_occupancy()
+    logging.info("OK for the zone occupancy")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import logging
+import time
+
+from util import http_pool
+from util.batch_pipeline import BatchPipeline
+from util.rate_limiter import AimdRateLimiter
+from util.utils import init_logging
+
+init_logging()
+"""
+This is a check used in development, with no server or cloud resources:
+It asserts that a BatchPipeline with a rate limiter takes each slot when a request is sent, not when it is added;
+that flush() with a deadline returns, by about the deadline, the contexts of its owner's requests not yet sent,
+rather than waiting for a backlog booked far ahead; and that it does not wait for the requests of other owners.
+
+Run it in the project root.
+"""
+
+RATE = 4  # Requests per second
+
+
+class FakeBatch:
+    """Succeeds at once for each request"""
+
+    def __init__(self, callback, sent):
+        self.__callback = callback
+        self.__sent = sent
+        self.__ids = []
+
+    def add(self, request, request_id):
+        self.__ids.append((request_id, request))
+
+    def execute(self, http=None):
+        for request_id, request in self.__ids:
+            self.__sent.append(request)
+            self.__callback(request_id, {}, None)
+
+
+def main():
+    http_pool.set_http_factory(object)
+    sent = []
+    limiter = AimdRateLimiter("test", RATE, RATE)
+    pipeline = BatchPipeline(
+        "test",
+        lambda callback: FakeBatch(callback, sent),
+        lambda *_: None,
+        max_batch_size=100,
+        rate_limiter=lambda _: limiter,
+    )
+
+    sweep, other = object(), object()
+    with pipeline.owned_by(sweep):
+        for i in range(40):
+            pipeline.add(f"sweep-{i}", context=f"sweep-{i}")
+    with pipeline.owned_by(other):
+        pipeline.add("other-0", context="other-0")
+    # Nothing booked ahead: Only the burst of a second's slots was taken
+    assert limiter.wait_seconds() <= 1 / RATE, limiter.wait_seconds()
+
+    start = time.time()
+    unsent = pipeline.flush(deadline=start + 2, owner=sweep)
+    elapsed = time.time() - start
+    assert 1.9 < elapsed < 3, elapsed
+    assert 10 <= len(sent) <= 20, sent
+    sent_of_sweep = [r for r in sent if r.startswith("sweep")]
+    assert len(unsent) + len(sent_of_sweep) == 40, (len(unsent), len(sent))
+    assert "other-0" not in unsent, "Only the owner's requests are returned"
+    assert sorted(unsent) == sorted(set(unsent)), unsent
+    assert not set(unsent) & set(sent), "Returned requests were also sent"
+
+    # A flush for no owner does not wait for the other owner's request, still queued behind the sweep's
+    start = time.time()
+    pipeline.flush()
+    assert time.time() - start < 1, time.time() - start
+    # The dispatcher sends it on its own
+    time.sleep(1)
+    assert "other-0" in sent, sent
+    logging.info("OK for rate-limited flush")
+
+
+if __name__ == "__main__":
+    main()
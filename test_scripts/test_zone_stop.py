@@ -0,0 +1,93 @@
+import logging
+import threading
+import time
+
+from plugin import Sweep
+from plugins.instances import Instances
+from test_scripts.utils_for_tests import assert_root_path
+from util import api_limiter
+from util.utils import init_logging
+
+init_logging()
+"""
+This is a check used in development, with no server or cloud resources:
+It asserts that when listing one zone shows that the API is disabled, label_all of GCE Instances raises soon,
+and that the other zones, already being listed and labeled on other threads, stop, rather than going on
+until done, whether label_all waits for them or has returned; with each label_engine.
+
+Run it in the project root, with from_project: False in the config, since the fake projects have no labels.
+"""
+
+ZONES = [f"region{r}-zone{z}" for r in range(10) for z in "abc"]
+# Listing each zone takes 4 s, so all of them at least 16 s
+LISTED_PER_ZONE = 20000
+
+
+class ApiDisabledError(Exception):
+    status_code = 403
+
+    def __init__(self):
+        super().__init__(
+            "accessNotConfigured: Compute Engine API has not been used in project"
+        )
+
+
+class FakeInstances(Instances):
+    """Lists slowly from all zones but the first, where the API is disabled, and records labels"""
+
+    def __init__(self):
+        super().__init__()
+        self.applied = 0
+        self.__lock = threading.Lock()
+
+    def _all_zones(self):
+        return ZONES
+
+    def _list_all(self, project_id, zone):
+        if zone == ZONES[0]:
+            time.sleep(0.2)
+            raise ApiDisabledError()
+        for i in range(LISTED_PER_ZONE):
+            if i % 100 == 0:
+                time.sleep(0.02)
+            yield {
+                "name": f"vm-{i}",
+                "zone": f"https://compute/zones/{zone}",
+                "machineType": "https://compute/machineTypes/e2-medium",
+                "labels": {},
+            }
+
+    def _apply_labels(self, gcp_object, project_id, labels):
+        with self.__lock:
+            self.applied += 1
+
+
+def check(engine: str):
+    api_limiter.is_enabled = lambda: engine == "api_limited"
+    plugin = FakeInstances()
+    sweep = Sweep()
+    start = time.time()
+    try:
+        plugin.label_all(f"stop-{engine}", sweep)
+        assert False, "Should raise"
+    except ApiDisabledError:
+        pass
+    elapsed = time.time() - start
+    assert elapsed < 2, f"label_all took {elapsed:.1f} s"
+    applied = plugin.applied
+    time.sleep(1)
+    assert (
+        plugin.applied == applied
+    ), f"Labeled {plugin.applied - applied} after label_all returned"
+    assert not sweep.checkpoint["zones_done"], sweep.checkpoint["zones_done"]
+
+
+def main():
+    for engine in ("threads", "api_limited"):
+        check(engine)
+        logging.info("OK for label_engine %s", engine)
+
+
+if __name__ == "__main__":
+    assert_root_path()
+    main()
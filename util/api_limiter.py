@@ -0,0 +1,78 @@
+"""
+A per-API concurrency limiter on threads, for the zone fan-out of label_all in GCE Instances and Disks,
+enabled with label_engine: api_limited in the config. (The default, threads, is a pool of 8 threads
+for each label_all.) No other plugin uses it.
+
+The calls run on one pool of threads, shared by all label_all runs in this instance, and at most
+api_concurrency[api] of them are in flight per API at once, across those runs. This is not non-blocking I/O:
+The Google client libraries are synchronous, so each call holds a thread while it waits on the network.
+"""
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional
+
+from util import config_utils
+
+# Threads shared by all LimitedExecutors; the semaphores bound how many are used per API
+_MAX_THREADS = 256
+
+__lock = threading.Lock()
+__executor: Optional[ThreadPoolExecutor] = None
+__semaphores: Dict[str, threading.Semaphore] = {}
+
+
+def is_enabled() -> bool:
+    return config_utils.label_engine() == "api_limited"
+
+
+class LimitedExecutor:
+    """
+    Submits calls to the shared pool, with at most api_concurrency(api) running at once
+    across all LimitedExecutors for the API. submit() blocks until there is room.
+    As a context manager, like ThreadPoolExecutor, it waits on exit for the calls submitted through it.
+    """
+
+    def __init__(self, api: str):
+        self.__semaphore = _get_semaphore(api)
+        self.__futures: List[Future] = []
+
+    def submit(self, func: Callable, *args) -> Future:
+        self.__semaphore.acquire()
+        try:
+            future = _get_executor().submit(func, *args)
+        except BaseException:
+            self.__semaphore.release()
+            raise
+        # Also called if the future is cancelled before it runs
+        future.add_done_callback(lambda _: self.__semaphore.release())
+        self.__futures.append(future)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        wait(self.__futures)
+        return False
+
+
+def _get_semaphore(api: str) -> threading.Semaphore:
+    """The limit is read when the API is first used; a change in the config applies after a restart"""
+    with __lock:
+        semaphore = __semaphores.get(api)
+        if semaphore is None:
+            semaphore = __semaphores[api] = threading.Semaphore(
+                config_utils.api_concurrency(api)
+            )
+        return semaphore
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global __executor
+    with __lock:
+        if __executor is None:
+            __executor = ThreadPoolExecutor(
+                max_workers=_MAX_THREADS, thread_name_prefix="api_limiter"
+            )
+        return __executor
@@ -0,0 +1,127 @@
+"""
+Enumeration of resources across an organization or folder, with one paginated
+Cloud Asset Inventory searchAllResources call per resource type,
+instead of listing project by project (and for GCE, zone by zone).
+
+Used when resource_search is True in the config.
+"""
+
+import json
+import logging
+import re
+from abc import ABCMeta, abstractmethod
+from typing import Dict, Generator, List, Optional, Tuple
+
+from util import gcp_utils, http_pool
+
+_PAGE_SIZE = 500
+
+# versionedResources holds the full resource as returned by its own API, where Cloud Asset supports that
+_READ_MASK = (
+    "name,assetType,project,location,labels,parentFullResourceName,versionedResources"
+)
+
+
+class AssetSearch(metaclass=ABCMeta):
+    @abstractmethod
+    def _search_page(
+        self, scope: str, asset_types: List[str], page_token: Optional[str]
+    ) -> Dict:
+        """:return one page of the searchAllResources response, a dict with results and nextPageToken"""
+        pass
+
+    def search(self, scope: str, asset_types: List[str]) -> Generator[Dict, None, None]:
+        """
+        :param scope: organizations/123, folders/123 or projects/my-project
+        :return search results for all resources of the given Cloud Asset types in the scope
+        """
+        for results, _ in self.search_pages(scope, asset_types):
+            yield from results
+
+    def search_pages(
+        self, scope: str, asset_types: List[str], page_token: Optional[str] = None
+    ) -> Generator[Tuple[List[Dict], Optional[str]], None, None]:
+        """As search, a page at a time, for checkpointing.
+        :return for each page, starting from page_token, the search results and the next page token
+        """
+        while True:
+            response = self._search_page(scope, asset_types, page_token)
+            page_token = response.get("nextPageToken")
+            yield response.get("results", []), page_token
+            if not page_token:
+                return
+
+
+class CloudAssetSearch(AssetSearch):
+    def __init__(self):
+        # Local import to avoid burdening AppEngine memory
+        from googleapiclient import discovery
+
+        self.__client = discovery.build("cloudasset", "v1")
+
+    def _search_page(self, scope, asset_types, page_token):
+        return http_pool.execute(
+            self.__client.v1().searchAllResources(
+                scope=scope,
+                assetTypes=asset_types,
+                pageSize=_PAGE_SIZE,
+                pageToken=page_token,
+                readMask=_READ_MASK,
+            )
+        )
+
+
+class LocalAssetSearch(AssetSearch):
+    """A stand-in for Cloud Asset Inventory, for tests and local development.
+    It serves the given search results, paginated like the real API, ignoring the scope.
+    """
+
+    def __init__(self, results: List[Dict], page_size: int = _PAGE_SIZE):
+        self.__results = results
+        self.__page_size = page_size
+        self.page_requests = 0
+
+    @classmethod
+    def from_json_lines(cls, path: str, page_size: int = _PAGE_SIZE):
+        with open(path) as f:
+            return cls([json.loads(line) for line in f if line.strip()], page_size)
+
+    def _search_page(self, scope, asset_types, page_token):
+        self.page_requests += 1
+        matching = [r for r in self.__results if r.get("assetType") in asset_types]
+        start = int(page_token or 0)
+        end = start + self.__page_size
+        response = {"results": matching[start:end]}
+        if end < len(matching):
+            response["nextPageToken"] = str(end)
+        return response
+
+
+__asset_search: Optional[AssetSearch] = None
+
+
+def get_asset_search() -> AssetSearch:
+    global __asset_search
+    if __asset_search is None:
+        __asset_search = CloudAssetSearch()
+    return __asset_search
+
+
+def set_asset_search(asset_search: AssetSearch):
+    """For example, to use LocalAssetSearch in testing"""
+    global __asset_search
+    __asset_search = asset_search
+
+
+def project_id_of(asset: Dict) -> Optional[str]:
+    """The search result gives the project number; but most resource names include the project id."""
+    match = re.match(r"//[^/]+/projects/([^/]+)/", asset.get("name", ""))
+    if match:
+        return match.group(1)
+    project = asset.get("project")  # projects/123456789
+    if project:
+        try:
+            return gcp_utils.project_id_from_number(project.split("/")[-1])
+        except Exception:
+            logging.exception("Cannot get project id for %s", project)
+    return None
@@ -0,0 +1,528 @@
+"""
+Pipelined writing of batched label requests.
+
+A plugin adds its requests to its BatchPipeline. When the current batch is full, it is handed to a bounded pool
+of flush threads, and a fresh batch starts filling, so that listing resources goes on during the round trip
+of the batch. At most _MAX_IN_FLIGHT batches per plugin are in flight; beyond that, add() waits,
+so that memory stays bounded. flush() sends the partial batch and waits for all in flight,
+as at the end of a label_all.
+
+With per_thread, as for the zone threads of GceZonalBase, each thread fills its own batch, without contention
+on a shared one; at its end, a thread merges its partial batch into the shared one with flush_thread().
+flush() also sends the batches of all threads, and forgets those of threads that have ended, so that a thread
+that did not call flush_thread() strands no requests, and leaves no buffer behind.
+
+The batch size adapts: It is halved after a batch that was rate-limited or had many errors,
+cut by a quarter after a slow batch, and otherwise grows back towards the maximum.
+
+Failures are handled per request in a batch, rather than waiting for the next cron to relabel:
+- Rate-limited (429) requests are requeued, with exponential backoff, into a later batch.
+- Requests that failed on a stale labelFingerprint (412), because the labels changed since the resource was listed,
+  are rebuilt by on_stale from a fresh read of just that resource, and put in a later batch.
+Each request is attempted up to _MAX_ATTEMPTS times; the rest of the failures are counted by status and logged.
+
+With a rate_limiter (see util.rate_limiter), requests are paced per API, operation and project:
+A request takes a slot when it is sent, not when it is added, so that a backlog does not book slots far ahead
+at a rate that may since have grown. A request that finds no free slot waits, in order, in a queue per limiter,
+from which a dispatcher thread sends it when a slot is free, as it also sends the retries when due.
+Each response feeds back into the rate.
+
+A label_all runs as the owner of the requests that it and its threads add (see owned_by), so that flush()
+waits only for those, up to the sweep's deadline; it returns the contexts of those not sent by then,
+for the sweep's checkpoint.
+"""
+
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+from util import config_utils, gcp_utils, http_pool
+from util.rate_limiter import AimdRateLimiter
+
+_MIN_BATCH_SIZE = 50
+_BATCH_SIZE_STEP = 100
+# A batch taking longer than this is taken as a sign of overload
+_SLOW_BATCH_SECONDS = 30
+_MAX_ERROR_RATE = 0.1
+_MAX_IN_FLIGHT = 2
+# Per request, including the first
+_MAX_ATTEMPTS = 3
+_BACKOFF_SECONDS = 2
+_MAX_BACKOFF_SECONDS = 30
+# Bounds on how long the dispatcher sleeps until the next slot or retry is due
+_MIN_DISPATCH_PAUSE_SECONDS = 0.05
+_MAX_DISPATCH_PAUSE_SECONDS = 1.0
+# How often flush() checks whether the dispatcher has sent the requests it waits for
+_FLUSH_POLL_SECONDS = 0.1
+
+# Called for each response in a batch, with the request ID, the response, and the exception, if any
+ResponseCallback = Callable[[str, object, Optional[Exception]], None]
+# Given the context of a request that failed on a stale labelFingerprint,
+# return a request built from a fresh read of the resource, or None if there is nothing to retry
+StaleHandler = Callable[[Any], Optional[object]]
+# Given the context of a request, return the rate limiter for it, or None
+RateLimiterGetter = Callable[[Any], Optional[AimdRateLimiter]]
+
+_executor_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+class _Item(NamedTuple):
+    request: object
+    context: Any
+    # Counting from 0
+    attempt: int
+    # See owned_by
+    owner: Any
+
+
+class _Buffer:
+    """The requests of the batch now filling"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items: List[_Item] = []
+
+
+class _Batch:
+    """A batch being sent, with what is needed to retry its requests"""
+
+    def __init__(self, items: List[_Item]):
+        self.items = items
+        # Request ID to item
+        self.requests: Dict[str, _Item] = {}
+        self.errors = 0
+        self.throttled = 0
+        # (is_stale, item for the next attempt) for each request to retry
+        self.retries: List[Tuple[bool, _Item]] = []
+
+
+class BatchPipeline:
+    def __init__(
+        self,
+        name: str,
+        new_batch: Callable[[ResponseCallback], object],
+        on_response: ResponseCallback,
+        max_batch_size: int,
+        on_stale: Optional[StaleHandler] = None,
+        per_thread: bool = False,
+        rate_limiter: Optional[RateLimiterGetter] = None,
+    ):
+        """
+        :param new_batch: Given a callback, return a new BatchHttpRequest that calls it for each response
+        :param on_response: Called for each final response, i.e., not for those that are retried
+        :param per_thread: Whether each thread fills its own batch, so that threads adding at once
+         do not contend; then each thread should call flush_thread() when done
+        :param rate_limiter: For requests with a context; a request that comes before its rate allows
+         waits to be sent by the dispatcher, rather than blocking the caller
+        """
+        self.name = name
+        self.__new_batch = new_batch
+        self.__on_response = on_response
+        self.__on_stale = on_stale
+        self.__per_thread = per_thread
+        self.__rate_limiter = rate_limiter
+        self.max_batch_size = max_batch_size
+        self.batch_size = max_batch_size
+        self.__lock = threading.Lock()
+        # The shared buffer, and with per_thread, thread ID to the buffer of that thread
+        self.__shared = _Buffer()
+        self.__buffers: Dict[threading.Thread, _Buffer] = {}
+        # Batches in flight, with their items
+        self.__in_flight: Dict[Future, List[_Item]] = {}
+        self.__slots = threading.BoundedSemaphore(_MAX_IN_FLIGHT)
+        # Heap of (due time, sequence number, item), for requests to retry
+        self.__delayed: List[Tuple[float, int, _Item]] = []
+        self.__sequence = itertools.count()
+        # Requests that wait for a slot, in order, by limiter
+        self.__waiting: Dict[AimdRateLimiter, Deque[_Item]] = {}
+        self.__dispatcher: Optional[threading.Thread] = None
+        # The items that the dispatcher took from the queues, and is submitting
+        self.__dispatching: List[_Item] = []
+        self.__owner = threading.local()
+        self.__failures: Counter = Counter()
+
+    @property
+    def pending(self) -> int:
+        """The number of requests in the batches now filling"""
+        with self.__lock:
+            buffers = [self.__shared, *self.__buffers.values()]
+        return sum(len(b.items) for b in buffers)
+
+    @property
+    def owner(self) -> Any:
+        """The owner of the requests that the calling thread adds, if any; see owned_by"""
+        return getattr(self.__owner, "owner", None)
+
+    @contextmanager
+    def owned_by(self, owner: Any):
+        """Within this, the requests that the calling thread adds belong to owner, for flush()"""
+        previous = self.owner
+        self.__owner.owner = owner
+        try:
+            yield
+        finally:
+            self.__owner.owner = previous
+
+    def add(self, request, context: Any = None):
+        """
+        :param context: If the request fails with a stale labelFingerprint, this is passed to on_stale;
+         and it is passed to rate_limiter
+        """
+        item = _Item(request, context, 0, self.owner)
+        if not self.__admit(item):
+            return
+        buffer = self.__buffer()
+        with buffer.lock:  # With per_thread, never contended but by flush()
+            buffer.items.append(item)
+            full = self.__take(buffer) if len(buffer.items) >= self.batch_size else None
+        if full:
+            self.__submit(full)
+
+    def flush_thread(self):
+        """With per_thread, for when the calling thread is done adding: Merge its partial batch into the shared one"""
+        if not self.__per_thread:
+            return
+        with self.__lock:
+            buffer = self.__buffers.pop(threading.current_thread(), None)
+        if buffer is None:
+            return
+        with buffer.lock:
+            items = self.__take(buffer)
+        fulls = []
+        with self.__shared.lock:
+            for item in items:
+                self.__shared.items.append(item)
+                if len(self.__shared.items) >= self.batch_size:
+                    fulls.append(self.__take(self.__shared))
+        for full in fulls:
+            self.__submit(full)
+
+    def flush(self, deadline: Optional[float] = None, owner: Any = None) -> List[Any]:
+        """
+        Send the batches now filling, and wait for all batches in flight, and for those requests of owner
+        (see owned_by) that wait for a rate-limit slot or a retry, until deadline, if any.
+        :return the contexts of owner's requests not sent by the deadline, which are dropped from the pipeline
+        """
+        with self.__lock:
+            buffers = [self.__shared, *self.__buffers.values()]
+            for thread in [t for t in self.__buffers if not t.is_alive()]:
+                del self.__buffers[
+                    thread
+                ]  # It adds no more, and its items are sent below
+        items = []
+        for buffer in buffers:
+            with buffer.lock:
+                items.extend(self.__take(buffer))
+        for i in range(0, len(items), self.batch_size):
+            self.__submit(items[i : i + self.batch_size])
+        unsent = []
+        while True:
+            self.wait()
+            with self.__lock:
+                if not any(item.owner is owner for item in self.__pending_items()):
+                    break
+                if deadline is not None and time.time() >= deadline:
+                    unsent = self.__drop_queued(owner)
+                    break
+            time.sleep(_FLUSH_POLL_SECONDS)  # While the dispatcher sends them
+        self.__log_failures()
+        if unsent:
+            logging.info(
+                "%d requests for %s not sent by the deadline", len(unsent), self.name
+            )
+        return [item.context for item in unsent if item.context is not None]
+
+    def wait(self):
+        """Wait for the batches now in flight"""
+        with self.__lock:
+            in_flight = list(self.__in_flight)
+        for future in in_flight:
+            future.result()  # __execute logs rather than raising
+
+    def failures(self) -> Dict[str, int]:
+        """Counts, by HTTP status, of requests that failed after all retries, since the last flush()"""
+        with self.__lock:
+            return dict(self.__failures)
+
+    def __limiter(self, context) -> Optional[AimdRateLimiter]:
+        if self.__rate_limiter is None or context is None:
+            return None
+        return self.__rate_limiter(context)
+
+    def __admit(self, item: _Item, first: bool = False) -> bool:
+        """
+        :param first: Whether the item goes to the front of the queue, as for a retry
+        :return True if the item may be sent now, having taken a slot, if it needs one;
+         else it waits in the queue of its limiter
+        """
+        limiter = self.__limiter(item.context)
+        if limiter is None:
+            return True
+        with self.__lock:
+            queue = self.__waiting.get(limiter)
+            if not queue and limiter.try_acquire():
+                return True
+            if queue is None:
+                queue = self.__waiting[limiter] = deque()
+            if first:
+                queue.appendleft(item)
+            else:
+                queue.append(item)
+            self.__start_dispatcher()
+        return False
+
+    def __schedule(self, delay: float, item: _Item):
+        with self.__lock:
+            heapq.heappush(
+                self.__delayed, (time.time() + delay, next(self.__sequence), item)
+            )
+            self.__start_dispatcher()
+
+    def __pending_items(self) -> List[_Item]:
+        """Call only under the lock. :return the items waiting for a slot or a retry, or on their way to be sent"""
+        return (
+            [d[2] for d in self.__delayed]
+            + [item for queue in self.__waiting.values() for item in queue]
+            + self.__dispatching
+            + [item for items in self.__in_flight.values() for item in items]
+        )
+
+    def __drop_queued(self, owner) -> List[_Item]:
+        """Call only under the lock. :return owner's items waiting for a slot or a retry, removed"""
+        dropped = [d[2] for d in self.__delayed if d[2].owner is owner]
+        self.__delayed = [d for d in self.__delayed if d[2].owner is not owner]
+        heapq.heapify(self.__delayed)
+        for limiter, queue in list(self.__waiting.items()):
+            dropped.extend(item for item in queue if item.owner is owner)
+            kept = deque(item for item in queue if item.owner is not owner)
+            if kept:
+                self.__waiting[limiter] = kept
+            else:
+                del self.__waiting[limiter]
+        return dropped
+
+    def __start_dispatcher(self):
+        """Call only under the lock"""
+        if self.__dispatcher is None:
+            self.__dispatcher = threading.Thread(
+                target=self.__dispatch, name=f"{self.name}_dispatcher", daemon=True
+            )
+            self.__dispatcher.start()
+
+    def __dispatch(self):
+        """Send the requests waiting for a slot, as slots come free, and the retries, when due.
+        Stops when none are left, to be started again by __start_dispatcher"""
+        while True:
+            due = self.__due()
+            items = [item for item in due if self.__admit(item, first=True)]
+            with self.__lock:
+                for limiter, queue in list(self.__waiting.items()):
+                    while queue and limiter.try_acquire():
+                        items.append(queue.popleft())
+                    if not queue:
+                        del self.__waiting[limiter]
+                self.__dispatching = items
+            for i in range(0, len(items), self.batch_size):
+                self.__submit(items[i : i + self.batch_size])
+            with self.__lock:
+                self.__dispatching = []
+                if not self.__delayed and not self.__waiting:
+                    self.__dispatcher = None
+                    return
+                now = time.time()
+                pause = min(
+                    [d[0] - now for d in self.__delayed[:1]]
+                    + [limiter.wait_seconds() for limiter in self.__waiting]
+                )
+            time.sleep(
+                min(
+                    _MAX_DISPATCH_PAUSE_SECONDS, max(_MIN_DISPATCH_PAUSE_SECONDS, pause)
+                )
+            )
+
+    def __buffer(self) -> _Buffer:
+        if not self.__per_thread:
+            return self.__shared
+        thread = threading.current_thread()
+        buffer = self.__buffers.get(thread)
+        if buffer is None:
+            with self.__lock:
+                buffer = self.__buffers[thread] = _Buffer()
+        return buffer
+
+    @staticmethod
+    def __take(buffer: _Buffer) -> List[_Item]:
+        """Call only under the lock of the buffer. :return its items, and empty it"""
+        items = buffer.items
+        buffer.items = []
+        return items
+
+    def __due(self) -> List[_Item]:
+        """:return the retries that are due, removed from the heap, and counted as dispatching"""
+        now = time.time()
+        due = []
+        with self.__lock:
+            while self.__delayed and self.__delayed[0][0] <= now:
+                due.append(heapq.heappop(self.__delayed)[2])
+            self.__dispatching = list(due)
+        return due
+
+    def __submit(self, items: List[_Item]):
+        self.__slots.acquire()  # Backpressure on the caller, while too many batches are in flight
+        future = _get_executor().submit(self.__execute, _Batch(items))
+        with self.__lock:
+            self.__in_flight[future] = items
+        future.add_done_callback(self.__done)
+
+    def __done(self, future: Future):
+        with self.__lock:
+            del self.__in_flight[future]
+        self.__slots.release()
+
+    def __execute(self, batch: _Batch):
+        start = time.time()
+        count = len(batch.items)
+        try:
+            http_batch = self.__new_batch(self.__callback(batch))
+            for item in batch.items:
+                request_id = gcp_utils.generate_uuid()
+                http_batch.add(item.request, request_id=request_id)
+                batch.requests[request_id] = item
+            with http_pool.checkout() as http:
+                http_batch.execute(http=http)
+        except Exception:
+            logging.exception(
+                "Exception executing batch of %d for %s", count, self.name
+            )
+            batch.errors = count
+        self.__adapt(count, batch, time.time() - start)
+        self.__retry(batch.retries)
+
+    def __callback(self, batch: _Batch) -> ResponseCallback:
+        def callback(request_id, response, exception):
+            item = batch.requests.pop(request_id)
+            context, attempt = item.context, item.attempt
+            limiter = self.__limiter(context)
+            if exception is None:
+                if limiter is not None:
+                    limiter.on_success()
+            else:
+                batch.errors += 1
+                is_throttled = _is_throttled(exception)
+                if is_throttled:
+                    batch.throttled += 1
+                    if limiter is not None:
+                        limiter.on_throttled()
+                if attempt + 1 < _MAX_ATTEMPTS:
+                    if is_throttled:
+                        batch.retries.append(
+                            (False, item._replace(attempt=attempt + 1))
+                        )
+                        return
+                    if _is_stale(exception) and self.__on_stale and context is not None:
+                        batch.retries.append(
+                            (True, item._replace(request=None, attempt=attempt + 1))
+                        )
+                        return
+                with self.__lock:
+                    self.__failures[str(_status(exception) or "other")] += 1
+            self.__on_response(request_id, response, exception)
+
+        return callback
+
+    def __retry(self, retries: List[Tuple[bool, _Item]]):
+        """Requeue rate-limited requests with backoff; rebuild requests with a stale labelFingerprint from a fresh read.
+        Either way, a retry takes a rate-limit slot when it is sent"""
+        for is_stale, item in retries:
+            if is_stale:
+                try:
+                    request = self.__on_stale(item.context)
+                except Exception:
+                    logging.exception("Cannot retry a request for %s", self.name)
+                    request = None
+                if request is None:
+                    continue
+                item = item._replace(request=request)
+                delay = 0.0
+            else:
+                backoff = min(
+                    _MAX_BACKOFF_SECONDS, _BACKOFF_SECONDS * 2 ** (item.attempt - 1)
+                )
+                delay = backoff * random.uniform(0.5, 1.0)
+            self.__schedule(delay, item)
+        if retries:
+            logging.info(
+                "Retrying %d requests for %s: %d with a stale fingerprint",
+                len(retries),
+                self.name,
+                sum(1 for r in retries if r[0]),
+            )
+
+    def __adapt(self, count: int, batch: _Batch, duration: float):
+        with self.__lock:
+            before = self.batch_size
+            floor = min(_MIN_BATCH_SIZE, self.max_batch_size)
+            if batch.throttled or batch.errors > _MAX_ERROR_RATE * count:
+                self.batch_size = max(floor, before // 2)
+            elif duration > _SLOW_BATCH_SECONDS:
+                self.batch_size = max(floor, before * 3 // 4)
+            else:
+                self.batch_size = min(self.max_batch_size, before + _BATCH_SIZE_STEP)
+            after = self.batch_size
+        if after < before:
+            logging.info(
+                "Batch size for %s down from %d to %d: batch of %d took %.1f s, %d errors, %d rate-limited",
+                self.name,
+                before,
+                after,
+                count,
+                duration,
+                batch.errors,
+                batch.throttled,
+            )
+
+    def __log_failures(self):
+        with self.__lock:
+            failures = dict(self.__failures)
+            self.__failures.clear()
+        if failures:
+            logging.info(
+                "Requests for %s that failed after retries, by status: %s",
+                self.name,
+                failures,
+            )
+
+
+def _status(exception: Exception) -> Optional[int]:
+    status = getattr(getattr(exception, "resp", None), "status", None)
+    try:
+        return int(status) if status is not None else None
+    except ValueError:
+        return None
+
+
+def _is_stale(exception: Exception) -> bool:
+    return _status(exception) == 412 or "fingerprint" in str(exception).lower()
+
+
+def _is_throttled(exception: Exception) -> bool:
+    return _status(exception) == 429 or "rate limit" in str(exception).lower()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=config_utils.batch_flush_threads(),
+                thread_name_prefix="batch_flush",
+            )
+        return _executor
@@ -0,0 +1,111 @@
+"""
+Concurrent label updates, for plugins whose API writes labels with one call per resource, with no batching
+(PubSub, Cloud SQL). The calls run on a pool shared by these plugins, while listing goes on,
+with at most a given number in flight per project; beyond that, submit() waits, which slows the listing.
+Outcomes are counted per project, failures by exception type, and logged once, rather than a line per call;
+only failures are also logged one by one.
+"""
+
+import logging
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+_MAX_THREADS = 64
+
+__lock = threading.Lock()
+__executor: Optional[ThreadPoolExecutor] = None
+
+
+class ConcurrentUpdates:
+    def __init__(
+        self,
+        name: str,
+        update: Callable[[Dict, str, Dict], Any],
+        concurrency: Callable[[], int],
+        success: str = "updated",
+    ):
+        """
+        :param update: update(gcp_object, project_id, labels) makes the call; its return value is ignored
+        :param concurrency: the maximum calls in flight per project, read when a project is first seen
+        :param success: how successful calls are counted in the log, e.g., "submitted" for long-running operations
+        """
+        self.__name = name
+        self.__success = success
+        self.__update = update
+        self.__concurrency = concurrency
+        self.__lock = threading.Lock()
+        self.__slots: Dict[str, threading.BoundedSemaphore] = {}
+        self.__in_flight: List[Future] = []
+        # Project ID to counts of successes and of failures, by exception type
+        self.__outcomes: Dict[str, Counter] = defaultdict(Counter)
+
+    @property
+    def pending(self) -> int:
+        with self.__lock:
+            return len(self.__in_flight)
+
+    def submit(self, gcp_object: Dict, project_id: str, labels: Dict):
+        with self.__lock:
+            slots = self.__slots.get(project_id)
+            if slots is None:
+                slots = self.__slots[project_id] = threading.BoundedSemaphore(
+                    self.__concurrency()
+                )
+        slots.acquire()  # Backpressure on the listing, per project
+        future = _get_executor().submit(
+            self.__update_and_count, gcp_object, project_id, labels
+        )
+        with self.__lock:
+            self.__in_flight.append(future)
+
+        def done(f):
+            with self.__lock:
+                self.__in_flight.remove(f)
+            slots.release()
+
+        future.add_done_callback(done)
+
+    def wait(self):
+        """Wait for the calls in flight, and log their outcomes"""
+        with self.__lock:
+            in_flight = list(self.__in_flight)
+        for future in in_flight:
+            future.result()  # __update_and_count does not raise
+        with self.__lock:
+            outcomes = dict(self.__outcomes)
+            self.__outcomes.clear()
+        for project_id, counts in outcomes.items():
+            succeeded = counts.pop(self.__success, 0)
+            logging.info(
+                "%s in %s: %d %s, %d failed %s",
+                self.__name,
+                project_id,
+                succeeded,
+                self.__success,
+                sum(counts.values()),
+                dict(counts) if counts else "",
+            )
+
+    def __update_and_count(self, gcp_object, project_id, labels):
+        try:
+            self.__update(gcp_object, project_id, labels)
+            outcome = self.__success
+        except Exception as e:
+            logging.warning(
+                "%s: Cannot update %s: %r", self.__name, gcp_object.get("name"), e
+            )
+            outcome = type(e).__name__
+        with self.__lock:
+            self.__outcomes[project_id][outcome] += 1
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global __executor
+    with __lock:
+        if __executor is None:
+            __executor = ThreadPoolExecutor(
+                max_workers=_MAX_THREADS, thread_name_prefix="concurrent_updates"
+            )
+        return __executor
@@ -1,23 +1,83 @@
-import functools
+import fnmatch
+import logging
 import os
 import re
 import sys
+import threading
+import time
 import typing
-from collections import defaultdict
+from types import MappingProxyType
 
 import yaml
 
+from util.detect_gae import detect_gae
+
+# How often to check whether the config file changed, for hot reload
+_RELOAD_CHECK_SECONDS = 5
+
+# Characters that make an entry in projects or excluded_projects a glob pattern rather than a project ID
+_GLOB_CHARS = re.compile(r"[*?\[]")
+
+_DEFAULT_API_CONCURRENCY = 64
+
+
+class CompiledConfig(typing.NamedTuple):
+    """
+    The config file, validated and precomputed once per load, so that the accessors on the labeling path,
+    called for every resource, do not re-read and re-check the raw dict.
+    Replaced as a whole on hot reload, never mutated.
+    """
+
+    raw: typing.Mapping
+    config_file: str
+    mtime: float
+    version: int
+    # Literal project IDs, and a regex for the glob patterns, if any, from projects
+    included_projects: typing.FrozenSet[str]
+    included_pattern: typing.Optional[typing.Pattern]
+    # Same, from excluded_projects
+    excluded_projects: typing.FrozenSet[str]
+    excluded_pattern: typing.Optional[typing.Pattern]
+    plugins: typing.Tuple[str, ...]
+    plugins_set: typing.FrozenSet[str]
+    from_project: bool
+    label_all_on_cron: bool
+    iris_prefix: str
+    specific_prefixes: typing.Mapping[str, typing.Optional[str]]
+    project_roots: typing.Tuple[str, ...]
+    resource_search: bool
+    project_labels_refresh_seconds: int
+    repropagate_project_labels: bool
+    rolling_partitions: int
+    rolling_partition_by: str
+    skip_cache_max_days: int
+    skip_cache_backend: str
+    skip_cache_path: str
+    do_label_time_budget_seconds: int
+    work_journal_path: str
+    work_journal_threads: int
+    batch_flush_threads: int
+    http_pool_size: int
+    label_engine: str
+    api_concurrency: typing.Mapping[str, int]
+    pubsub_update_concurrency: int
+    cloudsql_patch_concurrency: int
+    zone_regions: typing.Tuple[str, ...]
+    empty_zone_sweep_days: int
+    zone_occupancy_backend: str
+    zone_occupancy_path: str
+    lease_backend: str
+    lease_path: str
+    lease_ttl_seconds: int
+    lease_conflict: str
+
 
 def is_copying_labels_from_project() -> bool:
-    config = get_config()
-    from_project = config.get("from_project")
-    assert isinstance(from_project, bool), from_project
-    return from_project
+    return _compiled().from_project
 
 
 def iris_prefix() -> str:
-    config = get_config()
-    return config["iris_prefix"]
+    return _compiled().iris_prefix
 
 
 def iris_homepage_text():
@@ -25,41 +85,170 @@ def iris_homepage_text():
 
 
 def specific_prefix(resource_type) -> str:
-    config = get_config()
-    specific_prefixes = config.get("specific_prefixes", {})
-    return specific_prefixes.get(resource_type)
+    return _compiled().specific_prefixes.get(resource_type)
+
+
+def label_prefix(resource_type) -> str:
+    """The prefix, with its underscore separator, for the keys of labels on resource_type; may be empty"""
+    specific_pfx = specific_prefix(resource_type)
+    pfx = specific_pfx if specific_pfx is not None else iris_prefix()
+    return pfx + "_" if pfx else ""
 
 
 def is_project_enabled(project_id: str) -> bool:
-    enabled_projs = enabled_projects()
-    if enabled_projs:
-        return project_id in enabled_projs
-    else:
+    compiled = _compiled()
+    if __is_excluded(compiled, project_id):
+        return False
+    if not compiled.included_projects and not compiled.included_pattern:
         return True
+    return project_id in compiled.included_projects or bool(
+        compiled.included_pattern and compiled.included_pattern.match(project_id)
+    )
 
 
 def enabled_projects() -> typing.List[str]:
-    return get_config().get("projects")
+    """
+    The enabled projects, if they are listed by ID. Empty if all projects are enabled, or if
+    projects has glob patterns; then, list all projects and filter them with is_project_enabled.
+    """
+    compiled = _compiled()
+    if compiled.included_pattern:
+        return []
+    return sorted(
+        p for p in compiled.included_projects if not __is_excluded(compiled, p)
+    )
 
 
-def enabled_plugins() -> typing.List[str]:
-    config = get_config()
-    plugins = config.get("plugins")
+def __is_excluded(compiled: CompiledConfig, project_id: str) -> bool:
+    return project_id in compiled.excluded_projects or bool(
+        compiled.excluded_pattern and compiled.excluded_pattern.match(project_id)
+    )
+
+
+def project_roots() -> typing.List[str]:
+    return list(_compiled().project_roots)
 
-    assert all(re.match(r"[a-z]+", p) for p in plugins), plugins
-    return plugins
+
+def enabled_plugins() -> typing.List[str]:
+    return list(_compiled().plugins)
 
 
 def is_plugin_enabled(plugin) -> bool:
-    plugins = enabled_plugins()
-    return (plugin in plugins) if plugins else True
+    compiled = _compiled()
+    return (plugin in compiled.plugins_set) if compiled.plugins_set else True
 
 
 def label_all_on_cron() -> bool:
-    config = get_config()
-    ret = config.get("label_all_on_cron")
-    assert isinstance(ret, bool), ret
-    return ret
+    return _compiled().label_all_on_cron
+
+
+def resource_search() -> bool:
+    return _compiled().resource_search
+
+
+def project_labels_refresh_seconds() -> int:
+    return _compiled().project_labels_refresh_seconds
+
+
+def repropagate_project_labels() -> bool:
+    return _compiled().repropagate_project_labels
+
+
+def rolling_partitions() -> int:
+    """Number of days in a full rolling relabel cycle; 1 means relabel everything every day."""
+    return _compiled().rolling_partitions
+
+
+def rolling_partition_by() -> str:
+    return _compiled().rolling_partition_by
+
+
+def skip_cache_max_days() -> int:
+    """0 disables the skip cache"""
+    return _compiled().skip_cache_max_days
+
+
+def skip_cache_backend() -> str:
+    return _compiled().skip_cache_backend
+
+
+def skip_cache_path() -> str:
+    return _compiled().skip_cache_path
+
+
+def do_label_time_budget_seconds() -> int:
+    """0 means no limit"""
+    return _compiled().do_label_time_budget_seconds
+
+
+def work_journal_path() -> str:
+    """Empty means that do_label labels before acking, with no journal"""
+    return _compiled().work_journal_path
+
+
+def work_journal_threads() -> int:
+    return _compiled().work_journal_threads
+
+
+def batch_flush_threads() -> int:
+    return _compiled().batch_flush_threads
+
+
+def http_pool_size() -> int:
+    return _compiled().http_pool_size
+
+
+def label_engine() -> str:
+    return _compiled().label_engine
+
+
+def api_concurrency(api: str) -> int:
+    """The maximum concurrent calls to the API, like compute, with the api_limited label_engine"""
+    return _compiled().api_concurrency.get(api, _DEFAULT_API_CONCURRENCY)
+
+
+def pubsub_update_concurrency() -> int:
+    """The maximum concurrent label updates of PubSub Topics or Subscriptions, per project, in label_all"""
+    return _compiled().pubsub_update_concurrency
+
+
+def cloudsql_patch_concurrency() -> int:
+    """The maximum concurrent label patches of Cloud SQL instances, per project, in label_all"""
+    return _compiled().cloudsql_patch_concurrency
+
+
+def zone_regions() -> typing.List[str]:
+    """Empty means all regions"""
+    return list(_compiled().zone_regions)
+
+
+def empty_zone_sweep_days() -> int:
+    """0 means that all zones are swept on every run"""
+    return _compiled().empty_zone_sweep_days
+
+
+def zone_occupancy_backend() -> str:
+    return _compiled().zone_occupancy_backend
+
+
+def zone_occupancy_path() -> str:
+    return _compiled().zone_occupancy_path
+
+
+def lease_backend() -> str:
+    return _compiled().lease_backend
+
+
+def lease_path() -> str:
+    return _compiled().lease_path
+
+
+def lease_ttl_seconds() -> int:
+    return _compiled().lease_ttl_seconds
+
+
+def lease_conflict() -> str:
+    return _compiled().lease_conflict
 
 
 def pubsub_token() -> str:
@@ -70,28 +259,84 @@ def pubsub_token() -> str:
 
 
 def get_config_redact_token():
-    c = get_config().copy()
+    c = dict(get_config())
     c["pubsub_verification_token"] = "[REDACTED]"
     return c
 
 
-@functools.lru_cache
-def get_config() -> typing.Dict:
+def get_config() -> typing.Mapping:
+    """The raw config, read-only"""
+    return _compiled().raw
+
+
+def config_version() -> int:
+    """Incremented on each reload of the config file, for invalidating values computed from it"""
+    return _compiled().version
+
+
+__compiled: typing.Optional[CompiledConfig] = None
+__checked_at = 0.0
+__reload_lock = threading.Lock()
+
+
+def _compiled() -> CompiledConfig:
+    """
+    The current CompiledConfig. At most every _RELOAD_CHECK_SECONDS, checks whether the config file changed,
+    and if so, loads and compiles it again and swaps it in. An invalid new config is logged and ignored.
+    """
+    global __compiled, __checked_at
+    compiled = __compiled
+    if compiled is not None and time.time() < __checked_at + _RELOAD_CHECK_SECONDS:
+        return compiled
+    with __reload_lock:
+        if (
+            __compiled is not None
+            and time.time() < __checked_at + _RELOAD_CHECK_SECONDS
+        ):
+            return __compiled  # Another thread checked while we waited for the lock
+        __checked_at = time.time()
+        config_name = __config_file_name()
+        if __compiled is None:
+            __compiled = __load(config_name, version=1)
+        elif (
+            config_name != __compiled.config_file
+            or __mtime(config_name) != __compiled.mtime
+        ):
+            try:
+                __compiled = __load(config_name, version=__compiled.version + 1)
+                logging.info(
+                    "Reloaded %s, config version %d", config_name, __compiled.version
+                )
+            except Exception:
+                logging.exception("Cannot reload %s; keeping the config", config_name)
+        return __compiled
+
+
+def __config_file_name() -> str:
     dev_config = "config-dev.yaml"
     test_config = "config-test.yaml"
     prod_config = "config.yaml"
 
     if os.path.isfile(dev_config):
-        config_name = dev_config
+        return dev_config
 
     elif os.path.isfile(test_config):
-        config_name = test_config
+        return test_config
 
     else:
-        config_name = prod_config
+        return prod_config
+
+
+def __mtime(config_name: str) -> float:
+    try:
+        return os.path.getmtime(config_name)
+    except OSError:
+        return 0.0
 
-    print("Using", config_name, file=sys.stderr)  # logging not yet enabled
 
+def __load(config_name: str, version: int) -> CompiledConfig:
+    print("Using", config_name, file=sys.stderr)  # logging may not yet be enabled
+    mtime = __mtime(config_name)
     try:
         with open(config_name) as config_file:
             config = yaml.full_load(config_file)
@@ -100,8 +345,146 @@ def get_config() -> typing.Dict:
             f"Could not find the config-*.yaml file, specifically {config_name}"
         )
     config["config_file"] = config_name
+    return _compile(config, mtime, version)
+
+
+def _compile(
+    config: typing.Dict, mtime: float = 0.0, version: int = 1
+) -> CompiledConfig:
+    included_projects, included_pattern = __compile_projects(
+        config.get("projects") or []
+    )
+    excluded_projects, excluded_pattern = __compile_projects(
+        config.get("excluded_projects") or []
+    )
+
+    plugins = tuple(config.get("plugins") or [])
+    assert all(re.match(r"[a-z]+", p) for p in plugins), plugins
+
+    from_project = config.get("from_project")
+    assert isinstance(from_project, bool), from_project
+    label_all = config.get("label_all_on_cron")
+    assert isinstance(label_all, bool), label_all
+    general_pfx = config["iris_prefix"]
+    assert general_pfx is not None
+
+    project_roots = tuple(config.get("project_roots") or [])
+    assert all(
+        re.match(r"(organizations|folders)/\d+$", r) for r in project_roots
+    ), f"project_roots should be like organizations/123 or folders/123, was {project_roots}"
+    api_concurrency = dict(config.get("api_concurrency") or {})
+    assert all(__is_positive_int(v) for v in api_concurrency.values()), api_concurrency
+    # If not set, shared by all instances on App Engine, where redeliveries and overlapping runs
+    # land on various instances
+    lease_backend = config.get("lease_backend") or (
+        "memcache" if detect_gae() else "memory"
+    )
+    assert lease_backend in ("none", "memory", "file", "memcache"), lease_backend
+    zone_regions = tuple(config.get("zone_regions") or [])
+    assert all(re.match(r"[a-z]+-[a-z]+\d+$", r) for r in zone_regions), zone_regions
+
+    return CompiledConfig(
+        raw=MappingProxyType(config),
+        config_file=config["config_file"],
+        mtime=mtime,
+        version=version,
+        included_projects=included_projects,
+        included_pattern=included_pattern,
+        excluded_projects=excluded_projects,
+        excluded_pattern=excluded_pattern,
+        plugins=plugins,
+        plugins_set=frozenset(plugins),
+        from_project=from_project,
+        label_all_on_cron=label_all,
+        iris_prefix=general_pfx,
+        specific_prefixes=MappingProxyType(dict(config.get("specific_prefixes") or {})),
+        project_roots=project_roots,
+        resource_search=__get(config, "resource_search", False, __is_bool),
+        project_labels_refresh_seconds=__get(
+            config, "project_labels_refresh_seconds", 6 * 60 * 60, __is_positive_int
+        ),
+        repropagate_project_labels=__get(
+            config, "repropagate_project_labels", False, __is_bool
+        ),
+        rolling_partitions=__get(config, "rolling_partitions", 1, __is_positive_int),
+        rolling_partition_by=__get(
+            config, "rolling_partition_by", "project", ("project", "resource")
+        ),
+        skip_cache_max_days=__get(
+            config, "skip_cache_max_days", 32, __is_non_negative_int
+        ),
+        skip_cache_backend=__get(
+            config, "skip_cache_backend", "memcache", ("memcache", "local")
+        ),
+        skip_cache_path=config.get("skip_cache_path") or "",
+        do_label_time_budget_seconds=__get(
+            config, "do_label_time_budget_seconds", 45, __is_non_negative_int
+        ),
+        work_journal_path=config.get("work_journal_path") or "",
+        work_journal_threads=__get(
+            config, "work_journal_threads", 4, __is_positive_int
+        ),
+        batch_flush_threads=__get(config, "batch_flush_threads", 4, __is_positive_int),
+        http_pool_size=__get(config, "http_pool_size", 16, __is_positive_int),
+        label_engine=__get(
+            config, "label_engine", "threads", ("threads", "api_limited")
+        ),
+        api_concurrency=MappingProxyType(api_concurrency),
+        pubsub_update_concurrency=__get(
+            config, "pubsub_update_concurrency", 16, __is_positive_int
+        ),
+        cloudsql_patch_concurrency=__get(
+            config, "cloudsql_patch_concurrency", 10, __is_positive_int
+        ),
+        zone_regions=zone_regions,
+        empty_zone_sweep_days=__get(
+            config, "empty_zone_sweep_days", 7, __is_non_negative_int
+        ),
+        zone_occupancy_backend=__get(
+            config, "zone_occupancy_backend", "memcache", ("memcache", "local")
+        ),
+        zone_occupancy_path=config.get("zone_occupancy_path") or "",
+        lease_backend=lease_backend,
+        lease_path=config.get("lease_path") or "/tmp/iris_leases",
+        lease_ttl_seconds=__get(config, "lease_ttl_seconds", 120, __is_positive_int),
+        lease_conflict=__get(config, "lease_conflict", "skip", ("skip", "wait")),
+    )
+
+
+def __get(
+    config: typing.Dict,
+    key: str,
+    default,
+    valid: typing.Union[typing.Callable[[typing.Any], bool], typing.Tuple],
+):
+    """:param valid: a check of the value, or its allowed values"""
+    ret = config.get(key, default)
+    assert valid(ret) if callable(valid) else ret in valid, f"{key}: {ret}"
+    return ret
+
+
+def __is_bool(v) -> bool:
+    return isinstance(v, bool)
+
+
+def __is_positive_int(v) -> bool:
+    return isinstance(v, int) and v > 0
+
+
+def __is_non_negative_int(v) -> bool:
+    return isinstance(v, int) and v >= 0
+
 
-    return config
+def __compile_projects(
+    entries: typing.List[str],
+) -> typing.Tuple[typing.FrozenSet[str], typing.Optional[typing.Pattern]]:
+    """:return the literal project IDs, and one regex matching any of the glob patterns, or None"""
+    literals = frozenset(e for e in entries if not _GLOB_CHARS.search(e))
+    globs = [e for e in entries if _GLOB_CHARS.search(e)]
+    pattern = (
+        re.compile("|".join(fnmatch.translate(g) for g in globs)) if globs else None
+    )
+    return literals, pattern
 
 
 def is_test_or_dev_configuration():
@@ -0,0 +1,126 @@
+"""
+Labeling from a Cloud Asset Inventory export: A newline-delimited JSON file, with one resource per line,
+as written by `gcloud asset export --content-type=resource --output-path=gs://...`.
+
+The export is streamed from a gs:// object, so memory stays bounded however large it is.
+Local paths are accepted only with allow_local, for local development: The server must not open
+arbitrary local files named in a message.
+Each record is routed to the plugin for its asset type, which labels it from the exported data,
+without reading the resource again.
+"""
+
+import json
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Dict, Generator, Optional, TextIO
+
+from util.gcp_utils import add_loaded_lib
+from util.utils import shorten
+
+# Per plugin. When a plugin's queue is full, reading the export waits, so that memory stays bounded.
+_QUEUE_SIZE = 1000
+
+_END = object()
+
+
+@contextmanager
+def open_export(uri: str, allow_local: bool = False) -> Generator[TextIO, None, None]:
+    """:param uri: gs://bucket/object, or with allow_local, a local path"""
+    if uri.startswith("gs://"):
+        # Local import to avoid burdening AppEngine memory.
+        from google.cloud import storage
+
+        add_loaded_lib("storage")
+        bucket_name, _, blob_name = uri[len("gs://") :].partition("/")
+        blob = storage.Client().bucket(bucket_name).blob(blob_name)
+        with blob.open("r") as f:  # Streams in chunks rather than downloading all
+            yield f
+    elif allow_local:
+        with open(uri) as f:
+            yield f
+    else:
+        raise ValueError(f"Export URI should be gs://bucket/object, was {uri}")
+
+
+def read_assets(f: TextIO) -> Generator[Dict, None, None]:
+    """:return the export records, converted to the form of Cloud Asset search results"""
+    for line_num, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            logging.error("Cannot parse line %d of export: %s", line_num, shorten(line))
+            continue
+        asset = asset_from_export_record(record)
+        if asset is not None:
+            yield asset
+
+
+def asset_from_export_record(record: Dict) -> Optional[Dict]:
+    resource = record.get("resource")
+    if not resource or "data" not in resource:
+        return None  # Exported with a content-type other than resource
+    data = resource["data"]
+    return {
+        "name": record["name"],
+        # Exports use snake_case; accept camelCase too
+        "assetType": record.get("asset_type") or record.get("assetType"),
+        "location": resource.get("location"),
+        "labels": data.get("labels", {}),
+        "versionedResources": [{"version": resource.get("version"), "resource": data}],
+    }
+
+
+def label_from_export(
+    uri: str, plugins_by_asset_type: Dict, allow_local: bool = False
+) -> Dict[str, int]:
+    """
+    Each plugin gets its own thread with a bounded queue, so that plugins label in parallel,
+    while each plugin, which is not thread-safe, labels serially.
+    :param plugins_by_asset_type: Cloud Asset type to the Plugin instance that labels it
+    :param allow_local: Accept a local path as uri, as for local development
+    :return count of records by asset type
+    """
+    queues = {}
+    threads = []
+
+    def drain(plugin, q):
+        while True:
+            asset = q.get()
+            if asset is _END:
+                break
+            try:
+                plugin.label_asset(asset)
+            except Exception:
+                logging.exception("")
+        if plugin.counter > 0:
+            plugin.do_batch()
+
+    for plugin in set(plugins_by_asset_type.values()):
+        q = queue.Queue(maxsize=_QUEUE_SIZE)
+        queues[plugin] = q
+        t = threading.Thread(target=drain, args=(plugin, q), daemon=True)
+        t.start()
+        threads.append(t)
+
+    counts = {}
+    try:
+        with open_export(uri, allow_local) as f:
+            for asset in read_assets(f):
+                asset_type = asset["assetType"]
+                plugin = plugins_by_asset_type.get(asset_type)
+                if plugin is None:
+                    continue  # Unsupported type, or plugin not enabled
+                counts[asset_type] = counts.get(asset_type, 0) + 1
+                queues[plugin].put(asset)  # Blocks while the plugin is behind
+    finally:
+        for q in queues.values():
+            q.put(_END)
+        for t in threads:
+            t.join()
+
+    logging.info("label_from_export %s: %s", uri, counts)
+    return counts
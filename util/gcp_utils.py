@@ -1,18 +1,22 @@
 import logging
 import os
 import re
+import time
 import uuid
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, Any, Generator
+from functools import lru_cache
+from typing import Dict, Any, List
 from zoneinfo import ZoneInfo
 
 from google.appengine.api.runtime import memory_usage
 
-from util import localdev_config, utils
+from util import localdev_config, utils, config_utils
 from util.detect_gae import detect_gae
-from util.utils import timed_lru_cache, log_time, dict_to_camelcase, sort_dict
+from util.ttl_cache import ttl_cache
+from util.utils import log_time, dict_to_camelcase, sort_dict
 
 __invocation_count = Counter()
 
@@ -62,27 +66,107 @@ def is_appscript_project(p) -> bool:
     return bool(re.match(r"sys-\d{26}", p))
 
 
-# Not cached. Returns a generator, and so not reusable
-def all_projects() -> Generator[str, Any, None]:
-    """All projects to which the current user has access"""
-    # Local import to avoid burdening AppEngine memory.
-    # Loading all Cloud Client libraries would be 100MB  means that
-    # the default AppEngine Instance crashes on out-of-memory even before actually serving a request.
-    from google.cloud import resourcemanager_v3
+_MAX_ENUMERATION_THREADS = 8
 
-    add_loaded_lib("resourcemanager_v3")
-    projects_client = resourcemanager_v3.ProjectsClient()
 
-    current_proj_id = current_project_id()
-    current_project = projects_client.get_project(
-        None, name=f"projects/{current_proj_id}"
-    )
-    parent_name = current_project.name
-    org_name = get_org(parent_name)
+def project_roots() -> List[str]:
+    """The organizations and folders whose projects Iris labels:
+    As configured in project_roots, or else the organization of the project where Iris runs.
+    """
+    roots = config_utils.project_roots()
+    if roots:
+        return __outermost(roots)
+    else:
+        return [get_org(f"projects/{current_project_id()}")]
+
+
+def __outermost(roots: List[str]) -> List[str]:
+    """:return the roots without duplicates, and without folders inside other roots,
+    whose projects would otherwise be listed or searched twice"""
+    unique = list(dict.fromkeys(roots))
+    if len(unique) < 2:
+        return unique
+    ret = []
+    for root in unique:
+        if root.startswith("folders/"):
+            try:
+                inside = next((a for a in folder_ancestors(root) if a in unique), None)
+            except Exception:
+                logging.exception("Cannot get the ancestors of %s", root)
+                inside = None
+            if inside is not None:
+                logging.info("Not using root %s, which is inside %s", root, inside)
+                continue
+        ret.append(root)
+    return ret
+
+
+@ttl_cache(ttl_seconds=600, maxsize=250, stale_seconds=600)
+def folder_ancestors(folder_name: str) -> List[str]:
+    """:return the folders and organization above folder_name, nearest first"""
+    folders_client = __create_folder_client()
+    ancestors = []
+    parent_name = folders_client.get_folder(None, name=folder_name).parent
+    while parent_name.startswith("folders/"):
+        ancestors.append(parent_name)
+        parent_name = folders_client.get_folder(None, name=parent_name).parent
+    ancestors.append(parent_name)
+    return ancestors
+
 
-    project_objects = projects_client.list_projects(parent=org_name)
-    projects = (p.project_id for p in project_objects)
-    return projects
+# Not cached.
+def all_projects() -> List[str]:
+    """
+    All projects under the project_roots, including those in nested folders, without duplicates.
+    Roots and folders are listed concurrently, so that adding roots adds little time.
+    """
+    projects_client = __create_project_client()
+    folders_client = __create_folder_client()
+
+    def list_children(parent):
+        project_ids = [
+            p.project_id for p in projects_client.list_projects(parent=parent)
+        ]
+        folder_names = [f.name for f in folders_client.list_folders(parent=parent)]
+        return project_ids, folder_names
+
+    roots = project_roots()
+    projects = set()
+    start = time.time()
+    pending_by_root = Counter()
+    projects_by_root = Counter()
+    with ThreadPoolExecutor(max_workers=_MAX_ENUMERATION_THREADS) as executor:
+        pending = {}
+        for root in roots:
+            pending[executor.submit(list_children, root)] = (root, root)
+            pending_by_root[root] += 1
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                root, parent = pending.pop(future)
+                pending_by_root[root] -= 1
+                try:
+                    project_ids, folder_names = future.result()
+                except Exception:
+                    logging.exception("Cannot list projects and folders in %s", parent)
+                else:
+                    projects.update(project_ids)
+                    projects_by_root[root] += len(project_ids)
+                    for folder_name in folder_names:
+                        pending[executor.submit(list_children, folder_name)] = (
+                            root,
+                            folder_name,
+                        )
+                        pending_by_root[root] += 1
+                if pending_by_root[root] == 0:
+                    logging.info(
+                        "Found %d projects in %s in %d ms",
+                        projects_by_root[root],
+                        root,
+                        int((time.time() - start) * 1000),
+                    )
+    return list(projects)
 
 
 def method_name(projects):
@@ -90,7 +174,7 @@ def method_name(projects):
 
 
 @log_time
-@timed_lru_cache(maxsize=250, seconds=600)
+@ttl_cache(ttl_seconds=600, maxsize=250, stale_seconds=600)
 def get_org(proj_name):
     projects_client = __create_project_client()
     folders_client = __create_folder_client()
@@ -139,13 +223,19 @@ def __create_project_client():
     return projects_client
 
 
-@timed_lru_cache(maxsize=200, seconds=600)
 def get_project(project_id: str) -> Dict[str, Any]:
+    """Not cached: Project labels are cached in util.project_labels"""
     proj = __create_project_client().get_project(name=f"projects/{project_id}")
     proj_as_dict = {"labels": proj.labels}  # This is the only key actually used
     return proj_as_dict
 
 
+@lru_cache(maxsize=1000)  # The id of a project never changes
+def project_id_from_number(project_number: str) -> str:
+    proj = __create_project_client().get_project(name=f"projects/{project_number}")
+    return proj.project_id
+
+
 def cloudclient_pb_objects_to_list_of_dicts(objects):
     return (cloudclient_pb_obj_to_dict(i) for i in objects)
 
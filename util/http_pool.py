@@ -0,0 +1,106 @@
+"""
+A bounded pool of authorized HTTP transports for the Google API (discovery) clients.
+
+httplib2.Http is not thread-safe, yet the discovery client of each plugin is shared by the zone threads,
+the batch flush threads and concurrent requests. So, requests are built from the shared client, which is safe,
+and executed on a transport checked out from this pool, used by one thread at a time.
+Each transport keeps its connections alive, so that later calls reuse a warm TLS connection
+rather than connecting again; the most recently returned transport is checked out first.
+At most http_pool_size transports are created; beyond that, checkout() waits for one to be returned,
+and raises TimeoutError after _CHECKOUT_TIMEOUT_SECONDS.
+The transports share one set of credentials, so that the token is fetched and refreshed once, not per transport.
+"""
+
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Generator, Optional
+
+from util import config_utils
+
+_SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+# Longer than any single call should take on a transport; beyond that, a transport is presumed lost
+_CHECKOUT_TIMEOUT_SECONDS = 300
+
+__lock = threading.Lock()
+__factory: Optional[Callable[[], Any]] = None
+__idle: "queue.LifoQueue" = queue.LifoQueue()
+__created = 0
+__credentials_lock = threading.Lock()
+__credentials = None
+
+
+@contextmanager
+def checkout() -> Generator[Any, None, None]:
+    """Yield a transport for the exclusive use of the caller, e.g., for BatchHttpRequest.execute(http=...)"""
+    http = __take()
+    try:
+        yield http
+    finally:
+        __idle.put(http)
+
+
+def execute(request) -> Any:
+    """Execute a request built from a discovery client, on a pooled transport"""
+    with checkout() as http:
+        return request.execute(http=http)
+
+
+def set_http_factory(factory: Optional[Callable[[], Any]]):
+    """For tests and benchmarks: Create transports with factory, or if None, as authorized transports.
+    Empties the pool."""
+    global __factory, __idle, __created
+    with __lock:
+        __factory = factory
+        __idle = queue.LifoQueue()
+        __created = 0
+
+
+def stats() -> Dict[str, int]:
+    with __lock:
+        return {"created": __created, "idle": __idle.qsize()}
+
+
+def __take():
+    global __created
+    try:
+        return __idle.get_nowait()
+    except queue.Empty:
+        pass
+    with __lock:
+        create = __created < config_utils.http_pool_size()
+        if create:
+            __created += 1
+        factory = __factory or __new_authorized_http
+    if create:
+        try:
+            return factory()
+        except Exception:
+            # Give the slot back, or else failures (e.g., of google.auth.default) would use up the pool
+            with __lock:
+                __created -= 1
+            raise
+    try:
+        return __idle.get(timeout=_CHECKOUT_TIMEOUT_SECONDS)
+    except queue.Empty:
+        raise TimeoutError(
+            f"No HTTP transport returned to the pool in {_CHECKOUT_TIMEOUT_SECONDS} s"
+        ) from None
+
+
+def __new_authorized_http():
+    # Local import to avoid burdening AppEngine memory
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.http import build_http
+
+    return AuthorizedHttp(__get_credentials(), http=build_http())
+
+
+def __get_credentials():
+    global __credentials
+    with __credentials_lock:
+        if __credentials is None:
+            import google.auth
+
+            __credentials, _ = google.auth.default(scopes=_SCOPES)
+        return __credentials
@@ -0,0 +1,90 @@
+"""
+Declarative label specs: Each plugin class maps label names to extractors, in its _label_specs.
+An extractor takes the resource (as a dict, as from the API) and returns the label value, or MISSING,
+in which case the label is not added. Most extractors are built with field(), from a path of keys
+and optional transforms, for example
+
+    _label_specs = {"zone": field("zone", transform=after_last("/"))}
+
+Fields are routinely absent, e.g. in objects built from Cloud Asset search results;
+extractors return MISSING rather than raising and logging an exception.
+"""
+
+from typing import Any, Callable, Dict, Optional
+
+Extractor = Callable[[Dict], Any]
+Transform = Callable[[Any], Any]
+
+
+class _Missing:
+    def __repr__(self):
+        return "MISSING"
+
+    def __bool__(self):
+        return False
+
+
+MISSING = _Missing()
+
+
+def field(*path: str, transform: Optional[Transform] = None) -> Extractor:
+    """
+    :param path: The keys leading to the value in nested dicts
+    :param transform: Applied to the value, if present
+    :return an extractor of the value at path
+    """
+    assert path
+    if len(path) == 1:
+        # The common case, without a loop
+        key = path[0]
+
+        def extract(gcp_object):
+            value = gcp_object.get(key)
+            if value is None:
+                return MISSING
+            return transform(value) if transform else value
+
+    else:
+
+        def extract(gcp_object):
+            value = gcp_object
+            for k in path:
+                if not isinstance(value, dict):
+                    return MISSING
+                value = value.get(k)
+            if value is None:
+                return MISSING
+            return transform(value) if transform else value
+
+    return extract
+
+
+def first_of(*extractors: Extractor) -> Extractor:
+    """:return an extractor of the first value that is not MISSING"""
+
+    def extract(gcp_object):
+        for e in extractors:
+            value = e(gcp_object)
+            if value is not MISSING:
+                return value
+        return MISSING
+
+    return extract
+
+
+def after_last(separator: str) -> Transform:
+    """:return a transform to the part of a string after the last separator, e.g. a zone from its URL"""
+    return lambda s: s[s.rfind(separator) + 1 :]
+
+
+def lower(s: str) -> str:
+    return s.lower()
+
+
+def chain(*transforms: Transform) -> Transform:
+    def transform(value):
+        for t in transforms:
+            value = t(value)
+        return value
+
+    return transform
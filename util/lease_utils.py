@@ -0,0 +1,237 @@
+"""
+Leases that keep two do_label runs for the same (project, plugin, shard) from executing at once,
+as happens with redeliveries, manual triggers or overlapping crons. Duplicate runs double the
+API calls, and cause labelFingerprint conflicts.
+
+A lease has a TTL, renewed by a heartbeat while the run goes on, so that the lease of a crashed run expires.
+The backend is set with lease_backend in the config:
+- memory: Within one process.
+- file: Lock files in lease_path, for all processes on one host.
+- memcache: App Engine Memcache, shared by all instances. (In local development, an in-process stand-in.)
+- none: No leases.
+If it is not set, memcache on App Engine, and memory elsewhere.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Generator, Optional, Tuple
+
+from util import config_utils, memcache_utils
+
+_WAIT_POLL_SECONDS = 2
+
+
+class LeaseBackend(metaclass=ABCMeta):
+    @abstractmethod
+    def acquire(self, key: str, owner: str, ttl: int) -> bool:
+        """:return True if the lease was free or expired, and is now held by owner"""
+        pass
+
+    @abstractmethod
+    def renew(self, key: str, owner: str, ttl: int) -> bool:
+        """:return False if owner no longer holds the lease"""
+        pass
+
+    @abstractmethod
+    def release(self, key: str, owner: str):
+        pass
+
+
+class InMemoryLeaseBackend(LeaseBackend):
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__leases: Dict[str, Tuple[str, float]] = {}
+
+    def acquire(self, key, owner, ttl):
+        with self.__lock:
+            holder = self.__leases.get(key)
+            if holder is not None and holder[1] > time.time():
+                return False
+            self.__leases[key] = (owner, time.time() + ttl)
+            return True
+
+    def renew(self, key, owner, ttl):
+        with self.__lock:
+            holder = self.__leases.get(key)
+            if holder is None or holder[0] != owner:
+                return False
+            self.__leases[key] = (owner, time.time() + ttl)
+            return True
+
+    def release(self, key, owner):
+        with self.__lock:
+            holder = self.__leases.get(key)
+            if holder is not None and holder[0] == owner:
+                del self.__leases[key]
+
+
+class FileLeaseBackend(LeaseBackend):
+    """One file per lease, holding the owner and expiry, read and written under an exclusive flock."""
+
+    def __init__(self, directory: str):
+        self.__directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def __locked(self, key: str):
+        path = os.path.join(self.__directory, re.sub(r"[^\w.-]", "_", key))
+        with open(path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                holder = json.loads(content) if content else None
+
+                def write(new_holder: Optional[Dict]):
+                    f.seek(0)
+                    f.truncate()
+                    if new_holder is not None:
+                        json.dump(new_holder, f)
+                    f.flush()
+
+                yield holder, write
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def acquire(self, key, owner, ttl):
+        with self.__locked(key) as (holder, write):
+            if holder is not None and holder["expires"] > time.time():
+                return False
+            write({"owner": owner, "expires": time.time() + ttl})
+            return True
+
+    def renew(self, key, owner, ttl):
+        with self.__locked(key) as (holder, write):
+            if holder is None or holder["owner"] != owner:
+                return False
+            write({"owner": owner, "expires": time.time() + ttl})
+            return True
+
+    def release(self, key, owner):
+        with self.__locked(key) as (holder, write):
+            if holder is not None and holder["owner"] == owner:
+                write(None)
+
+
+class KeyValueLeaseBackend(LeaseBackend):
+    """
+    Leases in a key-value store shared by all instances, using atomic add, and compare-and-set.
+    :param client_factory: Returns a client with the interface of memcache.Client. A new client
+     is used for each operation, since memcache.Client keeps compare-and-set state per key.
+    """
+
+    def __init__(self, client_factory: Callable[[], Any]):
+        self.__client_factory = client_factory
+
+    def acquire(self, key, owner, ttl):
+        # The store expires the entry, so a held lease is never expired
+        client = self.__client_factory()
+        if client.add(key, owner, time=ttl):
+            return True
+        # A released lease is left as None until the store expires it
+        if client.gets(key) is not None:
+            return False
+        # Either released, or expired since the add
+        return client.cas(key, owner, time=ttl) or client.add(key, owner, time=ttl)
+
+    def renew(self, key, owner, ttl):
+        client = self.__client_factory()
+        if client.gets(key) != owner:
+            return False
+        return client.cas(key, owner, time=ttl)
+
+    def release(self, key, owner):
+        client = self.__client_factory()
+        if client.gets(key) == owner:
+            # Not a delete, which could remove a lease that another owner just acquired
+            client.cas(key, None, time=1)
+
+
+__backend: Optional[LeaseBackend] = None
+__backend_lock = threading.Lock()
+
+
+def get_lease_backend() -> Optional[LeaseBackend]:
+    """:return the backend configured with lease_backend, or None for no leases"""
+    global __backend
+    with __backend_lock:
+        if __backend is None:
+            __backend = __create_backend(config_utils.lease_backend())
+        return __backend
+
+
+def set_lease_backend(backend: LeaseBackend):
+    """For example, to use a KeyValueLeaseBackend over some other store"""
+    global __backend
+    with __backend_lock:
+        __backend = backend
+
+
+def __create_backend(name: str) -> Optional[LeaseBackend]:
+    if name == "none":
+        return None
+    elif name == "memory":
+        return InMemoryLeaseBackend()
+    elif name == "file":
+        return FileLeaseBackend(config_utils.lease_path())
+    elif name == "memcache":
+        return KeyValueLeaseBackend(memcache_utils.client)
+    else:
+        raise ValueError(f"Unknown lease_backend {name}")
+
+
+@contextmanager
+def lease(key: str) -> Generator[bool, None, None]:
+    """
+    Hold the lease for key, renewing it with a heartbeat, while in the context.
+    If another run holds it, then with lease_conflict "wait", wait for up to
+    lease_ttl_seconds for it to be released; with "skip", do not wait.
+    :return True if the lease is held (or leases are not in use); False if the caller should skip its work
+    """
+    backend = get_lease_backend()
+    if backend is None:
+        yield True
+        return
+    ttl = config_utils.lease_ttl_seconds()
+    owner = str(uuid.uuid4())
+    acquired = backend.acquire(key, owner, ttl)
+    if not acquired and config_utils.lease_conflict() == "wait":
+        deadline = time.time() + ttl
+        while not acquired and time.time() < deadline:
+            time.sleep(_WAIT_POLL_SECONDS)
+            acquired = backend.acquire(key, owner, ttl)
+    if not acquired:
+        logging.info("Lease %s is held by another run", key)
+        yield False
+        return
+
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(ttl / 3):
+            try:
+                if not backend.renew(key, owner, ttl):
+                    logging.warning("Lost lease %s", key)
+                    return
+            except Exception:
+                logging.exception("Cannot renew lease %s", key)
+
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    try:
+        yield True
+    finally:
+        stop.set()
+        heartbeat_thread.join()
+        try:
+            backend.release(key, owner)
+        except Exception:
+            logging.exception("Cannot release lease %s", key)
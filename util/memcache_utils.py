@@ -0,0 +1,131 @@
+"""
+App Engine Memcache, for state that all instances share, rather than each keeping its own:
+Leases, the skip cache and the zone occupancy. (App Engine routes the requests of one cron run,
+like /schedule and the /do_label requests that it triggers, to various instances.)
+Memcache may evict entries, so it holds only what can be recomputed, at some cost.
+
+In local development, an in-process stand-in with the same interface is used.
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from util.detect_gae import detect_gae
+
+_CAS_ATTEMPTS = 5
+# Memcache reads an expiry time above this as an absolute Unix time, not as seconds from now
+MAX_RELATIVE_EXPIRY_SECONDS = 30 * 24 * 60 * 60
+
+
+class LocalKeyValueStore:
+    """
+    A stand-in for App Engine Memcache in local development,
+    with the subset of the memcache.Client interface used here: add, get, gets, cas and delete.
+    Entries expire after their time in seconds, or as in Memcache, at that Unix time if it is
+    above MAX_RELATIVE_EXPIRY_SECONDS.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__entries: Dict[str, Tuple[Any, float, int]] = {}  # value, expiry, version
+        self.__cas_versions = threading.local()
+
+    def __live(self, key):
+        entry = self.__entries.get(key)
+        if entry is not None and entry[1] <= time.time():
+            del self.__entries[key]
+            entry = None
+        return entry
+
+    def add(self, key, value, time=0):
+        with self.__lock:
+            if self.__live(key) is not None:
+                return False
+            self.__entries[key] = (value, self.__expiry(time), 0)
+            return True
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__live(key)
+            return None if entry is None else entry[0]
+
+    def gets(self, key):
+        with self.__lock:
+            entry = self.__live(key)
+            if entry is None:
+                return None
+            self.__cas_versions.__dict__[key] = entry[2]
+            return entry[0]
+
+    def cas(self, key, value, time=0):
+        with self.__lock:
+            entry = self.__live(key)
+            version = self.__cas_versions.__dict__.pop(key, None)
+            if entry is None or entry[2] != version:
+                return False
+            self.__entries[key] = (value, self.__expiry(time), version + 1)
+            return True
+
+    def delete(self, key):
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    @staticmethod
+    def __expiry(seconds):
+        if not seconds:
+            return float("inf")
+        if seconds > MAX_RELATIVE_EXPIRY_SECONDS:
+            return seconds
+        return time.time() + seconds
+
+
+__local_store: Optional[LocalKeyValueStore] = None
+__lock = threading.Lock()
+
+
+def client():
+    """:return a new client with the interface of memcache.Client. Use a new client for each
+    read-modify-write, since memcache.Client keeps compare-and-set state per key."""
+    global __local_store
+    if detect_gae():
+        from google.appengine.api import memcache
+
+        return memcache.Client()
+    with __lock:
+        if __local_store is None:
+            __local_store = LocalKeyValueStore()
+        return __local_store
+
+
+def expiry_time(seconds: float) -> float:
+    """:return the time argument for Memcache that expires after seconds, which may be above a month"""
+    if seconds > MAX_RELATIVE_EXPIRY_SECONDS:
+        return time.time() + seconds
+    return seconds
+
+
+def update(key: str, func: Callable[[Optional[Any]], Optional[Any]], time=0) -> bool:
+    """
+    Replace the value of key (None if absent) with func(value), atomically with compare-and-set,
+    retrying on conflicts with other writers. A None result deletes the entry.
+    :param time: Seconds until the entry expires, which may be above a month; 0 for no expiry
+    :return False if it did not succeed after _CAS_ATTEMPTS
+    """
+    time = expiry_time(time)
+    for _ in range(_CAS_ATTEMPTS):
+        c = client()
+        value = c.gets(key)
+        new_value = func(value)
+        if new_value is None:
+            if value is not None:
+                c.delete(key)
+            return True
+        if value is None:
+            if c.add(key, new_value, time=time):
+                return True
+        elif c.cas(key, new_value, time=time):
+            return True
+    logging.warning("Cannot update %s in memcache: Conflicting writes", key)
+    return False
@@ -0,0 +1,126 @@
+"""
+Tracking of the long-running operations that some Google APIs (like sqladmin) return for updates,
+in the background, so that the labeling does not wait for them: A thread polls the pending operations
+every _POLL_SECONDS, and logs each that failed, or did not finish within _TIMEOUT_SECONDS, with its resource.
+The thread stops when no operations are pending, and is started again by track().
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+_POLL_SECONDS = 2
+_TIMEOUT_SECONDS = 300
+_POLL_THREADS = 8
+# Failures kept for failures(), most recent last
+_MAX_FAILURES_KEPT = 100
+
+
+class _Pending(NamedTuple):
+    project_id: str
+    operation_name: str
+    resource_name: str
+    deadline: float
+
+
+class OperationTracker:
+    def __init__(self, name: str, get_operation: Callable[[str, str], Dict]):
+        """
+        :param get_operation: get_operation(project_id, operation_name) returns the operation, with
+            status (DONE when finished) and, if it failed, error.errors
+        """
+        self.__name = name
+        self.__get_operation = get_operation
+        self.__lock = threading.Lock()
+        self.__pending: List[_Pending] = []
+        self.__failures: Dict[str, str] = {}
+        self.__thread: Optional[threading.Thread] = None
+
+    @property
+    def pending(self) -> int:
+        with self.__lock:
+            return len(self.__pending)
+
+    def failures(self) -> Dict[str, str]:
+        """Recently failed operations: Resource name to error"""
+        with self.__lock:
+            return dict(self.__failures)
+
+    def track(self, project_id: str, operation: Dict, resource_name: str):
+        """:param operation: as returned by the update call"""
+        if self.__check(operation, resource_name):
+            return
+        pending = _Pending(
+            project_id, operation["name"], resource_name, time.time() + _TIMEOUT_SECONDS
+        )
+        with self.__lock:
+            self.__pending.append(pending)
+            if self.__thread is None:
+                self.__thread = threading.Thread(
+                    target=self.__poll_loop,
+                    name=f"{self.__name}_operations",
+                    daemon=True,
+                )
+                self.__thread.start()
+
+    def __poll_loop(self):
+        with ThreadPoolExecutor(max_workers=_POLL_THREADS) as executor:
+            while True:
+                time.sleep(_POLL_SECONDS)
+                with self.__lock:
+                    pending = self.__pending
+                    self.__pending = []
+                still_pending = [
+                    p
+                    for p, done in zip(pending, executor.map(self.__poll, pending))
+                    if not done
+                ]
+                with self.__lock:
+                    self.__pending.extend(still_pending)
+                    if not self.__pending:
+                        self.__thread = None
+                        return
+
+    def __poll(self, pending: _Pending) -> bool:
+        """:return True if no longer pending"""
+        try:
+            operation = self.__get_operation(pending.project_id, pending.operation_name)
+        except Exception:
+            logging.exception(
+                "%s: Cannot get operation %s on %s",
+                self.__name,
+                pending.operation_name,
+                pending.resource_name,
+            )
+            operation = None
+        if operation is not None and self.__check(operation, pending.resource_name):
+            return True
+        if time.time() > pending.deadline:
+            self.__fail(
+                pending.resource_name,
+                f"operation {pending.operation_name} not done in {_TIMEOUT_SECONDS} s",
+            )
+            return True
+        return False
+
+    def __check(self, operation: Dict, resource_name: str) -> bool:
+        """:return True if the operation is done, having logged it if it failed"""
+        if operation.get("status") != "DONE":
+            return False
+        errors: Any = (operation.get("error") or {}).get("errors")
+        if errors:
+            self.__fail(resource_name, str(errors))
+        else:
+            with self.__lock:
+                self.__failures.pop(resource_name, None)
+        return True
+
+    def __fail(self, resource_name: str, error: str):
+        logging.error("%s: Labeling %s failed: %s", self.__name, resource_name, error)
+        with self.__lock:
+            self.__failures.pop(resource_name, None)
+            self.__failures[resource_name] = error
+            if len(self.__failures) > _MAX_FAILURES_KEPT:
+                del self.__failures[next(iter(self.__failures))]
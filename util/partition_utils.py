@@ -0,0 +1,43 @@
+"""
+Stable hash-partitioning, used for rolling relabel sweeps.
+
+With `rolling_partitions` N > 1 in the config, each daily cron tick relabels only the
+projects (or zones/resources) whose stable hash falls into that day's partition,
+so that a full relabeling cycle completes every N days.
+"""
+
+import time
+import zlib
+from typing import NamedTuple, Optional
+
+_SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class Partition(NamedTuple):
+    index: int
+    count: int
+
+    def contains(self, key: str) -> bool:
+        return partition_of(key, self.count) == self.index
+
+
+def stable_hash(key: str) -> int:
+    """Unlike the builtin hash(), this is the same across processes and instances."""
+    return zlib.crc32(key.encode("utf-8"))
+
+
+def partition_of(key: str, count: int) -> int:
+    return stable_hash(key) % count
+
+
+def todays_partition(count: int, now: Optional[float] = None) -> Optional[Partition]:
+    """
+    :return the partition to process on the current (UTC) day,
+     or None if partitioning is not in use, i.e. everything is processed every day.
+    """
+    if count <= 1:
+        return None
+    if now is None:
+        now = time.time()
+    day_number = int(now // _SECONDS_PER_DAY)
+    return Partition(day_number % count, count)
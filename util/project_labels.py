@@ -0,0 +1,159 @@
+"""
+Process-wide table of project labels, for copying them to resources (from_project in the config).
+
+The table, a TTLCache, is filled in bulk, with one paginated search of all projects visible to Iris,
+on /schedule and on a background timer every project_labels_refresh_seconds,
+so that labeling does not wait for a lookup per project.
+An UpdateProject audit event on /label_one invalidates the entry for that project, so the table stays fresh
+between refreshes. The event reaches only one instance, so it also records the invalidation in Memcache,
+where the other instances read it, at most every _INVALIDATIONS_POLL_SECONDS.
+A project missing from the table, e.g. one created or updated since the last refresh, is looked up singly.
+"""
+
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+from util import config_utils, gcp_utils, memcache_utils
+from util.gcp_utils import add_loaded_lib
+from util.ttl_cache import TTLCache
+
+_MAX_PROJECTS = 100000
+# Project ID to the time of its latest invalidation, kept for as long as an entry can be served
+_INVALIDATIONS_KEY = "iris_project_labels_invalidations"
+_INVALIDATIONS_POLL_SECONDS = 30
+
+__lock = threading.Lock()
+__cache: Optional[TTLCache] = None
+__refreshed_at: Optional[float] = None
+__timer_started = False
+__invalidations_checked_at = 0.0
+__invalidations_seen: Dict[str, float] = {}
+
+
+def get(project_id: str) -> Dict[str, str]:
+    """:return the labels of the project, or an empty dict if they cannot be read"""
+    __start_refresh_timer()
+    __apply_shared_invalidations()
+    try:
+        return __get_cache().get(project_id, lambda: __load_one(project_id))
+    except Exception:
+        logging.exception(f"Failing to get labels for project {project_id}")
+        return {}
+
+
+def invalidate(project_id: str):
+    """For when the project's labels changed, e.g. on an UpdateProject event. Applies to all instances."""
+    __get_cache().invalidate(project_id)
+    now = time.time()
+    with __lock:
+        __invalidations_seen[project_id] = now
+    keep_seconds = 2 * config_utils.project_labels_refresh_seconds()
+
+    def add_invalidation(invalidations):
+        recent = {
+            p: t for p, t in (invalidations or {}).items() if t > now - keep_seconds
+        }
+        return {**recent, project_id: now}
+
+    try:
+        memcache_utils.update(_INVALIDATIONS_KEY, add_invalidation, time=keep_seconds)
+    except Exception:
+        logging.exception("Cannot share the invalidation of project %s", project_id)
+
+
+def __apply_shared_invalidations():
+    """Invalidate the projects that other instances invalidated since the last check"""
+    global __invalidations_checked_at
+    now = time.time()
+    with __lock:
+        if now < __invalidations_checked_at + _INVALIDATIONS_POLL_SECONDS:
+            return
+        __invalidations_checked_at = now
+    try:
+        invalidations = memcache_utils.client().get(_INVALIDATIONS_KEY) or {}
+    except Exception:
+        logging.exception("Cannot read shared invalidations of project labels")
+        return
+    with __lock:
+        new = [p for p, t in invalidations.items() if __invalidations_seen.get(p) != t]
+        __invalidations_seen.update(invalidations)
+    for project_id in new:
+        __get_cache().invalidate(project_id)
+
+
+def stats() -> Dict[str, int]:
+    return __get_cache().stats()
+
+
+def __load_one(project_id: str) -> Dict[str, str]:
+    return dict(gcp_utils.get_project(project_id).get("labels", {}))
+
+
+def __get_cache() -> TTLCache:
+    global __cache
+    with __lock:
+        if __cache is None:
+            # An entry is served for up to twice the interval, in case a refresh failed;
+            # then, while it is reloaded singly
+            interval = config_utils.project_labels_refresh_seconds()
+            __cache = TTLCache(
+                2 * interval,
+                maxsize=_MAX_PROJECTS,
+                stale_seconds=interval,
+                name="project_labels",
+            )
+        return __cache
+
+
+def refresh():
+    """Load the labels of all projects, from one paginated search"""
+    global __refreshed_at
+    start = time.time()
+    # Local import to avoid burdening AppEngine memory.
+    # Loading all Cloud Client libraries would be 100MB  means that
+    # the default AppEngine Instance crashes on out-of-memory even before actually serving a request.
+    from google.cloud import resourcemanager_v3
+
+    add_loaded_lib("resourcemanager_v3")
+    projects_client = resourcemanager_v3.ProjectsClient()
+    cache = __get_cache()
+    count = 0
+    for p in projects_client.search_projects(query=""):
+        if config_utils.is_project_enabled(p.project_id):
+            cache.put(p.project_id, dict(p.labels))
+            count += 1
+    with __lock:
+        __refreshed_at = time.time()
+    logging.info(
+        "Loaded labels of %d projects in %d ms; cache %s",
+        count,
+        int((time.time() - start) * 1000),
+        cache.stats(),
+    )
+
+
+def __start_refresh_timer():
+    global __timer_started
+    with __lock:
+        if __timer_started:
+            return
+        __timer_started = True
+    threading.Thread(target=__refresh_periodically, daemon=True).start()
+
+
+def __refresh_periodically():
+    interval = config_utils.project_labels_refresh_seconds()
+    while True:
+        with __lock:
+            # Not if /schedule just refreshed
+            due = __refreshed_at is None or time.time() >= __refreshed_at + interval
+        if due:
+            try:
+                refresh()
+            except Exception:
+                logging.exception("Cannot load project labels")
+        with __lock:
+            next_at = (__refreshed_at or time.time()) + interval
+        time.sleep(max(1.0, next_at - time.time()))
@@ -0,0 +1,127 @@
+"""
+Adaptive rate limiting of API calls, per (API, operation, project), replacing a fixed limit per method.
+
+Each key has its own rate, learned by AIMD (additive increase, multiplicative decrease): It grows by a small step
+with each successful call, and is halved when a call is rate-limited (429 or rateLimitExceeded), so that
+Iris runs close to the quota, without storms of errors.
+
+Callers do not block: try_acquire() takes a slot only if one is free now, and wait_seconds() tells how long
+until one is, so that the call can wait for a later send (as BatchPipeline does). A slot is taken when
+the call is made, not booked ahead, so that a change in the rate applies to all calls not yet made.
+The learned rates are logged at most every _LOG_INTERVAL_SECONDS.
+"""
+
+import logging
+import threading
+import time
+from typing import Dict, Tuple
+
+# (API, operation) to the initial and maximum calls per second.
+# BigQuery allows 5 metadata updates per 10 seconds on a table or dataset; the earlier fixed limit was 35 per minute
+_RATES: Dict[Tuple[str, str], Tuple[float, float]] = {
+    ("bigquery", "tables.patch"): (35 / 60, 10),
+    ("bigquery", "datasets.patch"): (35 / 60, 10),
+}
+_DEFAULT_RATES = (10, 100)
+_MIN_RATE = 0.1
+# The additive increase per success, as a fraction of the maximum rate
+_INCREASE_FRACTION = 1 / 500
+_DECREASE_FACTOR = 0.5
+# The errors of one burst of calls should halve the rate once, not once per error
+_DECREASE_COOLDOWN_SECONDS = 2
+_LOG_INTERVAL_SECONDS = 60
+
+__lock = threading.Lock()
+__limiters: Dict[Tuple[str, str, str], "AimdRateLimiter"] = {}
+__logged_at = 0.0
+
+
+class AimdRateLimiter:
+    def __init__(self, name: str, rate: float, max_rate: float):
+        self.name = name
+        self.__rate = rate
+        self.__max_rate = max_rate
+        self.__increase = max_rate * _INCREASE_FRACTION
+        self.__lock = threading.Lock()
+        # The time at which the next slot is free; may be in the past, up to a burst of one second's calls
+        self.__next_free = 0.0
+        self.__decreased_at = 0.0
+
+    @property
+    def rate(self) -> float:
+        """Calls per second"""
+        return self.__rate
+
+    def wait_seconds(self) -> float:
+        """:return the seconds until a slot is free, 0 if now; without taking it"""
+        with self.__lock:
+            now = time.time()
+            return max(0.0, self.__start(now) - now)
+
+    def try_acquire(self) -> bool:
+        """:return True, having taken a slot, if one is free now"""
+        with self.__lock:
+            now = time.time()
+            start = self.__start(now)
+            if start > now:
+                return False
+            self.__next_free = start + 1 / self.__rate
+            return True
+
+    def on_success(self):
+        with self.__lock:
+            self.__rate = min(self.__max_rate, self.__rate + self.__increase)
+
+    def on_throttled(self):
+        with self.__lock:
+            now = time.time()
+            if now < self.__decreased_at + _DECREASE_COOLDOWN_SECONDS:
+                return
+            self.__decreased_at = now
+            before = self.__rate
+            self.__rate = max(_MIN_RATE, self.__rate * _DECREASE_FACTOR)
+            # The next slots are spaced out at the new rate
+            self.__next_free = max(self.__next_free, now) + 1 / self.__rate
+        logging.info(
+            "Rate limited on %s: down from %.2f to %.2f calls/s",
+            self.name,
+            before,
+            self.__rate,
+        )
+
+    def __start(self, now: float) -> float:
+        """Call only under the lock"""
+        burst = max(1.0, self.__rate)
+        return max(self.__next_free, now - (burst - 1) / self.__rate)
+
+
+def get_limiter(api: str, operation: str, project_id: str) -> AimdRateLimiter:
+    key = (api, operation, project_id)
+    limiter = __limiters.get(key)
+    if limiter is None:
+        with __lock:
+            limiter = __limiters.get(key)
+            if limiter is None:
+                rate, max_rate = _RATES.get((api, operation), _DEFAULT_RATES)
+                limiter = __limiters[key] = AimdRateLimiter(
+                    "/".join(key), rate, max_rate
+                )
+    __log_rates_if_due()
+    return limiter
+
+
+def rates() -> Dict[str, float]:
+    """The learned calls per second, by API/operation/project"""
+    with __lock:
+        limiters = list(__limiters.values())
+    return {limiter.name: round(limiter.rate, 2) for limiter in limiters}
+
+
+def __log_rates_if_due():
+    global __logged_at
+    now = time.time()
+    with __lock:
+        if now < __logged_at + _LOG_INTERVAL_SECONDS:
+            return
+        __logged_at = now
+    logging.info("Learned API rates, calls/s: %s", rates())
@@ -0,0 +1,219 @@
+"""
+Negative cache of (project, plugin) pairs that need not be labeled on every cron run:
+The API is disabled in that project, Iris lacks permissions there, or there are no such resources.
+
+Each such outcome doubles the interval until the pair is rechecked, up to skip_cache_max_days.
+A run that finds resources, or a resource-creation event in the project, clears the entry.
+
+Entries are recorded by do_label and read by schedule, which App Engine routes to various instances;
+so with skip_cache_backend "memcache" (the default), the cache is shared by all instances.
+With "local", it is in-process, and optionally persisted to the local file skip_cache_path,
+which is useful only where one instance serves all requests, as in local development.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Set
+
+from util import config_utils, memcache_utils
+
+API_DISABLED = "api_disabled"
+PERMISSION_DENIED = "permission_denied"
+NO_RESOURCES = "no_resources"
+
+_SECONDS_PER_DAY = 24 * 60 * 60
+# The cron runs about once a day, but not at exactly the same second
+_CRON_JITTER_SECONDS = 60 * 60
+_MEMCACHE_KEY_PREFIX = "iris_skip_cache/"
+
+# Reasons for a 403 that are transient, so the project should not be skipped
+_QUOTA_REASONS = (
+    "ratelimitexceeded",
+    "userratelimitexceeded",
+    "quotaexceeded",
+    "dailylimitexceeded",
+    "rate_limit_exceeded",
+    "resource_exhausted",
+    "quota exceeded",
+)
+_API_DISABLED_REASONS = (
+    "accessnotconfigured",
+    "service_disabled",
+    "has not been used in project",
+    "it is disabled",
+)
+_PERMISSION_REASONS = (
+    "forbidden",
+    "insufficientpermissions",
+    "permission_denied",
+    "accessdenied",
+    "permission",
+)
+
+__lock = threading.Lock()
+# For the "local" backend: Project ID to plugin name to entry
+__entries: Optional[Dict[str, Dict[str, Dict]]] = None
+
+
+def skip_reason(exc: Exception) -> Optional[str]:
+    """
+    :return API_DISABLED or PERMISSION_DENIED if the exception, from either
+    the Google API Client Libraries or the Cloud Client Libraries, shows that; else None,
+    including for a 403 for exceeding a quota or rate limit
+    """
+    # HttpError from googleapiclient has status_code; GoogleAPICallError from google.api_core has code
+    status = getattr(exc, "status_code", None) or getattr(exc, "code", None)
+    if status != 403:
+        return None
+    # The reason, like rateLimitExceeded, is in the message, the error details or (for google.api_core) reason
+    text = " ".join(
+        str(s)
+        for s in (
+            exc,
+            getattr(exc, "reason", None) or "",
+            getattr(exc, "error_details", None) or "",
+        )
+    ).lower()
+    if any(s in text for s in _QUOTA_REASONS):
+        return None
+    if any(s in text for s in _API_DISABLED_REASONS):
+        return API_DISABLED
+    if any(s in text for s in _PERMISSION_REASONS):
+        return PERMISSION_DENIED
+    return None
+
+
+def skipped_plugins(project_id: str) -> Set[str]:
+    """:return the names of the plugins to skip in the project on this cron run"""
+    if not __enabled():
+        return set()
+    entries = __read(project_id)
+    now = time.time()
+    return {
+        plugin_name
+        for plugin_name, entry in entries.items()
+        if now < entry["next_check"] - _CRON_JITTER_SECONDS
+    }
+
+
+def record(project_id: str, plugin_name: str, reason: str):
+    if not __enabled():
+        return
+    interval_days = 0
+
+    def add_entry(entries: Dict[str, Dict]) -> Dict[str, Dict]:
+        nonlocal interval_days
+        prev = entries.get(plugin_name)
+        count = prev["count"] + 1 if prev else 1
+        interval_days = min(2**count, config_utils.skip_cache_max_days())
+        return {
+            **entries,
+            plugin_name: {
+                "reason": reason,
+                "count": count,
+                "next_check": time.time() + interval_days * _SECONDS_PER_DAY,
+            },
+        }
+
+    __update(project_id, add_entry)
+    logging.info(
+        "Will skip %s in %s for %s days: %s",
+        plugin_name,
+        project_id,
+        interval_days,
+        reason,
+    )
+
+
+def clear(project_id: str, plugin_name: str):
+    __update(
+        project_id,
+        lambda entries: {k: v for k, v in entries.items() if k != plugin_name},
+    )
+
+
+def clear_project(project_id: str):
+    """For when we learn that there are resources in the project, e.g. on a creation event"""
+    if not project_id:
+        return
+    __update(project_id, lambda _: {})
+
+
+def __enabled() -> bool:
+    return config_utils.skip_cache_max_days() > 0
+
+
+def __read(project_id: str) -> Dict[str, Dict]:
+    """:return plugin name to entry"""
+    if config_utils.skip_cache_backend() == "memcache":
+        return memcache_utils.client().get(_MEMCACHE_KEY_PREFIX + project_id) or {}
+    with __lock:
+        return dict(__get_entries().get(project_id, {}))
+
+
+def __update(
+    project_id: str, func: Callable[[Dict[str, Dict]], Dict[str, Dict]]
+) -> None:
+    """Replace the entries of the project with func(entries)"""
+    if config_utils.skip_cache_backend() == "memcache":
+        # Kept beyond the last next_check, so that the interval keeps doubling
+        ttl = 2 * config_utils.skip_cache_max_days() * _SECONDS_PER_DAY
+        memcache_utils.update(
+            _MEMCACHE_KEY_PREFIX + project_id,
+            lambda entries: func(entries or {}) or None,
+            time=ttl,
+        )
+        return
+    with __lock:
+        entries = __get_entries()
+        before = entries.get(project_id, {})
+        after = func(before)
+        if after == before:
+            return
+        if after:
+            entries[project_id] = after
+        else:
+            del entries[project_id]
+        __save()
+
+
+def __get_entries() -> Dict[str, Dict[str, Dict]]:
+    """Call only under the lock"""
+    global __entries
+    if __entries is None:
+        __entries = {}
+        path = config_utils.skip_cache_path()
+        if path and os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    loaded = json.load(f)
+                for key, entry in loaded.items():
+                    project_id, plugin_name = key.split("/", 1)
+                    __entries.setdefault(project_id, {})[plugin_name] = entry
+            except (OSError, ValueError):
+                logging.exception("Cannot load skip cache from %s", path)
+    return __entries
+
+
+def __save():
+    """Call only under the lock"""
+    path = config_utils.skip_cache_path()
+    if not path:
+        return
+    try:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    f"{p}/{plg}": entry
+                    for p, by_plugin in __entries.items()
+                    for plg, entry in by_plugin.items()
+                },
+                f,
+            )
+        os.replace(tmp_path, path)
+    except OSError:
+        logging.exception("Cannot save skip cache to %s", path)
@@ -0,0 +1,182 @@
+"""
+A thread-safe cache with an expiry per entry, replacing utils.timed_lru_cache,
+which cleared all entries at once, so that they all missed at the same moment.
+
+- Each entry expires ttl_seconds after it was loaded.
+- Concurrent misses on one key are deduplicated ("single-flight"): One thread loads, the others wait for it.
+- A load in progress when its key is invalidated does not store its value, which may predate the invalidation.
+- Optionally, for stale_seconds after expiry, the stale value is returned while a background thread reloads it.
+- Bounded by number of entries, and optionally by total weight, evicting the least recently used.
+- stats() gives hit, miss and other counts.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import wraps
+from typing import Any, Callable, Dict, Hashable, Optional
+
+_EXPIRES = 1
+_WEIGHT = 2
+
+
+class TTLCache:
+    def __init__(
+        self,
+        ttl_seconds: float,
+        maxsize: int = 1024,
+        stale_seconds: float = 0,
+        max_weight: Optional[int] = None,
+        weigher: Optional[Callable[[Any], int]] = None,
+        name: str = "",
+    ):
+        """
+        :param stale_seconds: How long after expiry a value may be served while it is reloaded in the background
+        :param max_weight: With weigher, the bound on the total weight of the values
+        """
+        assert max_weight is None or weigher is not None
+        self.__ttl = ttl_seconds
+        self.__maxsize = maxsize
+        self.__stale = stale_seconds
+        self.__max_weight = max_weight
+        self.__weigher = weigher
+        self.name = name
+        self.__lock = threading.Lock()
+        # key to [value, expires, weight], least recently used first
+        self.__entries: OrderedDict = OrderedDict()
+        self.__weight = 0
+        self.__loading: Dict[Hashable, Future] = {}
+        # For keys being loaded: Count of invalidations during the load
+        self.__generations: Dict[Hashable, int] = {}
+        self.__stats = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "loads": 0,
+            "load_errors": 0,
+            "evictions": 0,
+        }
+
+    def get(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """:return the cached value for key, calling loader to load it if needed"""
+        now = time.time()
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                if now < entry[_EXPIRES]:
+                    self.__entries.move_to_end(key)
+                    self.__stats["hits"] += 1
+                    return entry[0]
+                if now < entry[_EXPIRES] + self.__stale:
+                    self.__entries.move_to_end(key)
+                    self.__stats["stale_hits"] += 1
+                    if key not in self.__loading:
+                        self.__loading[key] = Future()
+                        threading.Thread(
+                            target=self.__load, args=(key, loader, True), daemon=True
+                        ).start()
+                    return entry[0]
+            self.__stats["misses"] += 1
+            future = self.__loading.get(key)
+            if future is None:
+                future = self.__loading[key] = Future()
+                is_loader = True
+            else:
+                is_loader = False  # Another thread is loading this key
+        if is_loader:
+            self.__load(key, loader)
+        return future.result()
+
+    def put(self, key: Hashable, value: Any):
+        with self.__lock:
+            self.__set(key, value)
+
+    def invalidate(self, key: Hashable):
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is not None:
+                self.__weight -= entry[_WEIGHT]
+            if key in self.__generations:
+                self.__generations[key] += 1
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__weight = 0
+            for key in self.__generations:
+                self.__generations[key] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return {
+                **self.__stats,
+                "size": len(self.__entries),
+                "weight": self.__weight,
+            }
+
+    def __load(self, key, loader, background: bool = False):
+        with self.__lock:
+            future = self.__loading[key]
+            self.__generations[key] = generation = 0
+        try:
+            value = loader()
+        except BaseException as e:
+            with self.__lock:
+                self.__stats["load_errors"] += 1
+                del self.__loading[key]
+                del self.__generations[key]
+            future.set_exception(e)
+            if background:
+                # The stale value stays until the stale period ends
+                logging.exception("Cannot refresh %s in cache %s", key, self.name)
+            return
+        with self.__lock:
+            self.__stats["loads"] += 1
+            # If invalidated meanwhile, the value may be from before that, so it is returned but not stored
+            if self.__generations.pop(key) == generation:
+                self.__set(key, value)
+            del self.__loading[key]
+        future.set_result(value)
+
+    def __set(self, key, value):
+        """Call only under the lock"""
+        old = self.__entries.pop(key, None)
+        if old is not None:
+            self.__weight -= old[_WEIGHT]
+        weight = self.__weigher(value) if self.__weigher else 0
+        self.__entries[key] = [value, time.time() + self.__ttl, weight]
+        self.__weight += weight
+        while len(self.__entries) > self.__maxsize or (
+            self.__max_weight is not None
+            and self.__weight > self.__max_weight
+            and len(self.__entries) > 1
+        ):
+            _, evicted = self.__entries.popitem(last=False)
+            self.__weight -= evicted[_WEIGHT]
+            self.__stats["evictions"] += 1
+
+
+def ttl_cache(
+    ttl_seconds: float, maxsize: int = 1024, stale_seconds: float = 0
+) -> Callable:
+    """Decorator, caching by the positional and keyword arguments. The TTLCache is the function's `cache` attribute."""
+
+    def decorator(func):
+        cache = TTLCache(
+            ttl_seconds,
+            maxsize=maxsize,
+            stale_seconds=stale_seconds,
+            name=func.__name__,
+        )
+
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items()))) if kwargs else args
+            return cache.get(key, lambda: func(*args, **kwargs))
+
+        wrapped.cache = cache
+        return wrapped
+
+    return decorator
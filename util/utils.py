@@ -1,14 +1,13 @@
 import logging
 import pathlib
 import random
+import re
 import string
 import subprocess
 import sys
 import textwrap
 import time
-import typing
 from contextlib import contextmanager
-from datetime import datetime, timedelta
 from functools import lru_cache, wraps
 
 import flask
@@ -41,13 +40,19 @@ def shorten(o, length=400) -> str:
     return textwrap.shorten(str(o), length)
 
 
-def methods(o, pfx="") -> typing.List[typing.Callable]:
-    names = (
-        name
-        for name in dir(o.__class__)
-        if callable(getattr(o.__class__, name)) and name.startswith(pfx)
-    )
-    return [getattr(o, name) for name in names]
+# Label values may have only hyphens, underscores, lowercase letters (including international ones) and digits
+__ILLEGAL_LABEL_VALUE_CHARS = re.compile(r"[^\w-]")
+# Label values may have up to 63 characters
+__MAX_LABEL_VALUE_LEN = 62
+
+
+@lru_cache(maxsize=4096)
+def legalize_value(s: str) -> str:
+    """
+    :return s, with each illegal character replaced by an underscore, lowercased and truncated.
+    Memoized, since values such as zones, regions and machine types repeat across resources.
+    """
+    return __ILLEGAL_LABEL_VALUE_CHARS.sub("_", s).lower()[:__MAX_LABEL_VALUE_LEN]
 
 
 def random_str(length: int = 4):
@@ -182,25 +187,6 @@ def timing(tag: str) -> None:
     __log_end_timer(tag, start, "time")
 
 
-def timed_lru_cache(seconds: int, maxsize: int = 128):
-    def wrapper_cache(func):
-        func = lru_cache(maxsize=maxsize)(func)
-        func.lifetime = timedelta(seconds=seconds)
-        func.expiration = datetime.utcnow() + func.lifetime
-
-        @wraps(func)
-        def wrapped_func(*args, **kwargs):
-            if datetime.utcnow() >= func.expiration:
-                func.cache_clear()
-                func.expiration = datetime.utcnow() + func.lifetime
-
-            return func(*args, **kwargs)
-
-        return wrapped_func
-
-    return wrapper_cache
-
-
 def truncate_middle(s, resulting_len, elipsis_len=3):
     ellipsis_s = "." * elipsis_len
 
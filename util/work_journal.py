@@ -0,0 +1,224 @@
+"""
+Durable local journal of do_label jobs, so that do_label can ack the PubSub push at once,
+and background worker threads do the labeling.
+
+Without it, the ack deadline covers the whole label_all call: Slow runs are redelivered
+while still executing, and two instances do the same work.
+
+The journal is a SQLite database in WAL mode at work_journal_path. A job is journaled
+only if an identical one is not already pending, running or recently done,
+so redeliveries do not cause duplicate sweeps. On startup, jobs left running by a
+process that is gone (e.g., after a crash) are replayed.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from typing import Callable, Dict, Optional, Set
+
+from util import config_utils
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# A job identical to one done this recently is a redelivery, not a new request
+_DONE_RETENTION_SECONDS = 60 * 60
+# A failed job is retried, as PubSub would have redelivered it, up to this many attempts in all
+_MAX_ATTEMPTS = 3
+# Workers also poll, in case jobs were journaled by another process on this instance
+_POLL_SECONDS = 5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_key TEXT NOT NULL,
+    plugin TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    pid INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs (job_key, state);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+"""
+
+__lock = threading.Lock()
+__started = False
+__wakeup = threading.Event()
+# Plugins with a job running in this process; their instances are shared, so we run one job per plugin at a time
+__running_plugins: Set[str] = set()
+
+
+def is_enabled() -> bool:
+    return bool(config_utils.work_journal_path())
+
+
+def start(run_job: Callable[[Dict], None]):
+    """
+    Open the journal, replay jobs left running by a dead process, and start the workers.
+    Idempotent.
+    :param run_job: Does the labeling for the message data of a job; raises on failure
+    """
+    global __started
+    with __lock:
+        if __started:
+            return
+        __started = True
+    with closing(__connect()) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        __replay_orphans(conn)
+        __purge(conn)
+    threads = config_utils.work_journal_threads()
+    for i in range(threads):
+        threading.Thread(
+            target=__work, args=(run_job,), name=f"work_journal_{i}", daemon=True
+        ).start()
+    logging.info(
+        "Work journal at %s, with %d workers", config_utils.work_journal_path(), threads
+    )
+
+
+def enqueue(data: Dict) -> bool:
+    """
+    :param data: do_label message data
+    :return False if an identical job is already pending, running or was recently done
+    """
+    job_key = json.dumps(data, sort_keys=True)
+    now = time.time()
+    with closing(__connect()) as conn:
+        with conn:  # Transaction
+            # So that the check and the insert are atomic
+            conn.execute("BEGIN IMMEDIATE")
+            duplicate = conn.execute(
+                "SELECT state FROM jobs WHERE job_key=? AND (state IN (?, ?) OR (state=? AND updated>?))",
+                (job_key, PENDING, RUNNING, DONE, now - _DONE_RETENTION_SECONDS),
+            ).fetchone()
+            if duplicate:
+                logging.info(
+                    "Not journaling duplicate of %s job %s", duplicate[0], job_key
+                )
+                return False
+            conn.execute(
+                "INSERT INTO jobs (job_key, plugin, payload, state, updated) VALUES (?, ?, ?, ?, ?)",
+                (job_key, data.get("plugin", ""), job_key, PENDING, now),
+            )
+    __wakeup.set()
+    return True
+
+
+def counts() -> Dict[str, int]:
+    """:return number of jobs by state"""
+    with closing(__connect()) as conn:
+        return dict(
+            conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        )
+
+
+def __connect() -> sqlite3.Connection:
+    # One connection per use, since a sqlite3 connection should not be shared across threads
+    conn = sqlite3.connect(
+        config_utils.work_journal_path(), timeout=30, isolation_level=None
+    )
+    conn.execute("PRAGMA synchronous=NORMAL")  # Durable enough with WAL, and faster
+    return conn
+
+
+def __replay_orphans(conn: sqlite3.Connection):
+    orphans = [
+        (job_id, pid)
+        for job_id, pid in conn.execute(
+            "SELECT id, pid FROM jobs WHERE state=?", (RUNNING,)
+        )
+        if not __is_alive(pid)
+    ]
+    for job_id, _ in orphans:
+        conn.execute(
+            "UPDATE jobs SET state=?, pid=NULL WHERE id=? AND state=?",
+            (PENDING, job_id, RUNNING),
+        )
+    if orphans:
+        logging.info("Replaying %d unfinished jobs from the work journal", len(orphans))
+
+
+def __purge(conn: sqlite3.Connection):
+    conn.execute(
+        "DELETE FROM jobs WHERE state IN (?, ?) AND updated<?",
+        (DONE, FAILED, time.time() - _DONE_RETENTION_SECONDS),
+    )
+
+
+def __is_alive(pid: Optional[int]) -> bool:
+    if not pid or pid == os.getpid():
+        return False  # In this process, nothing runs before start()
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def __claim():
+    """:return (id, plugin, payload, attempts) of the oldest pending job, now marked running; or None"""
+    with __lock:
+        busy = list(__running_plugins)
+        with closing(__connect()) as conn:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute(
+                    f"SELECT id, plugin, payload, attempts+1 FROM jobs WHERE state=? "
+                    f"AND plugin NOT IN ({','.join('?' * len(busy))}) ORDER BY id LIMIT 1",
+                    (PENDING, *busy),
+                ).fetchone()
+                if row is None:
+                    return None
+                conn.execute(
+                    "UPDATE jobs SET state=?, pid=?, attempts=attempts+1, updated=? WHERE id=?",
+                    (RUNNING, os.getpid(), time.time(), row[0]),
+                )
+        __running_plugins.add(row[1])
+        return row
+
+
+def __finish(job_id: int, plugin: str, state: str):
+    with __lock:
+        __running_plugins.discard(plugin)
+    with closing(__connect()) as conn:
+        conn.execute(
+            "UPDATE jobs SET state=?, updated=? WHERE id=?",
+            (state, time.time(), job_id),
+        )
+    __wakeup.set()  # Another job for this plugin may now run
+
+
+def __work(run_job: Callable[[Dict], None]):
+    while True:
+        try:
+            claimed = __claim()
+        except sqlite3.Error:
+            logging.exception("Cannot read work journal")
+            claimed = None
+        if claimed is None:
+            __wakeup.wait(_POLL_SECONDS)
+            __wakeup.clear()
+            continue
+        job_id, plugin, payload, attempts = claimed
+        state = DONE
+        try:
+            run_job(json.loads(payload))
+        except Exception:
+            logging.exception(
+                "Error on journaled job %s, attempt %d", payload, attempts
+            )
+            state = PENDING if attempts < _MAX_ATTEMPTS else FAILED
+        finally:
+            __finish(job_id, plugin, state)